@@ -0,0 +1,53 @@
+"""
+Compare the JSON codecs available to jqi, on documents like the ones it's used on.
+
+    python -m bench.codec [records [repeats]]
+"""
+import random
+import sys
+import timeit
+
+from jqi import codec, render
+
+
+def records(n):
+    rng = random.Random(0)
+    return [{
+        "id": i,
+        "time": 1600000000.0 + i * 0.25,
+        "kind": rng.choice(["click", "view", "purchase"]),
+        "user": {"name": "user-{}".format(rng.randrange(1000)), "tags": ["a", "b", "é"][:rng.randrange(4)]},
+        "payload": "x" * rng.randrange(200),
+        "ok": rng.random() < 0.9,
+        "parent": None,
+    } for i in range(n)]
+
+
+def main(n=20000, repeats=3):
+    values = records(n)
+    lines = [codec.CODECS["json"][1](v).encode() for v in values]
+    document = b"[" + b",".join(lines) + b"]"
+    print("{} records, {:.1f} MB".format(n, len(document) / 2 ** 20))
+
+    for name, (loads, dumps) in codec.CODECS.items():
+        def time(f):
+            return min(timeit.repeat(f, number=1, repeat=repeats)) * 1e3
+
+        def rendered(**kwargs):
+            # Strings within the rendered output are encoded by the codec
+            saved = codec.dumps
+            codec.dumps = dumps
+            try:
+                return time(lambda: render.render(values, **kwargs))
+            finally:
+                codec.dumps = saved
+
+        print("{:7} {:22} {:9.1f} ms".format(name, "decode NDJSON lines", time(lambda: [loads(line) for line in lines])))
+        print("{:7} {:22} {:9.1f} ms".format(name, "decode one document", time(lambda: loads(document))))
+        print("{:7} {:22} {:9.1f} ms".format(name, "encode compact", time(lambda: [dumps(v) for v in values])))
+        print("{:7} {:22} {:9.1f} ms".format(name, "render (jq style)", rendered()))
+        print("{:7} {:22} {:9.1f} ms".format(name, "render -c, coloured", rendered(compact=True, colour=True)))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
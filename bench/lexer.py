@@ -0,0 +1,31 @@
+"""
+Compare the parsy and regular-expression lexers.
+
+    python -m bench.lexer [repeats]
+"""
+import sys
+import timeit
+
+from jqi.lexer import _scan_parsy, _scan_regex
+
+SMALL = ["...", "", " ", "1", "# testing\n1", ".data", ".data[]", "and", ". ", "$x"]
+
+STAGE = '.items[] | select(.kind == "widget" and .size >= 10) | {name: .name, tags: [.tags[] | @base64]}'
+LARGE = {
+    "one line": " | ".join([STAGE] * 200),
+    "multi-line": "\n".join("# stage {}\n{} |".format(i, STAGE) for i in range(200)) + " .",
+    "nested": "[" * 200 + ".a" + "]" * 200,
+}
+
+
+def main(repeats=5):
+    for name, scan in [("parsy", _scan_parsy), ("regex", _scan_regex)]:
+        small = min(timeit.repeat(lambda: [list(scan(s)) for s in SMALL], number=200, repeat=repeats)) / 200
+        print("{:6} {:12} {:10.1f} us".format(name, "test cases", small * 1e6))
+        for label, s in LARGE.items():
+            t = min(timeit.repeat(lambda: list(scan(s)), number=5, repeat=repeats)) / 5
+            print("{:6} {:12} {:10.2f} ms  ({} chars)".format(name, label, t * 1e3, len(s)))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
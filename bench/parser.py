@@ -0,0 +1,38 @@
+"""
+Time the parser on deeply nested queries and long operator chains.
+
+    python -m bench.parser [module [repeats]]
+
+`module` names an alternative parser module with the same interface, for comparison.
+"""
+import importlib
+import sys
+import timeit
+
+from jqi.lexer import lex
+
+QUERIES = {
+    "nested": lambda n: "[" * n + ".a" + "]" * n,
+    "parens": lambda n: "(" * n + "1" + ")" * n,
+    "pipe": lambda n: " | ".join([".a"] * n),
+    "comma": lambda n: ", ".join([".a"] * n),
+    "arith": lambda n: " + ".join(["1 * .a"] * n),
+    "mixed": lambda n: " | ".join(['select(.kind == "w" and .n >= 1) | {a: .x, b: [.y[]]}'] * n),
+}
+
+
+def main(module="jqi.parser", repeats="3"):
+    parser = importlib.import_module(module)
+    for name, make in QUERIES.items():
+        for n in (10, 100, 400):
+            tokens = lex(make(n))
+            try:
+                t = min(timeit.repeat(lambda: parser.top_level.parse(tokens), number=3, repeat=int(repeats))) / 3
+            except RecursionError:
+                print("{:8} {:5} {:>10}".format(name, n, "too deep"))
+                continue
+            print("{:8} {:5} {:10.2f} ms  ({} tokens)".format(name, n, t * 1e3, len(tokens)))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
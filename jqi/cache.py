@@ -0,0 +1,75 @@
+"""
+Remember the results of recent evaluations.
+"""
+from collections import OrderedDict
+
+from parsy import ParseError
+
+from .lexer import lex, _start
+
+
+def normalise(pattern):
+    """
+    Canonical text for a filter: comments are dropped and each run of whitespace between tokens becomes
+    a single space, so that filters which differ only in layout share a result.
+
+    Tokens are never joined or split apart, since jq (which may be running the filter) and jqi's lexer
+    don't always agree on where one token ends.
+    """
+    try:
+        tokens = lex(pattern)
+    except ParseError:
+        return pattern.strip()
+    parts = []
+    end = None
+    for t in tokens:
+        start = _start(t)
+        if end is not None and start > end:
+            parts.append(" ")
+        parts.append(pattern[start:t.pos[1]])
+        end = t.pos[1]
+    return "".join(parts)
+
+
+class ResultCache:
+    """
+    A least-recently-used map from keys to results, holding no more than `budget` characters of
+    results in total. A single result larger than the budget isn't kept at all.
+    """
+    def __init__(self, budget=32 * 2 ** 20):
+        self.budget = budget
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value, _ = self._entries[key]
+        except KeyError:
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value, size):
+        self.discard(key)
+        if size > self.budget:
+            return
+        self._entries[key] = value, size
+        self.size += size
+        while self.size > self.budget:
+            _, (_, dropped) = self._entries.popitem(last=False)
+            self.size -= dropped
+
+    def discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,8 +1,11 @@
 import argparse_helper as argparse
 import config_dir
+import os
+import stat
 import sys
 
 from .editor import Editor
+from .source import Input
 
 
 def main(*args):
@@ -13,6 +16,8 @@ def main(*args):
     parser.add_argument("-x", default=False, action="store_true", dest="run", help="run immediately")
     parser.add_argument("-l", default=False, action="count", dest="list", help="list saved queries")
     parser.add_argument("-p", default=False, action="store_true", dest="previous", help="use previous query")
+    parser.add_argument("--backend", choices=["auto", "jq"], default="auto",
+                        help="run filters in-process where possible (auto), or always with jq")
     parser.add_argument("pattern", nargs="?", help="override saved pattern")
     parser.add_argument("file", nargs="?", help="file to operate on")
     args = parser.parse_args(*args)
@@ -24,7 +29,7 @@ def main(*args):
         args.file = args.pattern
         args.pattern = None
 
-    editor = Editor(file=args.cfg_file, pattern=args.pattern)
+    editor = Editor(file=args.cfg_file, pattern=args.pattern, backend=args.backend)
 
     if args.list > 0:
         if args.cfg_file is not None:
@@ -34,16 +39,23 @@ def main(*args):
             list_stored(args.list > 1)
         return
 
+    # jq reads the input from a file: the one named, or a copy of stdin. A file that isn't a regular one
+    # (a pipe, say, from `<(cmd)`) can only be read once, so it's copied like stdin.
     if args.file is None:
-        text = sys.stdin.read()
+        source = Input.from_stream(sys.stdin.buffer)
+    elif stat.S_ISREG(os.stat(args.file).st_mode):
+        source = Input.from_path(args.file)
     else:
-        with open(args.file) as f:
-            text = f.read()
+        with open(args.file, "rb") as f:
+            source = Input.from_stream(f)
 
     if args.run:
-        editor.jq(text, stdio=True)
+        try:
+            editor.jq(source, stdio=True)
+        finally:
+            editor.close()
     else:
-        result = editor.run(text)
+        result = editor.run(source)
         if result == 0:
             editor.save()
             editor.save("previous")
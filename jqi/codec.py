@@ -0,0 +1,52 @@
+"""
+JSON decoding and encoding.
+
+The standard library's `json` module is always available; orjson is used instead if it's installed.
+Set JQI_CODEC to "json" or "orjson" to choose.
+
+orjson is stricter than jq in places (it won't decode NaN, or encode strings holding lone surrogates),
+so anything it refuses is handed on to `json` before being reported as an error. Errors are always
+`json.JSONDecodeError`s.
+"""
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_loads(data):
+    return json.loads(data)
+
+
+def _json_dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def _orjson_loads(data):
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return json.loads(data)
+
+
+def _orjson_dumps(value):
+    try:
+        return orjson.dumps(value).decode()
+    except orjson.JSONEncodeError:
+        return _json_dumps(value)
+
+
+CODECS = {
+    "json": (_json_loads, _json_dumps),
+}
+if orjson is not None:
+    CODECS["orjson"] = (_orjson_loads, _orjson_dumps)
+
+NAME = os.environ.get("JQI_CODEC", "orjson" if orjson is not None else "json")
+
+# Decode a JSON text (str or bytes-like) to a value
+# Encode a value as compact JSON text. Strings are encoded as jq would, but numbers may not be.
+loads, dumps = CODECS[NAME]
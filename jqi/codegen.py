@@ -0,0 +1,355 @@
+"""
+Compile a filter tree to Python source.
+
+`compile_python` turns an evaluator (as built by `jqi.eval`, which records its construction in a
+`node` attribute) into a single generated generator function with the same calling convention. The
+code is emitted in continuation-passing style: single-valued steps (field access, literals, arithmetic,
+comparisons, `select`) become straight-line assignments and `if` tests, and only steps that can produce
+several values open a `for` loop.
+
+Anything the generator doesn't recognise is called as an opaque evaluator from the generated code.
+
+`compile_query` parses, optimises and compiles a query, caching the result by query text. A query that
+defines functions is compiled for `jqi.vm` instead, which runs recursive definitions without recursing.
+"""
+
+import functools
+
+from .eval import _access, checked, neg, Function, ROOT, _NUMBERS, _PLAIN, add, sub, mul, eq, ne, lt, le, gt, ge
+from .function import _truth
+from .optimize import optimize
+from .parser import parse
+from .vm import compile_filter
+
+# CPython refuses more than 20 statically nested blocks in one function. Beyond this depth,
+# the remainder of the code is moved into a nested function.
+_MAX_BLOCKS = 16
+
+# Operators which agree with Python's when both operands are numbers or, for comparisons, both strings. A zero
+# product is left to `mul`, for its sign.
+_OPERATORS = {
+    add: ("{x} + {y}", False),
+    sub: ("{x} - {y}", False),
+    mul: ("{x} * {y} or {o}({x}, {y})", False),
+    eq: ("{x} == {y}", True),
+    ne: ("{x} != {y}", True),
+    lt: ("{x} < {y}", True),
+    le: ("{x} <= {y}", True),
+    gt: ("{x} > {y}", True),
+    ge: ("{x} >= {y}", True),
+}
+
+
+def _plain_test(strings, x, vx, y, vy):
+    # A test that the operands `vx` and `vy` (computed by `x` and `y`) are such a pair, or None if they can't be.
+    # A literal's type is known, so only the other operand need be looked at.
+    for f, other in ((x, vy), (y, vx)):
+        node = getattr(f, "node", None)
+        if node is not None and node[0] == "literal":
+            value = node[1]
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                return "type({}) in _NUMBERS".format(other)
+            elif isinstance(value, str) and strings:
+                return "type({}) is str".format(other)
+            return None
+    if strings:
+        return "(type({}), type({})) in _PLAIN".format(vx, vy)
+    return "type({}) in _NUMBERS and type({}) in _NUMBERS".format(vx, vy)
+
+
+def _each(item):
+    if isinstance(item, list):
+        return checked(item)
+    elif isinstance(item, dict):
+        return checked(item.values())
+    raise ValueError("can't iterate over {}".format(type(item).__name__))
+
+
+def compile_python(f):
+    """
+    Compile an evaluator into a generated function taking and returning a stream of `(env, item)` pairs.
+
+    If the tree is too deep to generate code for, the evaluator is returned unchanged.
+    """
+    generator = _Generator(track_paths=_has_node(f, "set_path"))
+    try:
+        source = generator.generate(f)
+    except RecursionError:
+        return f
+    namespace = dict(generator.consts, _access=_access, _neg=neg, _truth=_truth, _each=_each, _Function=Function,
+                     _ROOT=ROOT, _PLAIN=_PLAIN, _NUMBERS=_NUMBERS)
+    exec(compile(source, "<jq {}>".format(f.__name__), "exec"), namespace)
+    compiled = namespace["_compiled"]
+    compiled.source = source
+    return compiled
+
+
+@functools.lru_cache(maxsize=128)
+def compile_query(s):
+    f = optimize(parse(s))
+    if _has_node(f, "definition"):
+        # Generated code runs `def` bodies on the Python stack; the VM's tail calls don't recurse
+        return compile_filter(f)
+    return compile_python(f)
+
+
+def _has_node(f, op, seen=None):
+    if seen is None:
+        seen = set()
+    if id(f) in seen:
+        return False
+    seen.add(id(f))
+    node = getattr(f, "node", None)
+    if node is None:
+        return False
+    if node[0] == op:
+        return True
+    for arg in node[1:]:
+        if isinstance(arg, (list, tuple)):
+            if any(_has_node(a, op, seen) for pair in arg for a in (pair if isinstance(pair, tuple) else [pair])):
+                return True
+        elif callable(arg) and _has_node(arg, op, seen):
+            return True
+    return False
+
+
+class _Generator:
+    def __init__(self, track_paths=False):
+        self.track_paths = track_paths
+        self.lines = []
+        self.indent = 0
+        self.blocks = 0
+        self.consts = {}
+        self.counter = 0
+
+    def generate(self, f):
+        self.emit("def _compiled(stream):")
+        with self.block("for env, item in stream:"):
+            self.gen(f, "env", "item", lambda e, v: self.emit("yield {}, {}".format(e, v)))
+        return "\n".join(self.lines) + "\n"
+
+    def emit(self, line):
+        self.lines.append("    " * (self.indent + 1) + line if self.lines else line)
+
+    def fresh(self, prefix="v"):
+        self.counter += 1
+        return "{}{}".format(prefix, self.counter)
+
+    def const(self, obj):
+        name = self.fresh("_k")
+        self.consts[name] = obj
+        return name
+
+    def literal(self, n):
+        if n is None or isinstance(n, bool):
+            return repr(n)
+        elif isinstance(n, str):
+            return repr(str(n))
+        elif isinstance(n, int):
+            return repr(int(n))
+        elif isinstance(n, float) and n == n and n not in (float("inf"), float("-inf")):
+            return repr(float(n))
+        return self.const(n)
+
+    def block(self, header):
+        generator = self
+
+        class Block:
+            def __enter__(self):
+                if generator.blocks >= _MAX_BLOCKS:
+                    # Start a fresh code object; it closes over the variables in scope.
+                    self.name = generator.fresh("_nested")
+                    self.saved = generator.blocks
+                    generator.emit("def {}():".format(self.name))
+                    generator.indent += 1
+                    generator.blocks = 0
+                else:
+                    self.name = None
+                generator.emit(header)
+                generator.indent += 1
+                generator.blocks += 1
+
+            def __exit__(self, *exc):
+                generator.indent -= 1
+                generator.blocks -= 1
+                if self.name is not None:
+                    generator.emit("yield from ()")
+                    generator.indent -= 1
+                    generator.blocks = self.saved
+                    generator.emit("yield from {}()".format(self.name))
+
+        return Block()
+
+    def gen(self, f, env, val, k):
+        node = getattr(f, "node", None)
+        if node is None:
+            return self.gen_native(f, env, val, k)
+
+        op, *args = node
+        if op == "pipe":
+            x, y = args
+            self.gen(x, env, val, lambda e, v: self.gen(y, e, v, k))
+        elif op == "dot":
+            k(env, val)
+        elif op in ("field", "fields"):
+            for f in args:
+                key = self.literal(str(f))
+                v = self.fresh()
+                self.emit("{v} = {i}.get({key}) if type({i}) is dict else _access({i}, {key})".format(v=v, i=val, key=key))
+                val = v
+            k(self.path(env, self.const(args[0] if op == "field" else tuple(args))), val)
+        elif op == "literal":
+            v = self.fresh()
+            self.emit("{} = {}".format(v, self.literal(args[0])))
+            k(self.path(env), v)
+        elif op == "variable":
+            v = self.fresh()
+            self.emit("{} = {}[{}]".format(v, env, repr(args[0])))
+            k(self.path(env), v)
+        elif op == "local":
+            v = self.fresh()
+            self.emit("{} = {}".format(v, self.lookup(env, args[1], args[2])))
+            k(self.path(env), v)
+        elif op == "iterate":
+            v = self.fresh()
+            with self.block("for {} in _each({}):".format(v, val)):
+                k(env, v)
+        elif op == "op":
+            oper, x, y = args
+            plain, strings = _OPERATORS.get(oper, (None, False))
+            oper = self.const(oper)
+
+            def then_x(ey, vy):
+                def combine(ex, vx):
+                    v = self.fresh()
+                    test = None if plain is None else _plain_test(strings, x, vx, y, vy)
+                    if test is None:
+                        self.emit("{} = {}({}, {})".format(v, oper, vx, vy))
+                    else:
+                        # Python's operator will do for plain operands; jq's rules apply to the rest
+                        self.emit("{v} = {p} if {t} else {o}({x}, {y})".format(
+                            v=v, p=plain.format(x=vx, y=vy, o=oper), t=test, o=oper, x=vx, y=vy))
+                    k(ey, v)
+                self.gen(x, env, val, combine)
+            self.gen(y, env, val, then_x)
+        elif op == "negate":
+            def negate(e, v):
+                v2 = self.fresh()
+                self.emit("{} = _neg({})".format(v2, v))
+                k(e, v2)
+            self.gen(args[0], env, val, negate)
+        elif op == "collect":
+            acc = self.fresh("acc")
+            self.emit("{} = []".format(acc))
+            self.gen(args[0], env, val, lambda e, v: self.emit("{}.append({})".format(acc, v)))
+            k(env, acc)
+        elif op == "binding":
+            term, pattern, exp, names = args
+            pattern = self.const(pattern)
+
+            def bind(et, vt):
+                b = self.fresh("b")
+                with self.block("for {} in {}.bindings([({}, {})], {}):".format(b, pattern, env, val, vt)):
+                    e = self.fresh("e")
+                    if names is None:
+                        self.emit("{} = {}.child({})".format(e, env, b))
+                    else:
+                        values = "".join("{}[{!r}], ".format(b, n) for n in names)
+                        self.emit("{} = {}.push(({}))".format(e, env, values))
+                    self.gen(exp, e, val, k)
+            self.gen(term, env, val, bind)
+        elif op in ("comma", "log_and", "log_or"):
+            self.gen_generator(f, op, args, env, val, k)
+        elif op == "call":
+            self.gen_call("{}[{}]".format(env, repr(args[0])), args[1:], env, val, k)
+        elif op == "local_call":
+            self.gen_call(self.lookup(env, args[1], args[2]), args[3:], env, val, k)
+        elif op == "builtin":
+            if not self.gen_inline(args[0], args[2:], env, val, k):
+                self.gen_call(self.const(args[1]), args[2:], env, val, k)
+        elif op == "definition":
+            ident_name, params, body, rest = args
+            e = self.fresh("e")
+            self.emit("{} = _Function({}, {}, {}).env".format(e, self.const(params), self.const(body), env))
+            self.gen(rest, e, val, k)
+        else:
+            self.gen_native(f, env, val, k)
+
+    def gen_generator(self, f, op, args, env, val, k):
+        # Rather than duplicate the continuation for each branch, the branches yield into it
+        name = self.fresh("_branches")
+        ev, vv = self.fresh("e"), self.fresh("i")
+        saved = self.indent, self.blocks
+        self.emit("def {}({}, {}):".format(name, ev, vv))
+        self.indent += 1
+        self.blocks = 0
+        out = lambda e, v: self.emit("yield {}, {}".format(e, v))
+        x, y = args
+        if op == "comma":
+            self.gen(x, ev, vv, out)
+            self.gen(y, ev, vv, out)
+        else:
+            def test(e1, v1):
+                self.emit("if _truth({}) is {}:".format(v1, op == "log_and"))
+                self.indent += 1
+                self.gen(y, ev, vv, lambda e2, v2: out(e2, "_truth({})".format(v2)))
+                self.indent -= 1
+                self.emit("else:")
+                self.indent += 1
+                out(e1, repr(op == "log_or"))
+                self.indent -= 1
+            self.gen(x, ev, vv, test)
+        self.emit("yield from ()")
+        self.indent, self.blocks = saved
+        e, v = self.fresh("e"), self.fresh()
+        with self.block("for {}, {} in {}({}, {}):".format(e, v, name, env, val)):
+            k(e, v)
+
+    def gen_inline(self, ident_name, argfs, env, val, k):
+        # Inline the simplest builtins; returns whether `ident_name` was one of them
+        if ident_name == "select/1":
+            def test(e, v):
+                self.emit("if _truth({}):".format(v))
+                self.indent += 1
+                k(env, val)
+                self.indent -= 1
+            self.gen(argfs[0], env, val, test)
+        elif ident_name == "empty/0":
+            # Still a generator, even if this is the only way out
+            self.emit("yield from ()")
+        elif ident_name in ("true/0", "false/0", "null/0"):
+            k(env, {"true/0": "True", "false/0": "False", "null/0": "None"}[ident_name])
+        elif ident_name == "not/0":
+            v = self.fresh()
+            self.emit("{} = not _truth({})".format(v, val))
+            k(env, v)
+        else:
+            return False
+        return True
+
+    def gen_call(self, fun, argfs, env, val, k):
+        # `fun` is an expression for the function to call
+        e, v = self.fresh("e"), self.fresh()
+        args = "".join(", {}".format(self.const(a)) for a in argfs)
+        with self.block("for {}, {} in {}({}, {}{}):".format(e, v, fun, env, val, args)):
+            k(e, v)
+
+    def gen_native(self, f, env, val, k):
+        e, v = self.fresh("e"), self.fresh()
+        with self.block("for {}, {} in {}([({}, {})]):".format(e, v, self.const(f), env, val)):
+            k(e, v)
+
+    def lookup(self, env, depth, slot):
+        # The value in `slot` of the frame `depth` frames out (see `jqi.optimize.resolve`)
+        return "{}.frame{}.values[{}]".format(env, ".parent" * depth, slot)
+
+    def path(self, env, step=None):
+        if not self.track_paths:
+            # Paths are only consulted by update operators; elsewhere, the environment passes through
+            return env
+        e = self.fresh("e")
+        if step is None:
+            self.emit("{} = {}.at(_ROOT)".format(e, env))
+        else:
+            self.emit("{} = {}.at(({}.path, {}))".format(e, env, env, step))
+        return e
@@ -1,6 +1,9 @@
+import contextvars
 import functools
 from numbers import Number
-from .parser import Field, Token, Ident, PartialString, String
+import random
+import time
+from .lexer import Field, Token, Ident, PartialString, String
 
 
 class Completion(Exception):
@@ -10,10 +13,55 @@ class Completion(Exception):
         self.pos = pos
 
 
+class Sampling:
+    """
+    How much of a stream completion looks at.
+
+    `method` is "first", to take the first `limit` items; "reservoir", to take a uniform sample of
+    `limit` items from those seen before the `budget` (in seconds) runs out; or "exhaustive", to take
+    everything. With "first", the budget also applies. A limit or budget of None means no limit.
+
+    Completion samples its input, then samples again wherever it collects candidates. Streams are
+    lazy, so items beyond the sample are never computed.
+    """
+    def __init__(self, method="first", limit=1000, budget=0.1):
+        if method not in ("first", "reservoir", "exhaustive"):
+            raise ValueError("unknown sampling method {}".format(method))
+        self.method = method
+        self.limit = limit
+        self.budget = budget
+
+    def __call__(self, stream):
+        if self.method == "exhaustive":
+            return list(stream)
+        deadline = None if self.budget is None else time.monotonic() + self.budget
+        sample = []
+        # Seeded, so the same stream gets the same completions
+        rng = random.Random(0)
+        for seen, item in enumerate(stream, 1):
+            if self.limit is None or len(sample) < self.limit:
+                sample.append(item)
+            else:
+                i = rng.randrange(seen)
+                if i < self.limit:
+                    sample[i] = item
+            if self.method == "first" and self.limit is not None and len(sample) >= self.limit:
+                break
+            if deadline is not None and time.monotonic() > deadline:
+                break
+        return sample
+
+
+EXHAUSTIVE = Sampling("exhaustive")
+
+# The sampling used by completions; see `jqi.completion.completer`
+_sampling = contextvars.ContextVar("sampling", default=Sampling())
+
+
 # return the union of keys of objects in the stream
 def sample_objects(stream):
     keys = set()
-    for env, item in stream:
+    for env, item in _sampling.get()(stream):
         try:
             keys.update(item.keys())
         except AttributeError:
@@ -44,6 +92,20 @@ def complete_term(term, evaluator):
         return evaluator
 
 
+def _hook(make):
+    """
+    Record how a completion hook was made, and around which filter, so that scope resolution (see
+    `jqi.optimize.resolve`) can make it again around the resolved filter.
+    """
+    @functools.wraps(make)
+    def remake(*args):
+        f = make(*args)
+        f.node = ("complete", remake, *args)
+        return f
+    return remake
+
+
+@_hook
 def complete_field(prefix, evaluator):
     def complete_field(stream):
         stream = evaluator(stream)
@@ -52,6 +114,7 @@ def complete_field(prefix, evaluator):
     return complete_field
 
 
+@_hook
 def complete_comparison(evaluator):
     def complete_comparison(stream):
         stream = evaluator(stream)
@@ -62,7 +125,7 @@ def complete_comparison(evaluator):
 
 def sample_values(stream):
     items = set()
-    for env, item in stream:
+    for env, item in _sampling.get()(stream):
         if isinstance(item, (Number, str)):
             items.add(item)
     return sorted(items, key=functools.cmp_to_key(jq_cmp))
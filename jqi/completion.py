@@ -1,20 +1,31 @@
-from .lexer import lex
-from .parser import top_level
+from .parser import top_level, complete as parse_completion
 from .completer import *
+from .completer import _sampling
 from .eval import make_env, splice
 
 
-def completer(s, offset, start=top_level):
-    evaluator = start.parse(lex(s, offset))
+def completer(s, offset, start=top_level, relexer=None):
+    evaluator = parse_completion(s, offset, start, relexer)
 
-    def complete(stream="", env=None):
+    def complete(stream="", env=None, sampling=None):
+        """
+        `sampling` bounds how many values candidates are drawn from; by default, a quick sample.
+        """
         if env is None:
             env = {}
         env = make_env().update(env)    # Install standard bindings
+        token = _sampling.set(sampling) if sampling is not None else None
         try:
-            _ = evaluator(splice(env, stream))
+            # The input is materialised by `splice`, so only a sample of it is taken
+            stream = _sampling.get()(stream)
+            # Evaluation is lazy: drain the stream so that any completion point is reached
+            for _ in evaluator(splice(env, stream)):
+                pass
             return []
         except Completion as c:
             return c.completions, c.pos if c.pos is not None else (offset, offset)
+        finally:
+            if token is not None:
+                _sampling.reset(token)
 
     return complete
@@ -1,7 +1,6 @@
 """Mix-ins for the Editor"""
 import asyncio
 import config_dir
-import io
 import json
 from numbers import Number
 from prompt_toolkit import Application
@@ -16,71 +15,106 @@ from prompt_toolkit.layout.containers import HSplit, VSplit, Window
 from prompt_toolkit.layout.controls import BufferControl, FormattedTextControl
 from prompt_toolkit.layout.layout import Layout
 from prompt_toolkit.layout.menus import CompletionsMenu
-import re
-import sh
 import sys
+import time
 import types
 import yaml
 
+from . import codec
+from .cache import ResultCache, normalise
+from .completer import Sampling
 from .completion import completer
+from .lexer import Relexer, typed_edit
 from .parser import Token, Field, String
+from .render import render
+from .source import Input, MappedValues
+from .view import LineIndex
+from .worker import JqWorker, InProcessWorker, FallbackWorker, Failed
 
 
 class Refresh:
-    def __init__(self, *args, **kwargs):
-        self._counting = False
+    """
+    Calls `refresh` once the pattern has stopped changing for `delay` seconds. Nothing runs while the
+    pattern is left alone: each change (reported to `schedule_refresh`) restarts a single timer.
+
+    In adaptive mode, the delay is cut to a few times the duration of the last evaluation (as reported
+    to `record_duration`), so that cheap filters update almost as they're typed.
+    """
+    MIN_DELAY = 0.05
+    ADAPTIVE_FACTOR = 2
+
+    def __init__(self, *args, delay=0.5, adaptive=True, **kwargs):
+        self.delay = delay
+        self.adaptive = adaptive
+        self.last_duration = None
         self._old_pattern = None
         self._get_pattern = None
         self._refresh = None
-        self._task = None
+        self._timer = None
 
-    def create_refresh_task(self, refresh=None, get_pattern=None):
+    def start_refresh(self, refresh=None, get_pattern=None):
         self._refresh = refresh
         self._get_pattern = get_pattern
-        self._task = asyncio.get_event_loop().create_task(self._tick())
-        return self._task
-
-    def cancel_refresh_task(self):
-        self._task.cancel()
-
-    def disable_refresh(self):
-        # Turn off the display update
-        self._counting = False
-        self._old_pattern = self._get_pattern()
-
-    async def _tick(self):
-        unchanged_count = 0
-        self._counting = False
-        self._old_pattern = self._get_pattern()
-        while True:
-            pattern = self._get_pattern()
-            if pattern != self._old_pattern:
-                self._old_pattern = pattern
-                unchanged_count = 0
-                self._counting = True
-            if self._counting:
-                unchanged_count += 1
-            if unchanged_count > 2:
-                self._counting = False
-                unchanged_count = 0
-                try:
-                    self._refresh()
-                except Exception as e:
-                    print("error:", e)
-            await asyncio.sleep(0.3)
+        self._old_pattern = get_pattern()
+
+    def stop_refresh(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._refresh = None
+
+    def refresh_delay(self):
+        if not self.adaptive or self.last_duration is None:
+            return self.delay
+        return min(self.delay, max(self.MIN_DELAY, self.last_duration * self.ADAPTIVE_FACTOR))
+
+    def record_duration(self, seconds):
+        self.last_duration = seconds
+
+    def schedule_refresh(self):
+        if self._refresh is None:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(self.refresh_delay(), self._fire)
+
+    def _fire(self):
+        self._timer = None
+        pattern = self._get_pattern()
+        if pattern == self._old_pattern:
+            return
+        self._old_pattern = pattern
+        try:
+            self._refresh()
+        except Exception as e:
+            print("error:", e)
 
 
 class JQCompleter(Completer):
-    def __init__(self, object_source=None, *args, **kwargs):
+    def __init__(self, object_source=None, sampling=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._object_source = object_source
+        self._sampling = sampling
+        # The query is relexed as it's edited; the buffer's events say where each edit was made
+        self.relexer = Relexer()
+        self._document = None
+
+    def text_changed(self, buf):
+        old, new = self._document, buf.document
+        if old is not None:
+            self.relexer.edited(old.text, new.text,
+                                typed_edit(old.text, old.cursor_position, new.text, new.cursor_position))
+        self._document = new
+
+    def cursor_moved(self, buf):
+        self._document = buf.document
 
     def get_completions(self, doc, event):
         expr = doc.text
         pos = doc.cursor_position
         try:
-            comp = completer(expr, pos)
-            completions, (start, end) = comp(self._object_source())
+            comp = completer(expr, pos, relexer=self.relexer)
+            completions, (start, end) = comp(self._object_source(), sampling=self._sampling)
             return (Completion(text=_expand_completion(c), start_position=start - pos)
                     for c in completions)
         except Exception as e:
@@ -92,33 +126,44 @@ def _expand_completion(c):
     if isinstance(c, (Token, Field)):
         return c
     elif isinstance(c, (String, str, Number)):
-        return json.dumps(c)
+        return codec.dumps(c)
     else:
         raise NotImplementedError("{} = {}".format(c, type(c)))
 
 
 class Editor(Refresh):
-    def __init__(self, pattern=None, file=None, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    def __init__(self, pattern=None, file=None, backend="auto", *args, **kwargs):
+        cfg = self.load_settings()
+        super().__init__(*args, **{**cfg.refresh, **kwargs})
         self.file = file
+        self.backend = backend
         if pattern is None:
             pattern = "."
         self.pattern = pattern
         self.compact = False
         self.raw = False
-        self.input = "{}"
-
-        self.kb = self.construct_key_bindings()
+        self.input = Input.from_text("{}")
+        self.input_id = 0
+        self.worker = None
+        self.job = None
+        self.shown_key = None
+        self.truncated = False
+
+        self.kb = self.construct_key_bindings(cfg.bindings)
+        self.results = ResultCache(**cfg.results)
+        self.screens = cfg.output["screens"]
+        self.sampling = Sampling(**cfg.completion)
 
         self.app = None
         self.buf = None
         self.status = None
         self.result = None
-        self.cache = {Editor.CACHE_ORIGINAL_OBJECT: None}
+        self.cache = {Editor.CACHE_ORIGINAL_OBJECT: None, Editor.CACHE_BYTES: "", Editor.CACHE_OBJECT: None,
+                      Editor.CACHE_JQ_LINES: None, Editor.CACHE_YAML_LINES: None}
         self.error = None
         self.vbar = self.completions = None
         self.result_coords = (0, 0)
-        self.max_coords = (0, 0)
+        self.lines = LineIndex("")
         self.load()
         self.layout()
         self.mode = Editor.CACHE_JQ_LINES
@@ -129,7 +174,8 @@ class Editor(Refresh):
     CACHE_JQ_LINES = 'LINES'
     CACHE_YAML_LINES = 'YAML'
 
-    def construct_key_bindings(self):
+    @staticmethod
+    def load_settings():
         bindings = [
             {"keys": ["c-x"], "args": dict(eager=True), "func": "exit"},
             {"keys": ["c-c"], "args": {}, "func": "quit"},
@@ -146,13 +192,38 @@ class Editor(Refresh):
             {"keys": ["escape", "pageup"], "args": {}, "func": "output_move"},
             {"keys": ["escape", "pagedown"], "args": {}, "func": "output_move"},
         ]
+        refresh = {
+            "delay": 0.5,       # seconds without typing before the pattern is evaluated
+            "adaptive": True,   # shorten the delay when evaluation is quick
+        }
+        results = {
+            "budget": 32 * 2 ** 20,     # characters of output to keep for recently-run filters
+        }
+        output = {
+            "screens": None,            # stop reading output after this many screenfuls; null to read it all
+        }
+        completion = {
+            "method": "first",          # first, reservoir or exhaustive: which values to offer completions from
+            "limit": 1000,              # how many values
+            "budget": 0.1,              # seconds to spend looking for them
+        }
         cfg = {
             "bindings": bindings,
+            "refresh": refresh,
+            "results": results,
+            "output": output,
+            "completion": completion,
         }
         cfg = types.SimpleNamespace(**config_dir.load_config(".jqi", default=cfg))
+        cfg.refresh = {**refresh, **getattr(cfg, "refresh", {})}
+        cfg.results = {**results, **getattr(cfg, "results", {})}
+        cfg.output = {**output, **getattr(cfg, "output", {})}
+        cfg.completion = {**completion, **getattr(cfg, "completion", {})}
+        return cfg
 
+    def construct_key_bindings(self, bindings):
         kb = KeyBindings()
-        for binding in cfg.bindings:
+        for binding in bindings:
             binding = types.SimpleNamespace(**binding)
             kb.add(*binding.keys, **binding.args)(getattr(self, binding.func))
 
@@ -187,11 +258,43 @@ class Editor(Refresh):
 
     def toggle_compact(self, event):
         self.compact = not self.compact
-        self.reformat()
+        self.rerender()
 
     def toggle_raw(self, event):
         self.raw = not self.raw
-        self.reformat()
+        self.rerender()
+
+    def rerender(self):
+        # Only the formatting has changed: lay out the values on display again
+        if not self.showing_current():
+            self.reformat()
+        elif self.cache[Editor.CACHE_OBJECT] is not None:
+            self.render_objects()
+        else:
+            self.start_job(self.rerender_async())
+
+    async def rerender_async(self):
+        try:
+            await self.load_objects()
+        except Failed:
+            return await self.evaluate()
+        self.render_objects()
+
+    def render_objects(self):
+        objects = self.cache[Editor.CACHE_OBJECT]
+        key = self.result_key()
+        out = render(objects, compact=self.compact, raw=self.raw, colour=True)
+        self.results.put(key, (out, None), len(out))
+        self.show(out, None, key)
+        self.cache[Editor.CACHE_OBJECT] = objects
+        self.update_status_bar()
+
+    def showing_current(self):
+        # Is the output on display the whole of the current filter's output?
+        if self.running or self.shown_key is None:
+            return False
+        pattern, args, input_id = self.shown_key
+        return (pattern, input_id) == (normalise(self.buf.text), self.input_id)
 
     def set_mode_jq(self, event):
         self.mode = Editor.CACHE_JQ_LINES
@@ -201,24 +304,140 @@ class Editor(Refresh):
 
     def set_mode_yaml(self, event):
         self.mode = Editor.CACHE_YAML_LINES
+        if self.cache[Editor.CACHE_OBJECT] is None and self.showing_current():
+            self.start_job(self.show_objects())
         self.update_status_bar()
         self.update_main_window()
         event.app.invalidate()
 
     def update_status_bar(self):
-        args = []
-        if self.compact:
-            args += ["-c"]
-        if self.raw:
-            args += ["-r"]
-
+        args = self.jq_args()
         self.status.text = "[{}]-[{}]".format(" ".join(args), self.mode)
+        if self.running:
+            self.status.text += "-[running]"
+        elif self.truncated:
+            self.status.text += "-[truncated]"
+
+    @property
+    def running(self):
+        return self.job is not None and not self.job.done()
 
     def reformat(self):
+        # Evaluate in the background, abandoning any evaluation that's still going
+        self.cancel_job()
+        key = self.result_key()
+        cached = self.results.get(key)
+        if cached is not None:
+            self.job = None
+            self.truncated = False
+            self.show(*cached, key)
+            self.update_status_bar()
+            if self.mode == Editor.CACHE_YAML_LINES and cached[0] is not None:
+                self.start_job(self.show_objects())
+            return
+        self.start_job(self.evaluate())
+
+    def start_job(self, coroutine):
+        self.cancel_job()
+        self.job = asyncio.ensure_future(coroutine)
+        self.job.add_done_callback(self.job_done)
         self.update_status_bar()
-        self.vbar.width = self.completions.width = 0
+        self.app.invalidate()
 
-        out, err = self.jq(tty=True)
+    def cancel_job(self):
+        if self.running:
+            self.job.cancel()
+
+    def job_done(self, job):
+        if not job.cancelled() and job.exception() is not None:
+            self.show(None, "error: {}".format(job.exception()), None)
+        self.update_status_bar()
+        self.app.invalidate()
+
+    def pattern_changed(self, buf):
+        # Whatever's being evaluated is left running until the refresh fires: the edit may yet be undone,
+        # in which case there's nothing to refresh and its result is still wanted
+        self.schedule_refresh()
+
+    async def evaluate(self):
+        key = self.result_key()
+        start = time.monotonic()
+        limit = None if self.screens is None else self.screens * self.app.output.get_size().rows
+        chunks, size, shown, lines = [], 0, 0, 0
+        self.truncated = False
+        stream = self.jq_stream(tty=True)
+        try:
+            async for chunk in stream:
+                if chunk is None:
+                    chunks, size, shown, lines = [], 0, 0, 0
+                    continue
+                chunks.append(chunk)
+                size += len(chunk)
+                lines += chunk.count("\n")
+                if limit is not None and lines >= limit:
+                    self.truncated = True
+                    break
+                if size >= 2 * shown:
+                    # Show the output so far. The first screenful appears at once; after that, waiting
+                    # for the output to double keeps the copying down.
+                    self.show("".join(chunks), None, None)
+                    shown = size
+        except Failed as e:
+            self.record_duration(time.monotonic() - start)
+            err = e.args[0]
+            self.results.put(key, (None, err), len(err))
+            self.show(None, err, None)
+            return
+        finally:
+            await stream.aclose()
+        self.record_duration(time.monotonic() - start)
+
+        out = "".join(chunks)
+        if self.truncated:
+            # This isn't the whole result, so it can't be kept or re-rendered
+            self.show(out, None, None)
+        else:
+            self.results.put(key, (out, None), len(out))
+            self.show(out, None, key)
+            if self.mode == Editor.CACHE_YAML_LINES:
+                await self.show_objects()
+
+    def values_key(self):
+        # The output values don't depend on how they're laid out
+        return normalise(self.buf.text), None, self.input_id
+
+    async def load_objects(self):
+        """
+        The values output by the current filter, as shown.
+        """
+        if (objects := self.cache[Editor.CACHE_OBJECT]) is not None:
+            return objects
+        key = self.values_key()
+        if (objects := self.results.get(key)) is None:
+            objects = await self.get_worker().objects(self.buf.text)
+            # The output on display is a fair guide to how much memory the values take
+            self.results.put(key, objects, len(self.cache[Editor.CACHE_BYTES]))
+        self.cache[Editor.CACHE_OBJECT] = objects
+        return objects
+
+    async def show_objects(self):
+        try:
+            await self.load_objects()
+        except Failed as e:
+            self.cache[Editor.CACHE_YAML_LINES] = LineIndex("Error fetching values for Yaml: {}".format(e.args[0]))
+        else:
+            self.cache[Editor.CACHE_YAML_LINES] = None
+        self.update_main_window()
+        self.app.invalidate()
+
+    def result_key(self):
+        # Results depend on the filter, the flags it's run with and the input it's run over
+        return normalise(self.buf.text), tuple(self.jq_args()), self.input_id
+
+    def show(self, out, err, key):
+        # `key` identifies the evaluation that produced the output, if it's one that could be repeated
+        self.vbar.width = self.completions.width = 0
+        self.shown_key = key if out is not None else None
         if out is not None:
             self.cache[Editor.CACHE_BYTES] = out
             self.cache[Editor.CACHE_JQ_LINES] = None
@@ -240,25 +459,24 @@ class Editor(Refresh):
         if self.mode == Editor.CACHE_JQ_LINES:
             out = self.cache[Editor.CACHE_BYTES]
             if (lines := self.cache[Editor.CACHE_JQ_LINES]) is None:
-                lines = self.cache[Editor.CACHE_JQ_LINES] = out.splitlines()
-                self.max_coords = (len(lines), max(len(line) for line in lines))
+                lines = self.cache[Editor.CACHE_JQ_LINES] = LineIndex(out)
         elif self.mode == Editor.CACHE_YAML_LINES:
             if (lines := self.cache[Editor.CACHE_YAML_LINES]) is None:
-                try:
-                    objects = self._get_cached_objects()
-                    out = yaml.safe_dump_all(objects)
-                except json.JSONDecodeError:
-                    out = "Error parsing stream as Yaml"
-                lines = self.cache[Editor.CACHE_YAML_LINES] = out.splitlines()
-                self.max_coords = (len(lines), max(len(line) for line in lines))
+                if (objects := self.cache[Editor.CACHE_OBJECT]) is None:
+                    # Not fetched yet
+                    lines = LineIndex("")
+                else:
+                    lines = self.cache[Editor.CACHE_YAML_LINES] = LineIndex(yaml.safe_dump_all(objects))
         else:
             raise NotImplementedError("Unknown mode: {}".format(self.mode))
+        self.lines = lines
 
-        # Window positioning goes here.
-        maxwidth = max(self.app.output.get_size().columns * 10, 160)
-        maxlen = max(self.app.output.get_size().rows * 2, 100)
+        # Only the lines on screen are cut out of the output. Escape sequences take up characters
+        # without taking up columns, so allow for plenty of them.
+        size = self.app.output.get_size()
         top, left = self.result_coords
-        self.result.content.text = ANSI("\n".join(line[left:left + maxwidth] for line in lines[top:top + maxlen]))
+        window = lines.window(top, size.rows, left, size.columns * 10)
+        self.result.content.text = ANSI("\n".join(window))
 
     def output_move(self, event):
         # key_sequence=[KeyPress(key=<Keys.Escape: 'escape'>, data='\x1b'), KeyPress(key=<Keys.Left: 'left'>, data='\x1b[D')]
@@ -266,11 +484,11 @@ class Editor(Refresh):
         width = self.app.output.get_size().columns
         height = self.app.output.get_size().rows
         top, left = self.result_coords
-        max_top, max_left = self.max_coords
+        max_top = len(self.lines)
         if seq == [Keys.Escape, Keys.Left]:
             left = max(0, left - 4)
         elif seq == [Keys.Escape, Keys.Right]:
-            left = min(max_left, left + 4)
+            left = min(self.lines.width(top, height), left + 4)
         elif seq == [Keys.Escape, Keys.Up]:
             top = max(0, top - 1)
         elif seq == [Keys.Escape, Keys.Down]:
@@ -282,56 +500,25 @@ class Editor(Refresh):
         elif seq == ["escape", "[", "1", ";", "9", "H"]:
             left = max(0, left - width)
         elif seq == ["escape", "[", "1", ";", "9", "F"]:
-            left = min(max_left, left + width)
+            left = min(self.lines.width(top, height), left + width)
         self.result_coords = (top, left)
         self.update_main_window()
 
-    _STRIP_ANSI = re.compile(r"""
-        (\001[^\002]*\002) | # zero-width sequence
-        (\033[^\[]) |        # Other escape
-        (\033 \[ [0-9;]* m)  # colour sequence
-        """, re.VERBOSE)
-
-    _NOT_WHITESPACE = re.compile(r'[^\s]')
-
-    @staticmethod
-    def _parse_json_objects(stream):
-        objects = []
-        parser = json.JSONDecoder()
-        offset = 0
-
-        while True:
-            match = Editor._NOT_WHITESPACE.search(stream, offset)
-            if not match:
-                break
-            try:
-                obj, offset = parser.raw_decode(stream, match.start())
-            except json.JSONDecodeError:
-                # do something sensible if there's some error
-                raise
-            objects.append(obj)
-
-        return objects
-
-    def _get_cached_objects(self):
-        if self.cache[Editor.CACHE_OBJECT]:
-            return self.cache[Editor.CACHE_OBJECT]
-
-        out = self.cache[Editor.CACHE_BYTES]
-        out = Editor._STRIP_ANSI.sub("", out)
-        objects = self.cache[Editor.CACHE_OBJECT] = self._parse_json_objects(out)
-        return objects
-
     def _get_cached_original_objects(self):
-        if self.cache[Editor.CACHE_ORIGINAL_OBJECT]:
+        if self.cache[Editor.CACHE_ORIGINAL_OBJECT] is not None:
             return self.cache[Editor.CACHE_ORIGINAL_OBJECT]
 
-        objects = self.cache[Editor.CACHE_ORIGINAL_OBJECT] = self._parse_json_objects(self.input)
+        # Input in a file is decoded a value at a time, as it's used
+        objects = self.cache[Editor.CACHE_ORIGINAL_OBJECT] = self.input.values()
         return objects
 
     def layout(self):
-        completer = JQCompleter(object_source=self._get_cached_original_objects)
+        completer = JQCompleter(object_source=self._get_cached_original_objects, sampling=self.sampling)
         self.buf = Buffer(document=Document(text=self.pattern), completer=completer)  # Editable buffer.
+        self.buf.on_text_changed += self.pattern_changed
+        self.buf.on_text_changed += completer.text_changed
+        self.buf.on_cursor_position_changed += completer.cursor_moved
+        completer.cursor_moved(self.buf)
         self.status = FormattedTextControl(text="")  # Status line
 
         root_container = HSplit([
@@ -365,51 +552,78 @@ class Editor(Refresh):
     def get_pattern(self):
         return self.buf.text
 
-    def run(self, text):
-        self.input = text
-        self.create_refresh_task(refresh=self.reformat, get_pattern=self.get_pattern)
-        self.reformat()
+    def set_input(self, source):
+        # The editor takes charge of `source`, an `Input` or the text of one
+        self.close()
+        self.input = Input.from_text(source) if isinstance(source, str) else source
+        self.input_id += 1
+        self.results.clear()
+
+    def close(self):
+        if self.worker is not None:
+            self.worker.close()
+            self.worker = None
+        if (objects := self.cache[Editor.CACHE_ORIGINAL_OBJECT]) is not None:
+            if isinstance(objects, MappedValues):
+                objects.close()
+            self.cache[Editor.CACHE_ORIGINAL_OBJECT] = None
+        self.input.close()
+
+    def run(self, source):
+        self.set_input(source)
+
+        def start():
+            # Called once the application's event loop is running
+            self.start_refresh(refresh=self.reformat, get_pattern=self.get_pattern)
+            self.reformat()
 
         # Run the application, and wait for it to finish.
-        result = self.app.run()
-        self.cancel_refresh_task()
-
-        if result != 0:
-            return result
+        result = self.app.run(pre_run=start)
+        self.stop_refresh()
 
-        out, _ = self.jq(tty=sys.stdout.isatty())
-        print(out, end="")
-        return 0
+        try:
+            if result != 0:
+                return result
+
+            out, _ = self.jq(tty=sys.stdout.isatty())
+            print(out, end="")
+            return 0
+        finally:
+            self.close()
+
+    def make_worker(self):
+        jq = JqWorker(self.input)
+        if self.backend == "jq":
+            return jq
+        try:
+            objects = self._get_cached_original_objects()
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return jq
+        # Filters that jqi can run itself are evaluated in-process; jq handles the rest
+        return FallbackWorker(InProcessWorker(objects), jq)
 
-    def jq(self, text=None, stdio=False, tty=False):
-        if text is not None:
-            self.input = text
+    def jq_args(self):
         args = []
         if self.compact:
             args += ["-c"]
         if self.raw:
             args += ["-r"]
-
-        args += [self.buf.text]
-
-        tty_args = {}
-        if stdio:
-            out = sys.stdout
-            err = sys.stderr
-        else:
-            out = io.StringIO()
-            err = io.StringIO()
-            tty_args.update({"_tty_out": tty})
-
-        try:
-            proc = sh.jq(*args, _in=self.input, _out=out, _err=err, _return_cmd=True, **tty_args)
-            proc.wait()
-            if not stdio:
-                out = out.getvalue()
-                err = None
-        except sh.ErrorReturnCode:
-            if not stdio:
-                out = None
-                err = err.getvalue()
-
-        return out, err
+        return args
+
+    def get_worker(self):
+        if self.worker is None:
+            # The input is handed over once; after that, only the filter changes
+            self.worker = self.make_worker()
+        return self.worker
+
+    def jq(self, source=None, stdio=False, tty=False):
+        if source is not None:
+            self.set_input(source)
+        # The preview may be evaluated in-process, but output that leaves jqi is always jq's own
+        with JqWorker(self.input) as worker:
+            if stdio:
+                return worker.run(self.buf.text, self.jq_args(), out=sys.stdout, err=sys.stderr)
+            return worker.run(self.buf.text, self.jq_args(), tty=tty)
+
+    def jq_stream(self, tty=False):
+        return self.get_worker().stream(self.buf.text, self.jq_args(), tty=tty)
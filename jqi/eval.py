@@ -1,29 +1,42 @@
 """
-Note: there are currently three shortcomings with this implementation.
+Note: there is currently one shortcoming with this implementation.
 
-The first is that we use materialised streams (ie, lists) and pass those around. It's not difficult
-to replace these with generators. The main issue with the current implementation is that it makes
-functions like `input` near-impossible to implement simply.
-
-The second issue is that we use the Python stack to manage the stack of filters.
+We use the Python stack to manage the stack of filters.
 This has some small advantages (exception management can lean on Python's implementation); however,
-it precludes optimisations like tail recursion.
+it precludes optimisations like tail recursion. `jqi.vm` compiles the same filter tree (each evaluator
+records how it was built in its `node` attribute) for an explicit-stack machine which doesn't have
+this limitation.
 
-The third issue is that we don't keep track of query paths. This makes update operators currently
-impossible to implement.
+Streams are lazy: each filter takes an iterable of `(env, item)` pairs and returns an iterator
+of them, so memory use is proportional to the depth of the pipeline rather than the width of
+the stream. Filters that need to see their input more than once (eg, both sides of a `,`) are
+handed a fresh single-item stream for each input pair.
 
-In time, all of these will be addressed (probably together).
+Query paths are tracked for the update operators: each environment carries the path at which its
+accompanying item was found.
 """
 
+import contextvars
+from itertools import islice
 from numbers import Number
-import operator
 
 from .error import Error
 from .lexer import Field, String
 from .function import _truth, REGISTER
 
 
+def node(op, *args):
+    """
+    Record how an evaluator was constructed, so that the filter tree can be walked (see `jqi.vm`)
+    """
+    def node(f):
+        f.node = (op, *args)
+        return f
+    return node
+
+
 def pipe(x, y):
+    @node("pipe", x, y)
     def pipe(stream):
         stream = x(stream)
         stream = y(stream)
@@ -31,243 +44,624 @@ def pipe(x, y):
     return pipe
 
 
+@node("dot")
 def dot(stream):
-    return stream
+    return iter(stream)
 
 
 def comma(x, y):
+    @node("comma", x, y)
     def comma(stream):
-        result = []
         for pair in stream:
-            r1s = x([pair])
-            result.extend(r1s)
-            r2s = y([pair])
-            result.extend(r2s)
-        return result
+            yield from x([pair])
+            yield from y([pair])
     return comma
 
 
+# An evaluation whose output stands in for jq's (see `jqi.worker`) sets this: indexing something that isn't an
+# object then fails, as it does in jq, instead of producing an `Error` value.
+strict = contextvars.ContextVar("strict", default=False)
+
+
+def _access(i, f):
+    if i is None:
+        return None     # jq semantics
+    try:
+        return i.get(str(f))       # ditto for missing fields
+    except Exception as e:
+        if strict.get():
+            raise ValueError("Cannot index {} with \"{}\"".format(_KINDS[_kind(i)][1], f)) from e
+        return Error.from_exception(e)
+
+
 def field(f):
-    def access(i):
-        if i is None:
-            return None     # jq semantics
-        try:
-            return i.get(str(f))       # ditto for missing fields
-        except Exception as e:
-            return Error.from_exception(e)
+    key = str(f)
 
+    @node("field", f)
     def _field_access(stream):
-        return [(e.child({".path": f}), access(i)) for (e, i) in stream]
+        return ((e.at((e.path, f)), i.get(key) if type(i) is dict else _access(i, f)) for (e, i) in stream)
 
     return _field_access
 
 
+def fields(*fs):
+    # `.a.b.c` as a single step: the item is walked once and the whole path is recorded in one environment
+    keys = [str(f) for f in fs]
+
+    @node("fields", *fs)
+    def _fields_access(stream):
+        for e, i in stream:
+            for key in keys:
+                i = i.get(key) if type(i) is dict else _access(i, key)
+            yield e.at((e.path, fs)), i
+
+    return _fields_access
+
+
 def literal(n):
     if isinstance(n, String):
         n = str(n)
+
+    @node("literal", n)
     def _literal(stream):
-        return [(e.child({".path": "."}), n) for (e, _) in stream]
+        return ((e.at(ROOT), n) for (e, _) in stream)
 
     return _literal
 
 
 def variable(v):
     ident_name = "${}".format(v)
+
+    @node("variable", ident_name)
     def variable(stream):
-        return [(e.child({".path": "."}), e[ident_name]) for (e, _) in stream]
+        return ((e.at(ROOT), e[ident_name]) for (e, _) in stream)
     return variable
 
 
-def binding(term, pattern, exp):
+def local(v, depth, slot):
+    # A variable which scope resolution (see `jqi.optimize.resolve`) has found in an enclosing frame
+    ident_name = "${}".format(v)
+
+    @node("local", ident_name, depth, slot)
+    def local(stream):
+        return ((e.at(ROOT), e.lookup(depth, slot)) for (e, _) in stream)
+    return local
+
+
+def binding(term, pattern, exp, names=None):
     # TODO: complex destructuring
+    # Once resolved, the bound values make a frame, in the order of `names`; otherwise, they're bound by name.
+    @node("binding", term, pattern, exp, names)
     def binding(stream):
-        results = []
         for (env, item) in stream:
             # Work out the value(s) to bind
             values = term([(env, item)])
             for env2, value in values:
-                bindings = pattern.bindings(stream, value)
+                bindings = pattern.bindings([(env, item)], value)
                 for binding in bindings:
-                    env3 = env.child(binding)
-                    items = exp([(env3, item)])
-                    results.extend(items)
-        return results
+                    env3 = bind(env, binding, names)
+                    yield from exp([(env3, item)])
     return binding
 
 
+def bind(env, bindings, names):
+    if names is None:
+        return env.child(bindings)
+    return env.push(tuple(bindings[n] for n in names))
+
+
 # log_and and log_or have bizarre short-circuiting behaviour
 def log_and(xf, yf):
+    @node("log_and", xf, yf)
     def log_and(stream):
-        results = []
-        xs = xf(stream)
-        for e1, x in xs:
-            if _truth(x):
-                # XXX: does the environment from the LHS percolate into the environment on the RHS?
-                ys = yf(stream)
-                results.extend((e2, _truth(y)) for (e2, y) in ys)
-            else:
-                results.append((e1, False))
-        return results
+        for pair in stream:
+            xs = xf([pair])
+            for e1, x in xs:
+                if _truth(x):
+                    # XXX: does the environment from the LHS percolate into the environment on the RHS?
+                    ys = yf([pair])
+                    yield from ((e2, _truth(y)) for (e2, y) in ys)
+                else:
+                    yield e1, False
     return log_and
 
 
 def log_or(xf, yf):
+    @node("log_or", xf, yf)
     def log_or(stream):
-        results = []
-        xs = xf(stream)
-        for e1, x in xs:
-            if _truth(x):
-                results.append((e1, True))
-            else:
-                ys = yf(stream)
-                results.extend((e2, _truth(y)) for (e2, y) in ys)
-        return results
+        for pair in stream:
+            xs = xf([pair])
+            for e1, x in xs:
+                if _truth(x):
+                    yield e1, True
+                else:
+                    ys = yf([pair])
+                    yield from ((e2, _truth(y)) for (e2, y) in ys)
     return log_or
 
 
 def op_generic(oper):
     def op_generic(xf, yf):
+        @node("op", oper, xf, yf)
         def op_mul(stream):
             # Check here: are environments regenerated and passed through?
-            xs = xf(stream)
-            ys = yf(stream)
-            return [(e, oper(x, y)) for (e, y) in ys for (_, x) in xs]
+            # The LHS is re-evaluated for each value of the RHS rather than being held in memory.
+            for pair in stream:
+                for (e, y) in yf([pair]):
+                    for (_, x) in xf([pair]):
+                        yield e, oper(x, y)
         return op_mul
     return op_generic
 
 
-op_mul = op_generic(operator.mul)
-op_add = op_generic(operator.add)
-op_sub = op_generic(operator.sub)
-op_div = op_generic(operator.truediv)
-op_mod = op_generic(operator.mod)
+# The arithmetic and comparison operators follow jq rather than Python: booleans aren't numbers, `%` truncates
+# towards zero, and mismatched operands are an error rather than whatever Python makes of them.
+
+_KINDS = ((type(None), "null"), (bool, "boolean"), (Number, "number"), (str, "string"), (list, "array"),
+          (dict, "object"))
+
+
+NULL, BOOLEAN, NUMBER, STRING, ARRAY, OBJECT = range(len(_KINDS))
+
+_ORDER = {type(None): NULL, bool: BOOLEAN, int: NUMBER, float: NUMBER, str: STRING, list: ARRAY, dict: OBJECT}
+
+# Operands of these types, both numbers or both strings, need no more than Python's own operators
+_NUMBERS = {int, float}
+_NUMBER_PAIRS = {(int, int), (int, float), (float, int), (float, float)}
+_PLAIN = _NUMBER_PAIRS | {(str, str)}
+
+
+def _kind(x):
+    kind = _ORDER.get(type(x))
+    if kind is not None:
+        return kind
+    for order, (t, _) in enumerate(_KINDS):
+        if isinstance(x, t):
+            return order
+    raise ValueError("not a JSON value: {!r}".format(x))
+
+
+def _type_error(x, y, message):
+    return ValueError("{} and {} {}".format(_KINDS[_kind(x)][1], _KINDS[_kind(y)][1], message))
+
+
+def compare(x, y):
+    """
+    jq's total order: null < false < true < numbers < strings < arrays < objects. Arrays compare
+    lexically; objects by their sorted keys first, then by the values under those keys.
+    """
+    if (type(x), type(y)) in _PLAIN:
+        return (x > y) - (x < y)
+    kx, ky = _kind(x), _kind(y)
+    if kx != ky:
+        return -1 if kx < ky else 1
+    if kx == BOOLEAN:
+        return (x > y) - (x < y)
+    elif kx in (NUMBER, STRING):
+        return (x > y) - (x < y)
+    elif kx == ARRAY:
+        for a, b in zip(x, y):
+            c = compare(a, b)
+            if c:
+                return c
+        return (len(x) > len(y)) - (len(x) < len(y))
+    elif kx == OBJECT:
+        keys = sorted(x)
+        c = compare(keys, sorted(y))
+        if c:
+            return c
+        for k in keys:
+            c = compare(x[k], y[k])
+            if c:
+                return c
+    return 0
+
+
+def add(x, y):
+    if type(x) in _NUMBERS and type(y) in _NUMBERS:
+        return x + y
+    if x is None:
+        return y
+    if y is None:
+        return x
+    kx, ky = _kind(x), _kind(y)
+    if kx == ky and kx in (NUMBER, STRING, ARRAY):
+        return x + y
+    elif kx == ky == OBJECT:
+        return {**x, **y}
+    raise _type_error(x, y, "cannot be added")
+
+
+def sub(x, y):
+    if type(x) in _NUMBERS and type(y) in _NUMBERS:
+        return x - y
+    kx, ky = _kind(x), _kind(y)
+    if kx == ky == NUMBER:
+        return x - y
+    elif kx == ky == ARRAY:
+        return [a for a in x if all(compare(a, b) for b in y)]
+    raise _type_error(x, y, "cannot be subtracted")
+
+
+def mul(x, y):
+    # A zero product of doubles has a sign (`0 * -1` is `-0`), which an int product loses: zeros are made as floats
+    if type(x) in _NUMBERS and type(y) in _NUMBERS:
+        return x * y or float(x) * float(y)
+    kx, ky = _kind(x), _kind(y)
+    if kx == ky == NUMBER:
+        return x * y or float(x) * float(y)
+    elif {kx, ky} == {NUMBER, STRING}:
+        s, n = (x, y) if kx == STRING else (y, x)
+        # jq 1.6 repeats the string `n` times, truncating; below one copy the result is null
+        n = int(n - 1)
+        return None if n < 0 else s * (n + 1)
+    elif kx == ky == OBJECT:
+        return _deep_merge(x, y)
+    raise _type_error(x, y, "cannot be multiplied")
+
+
+def _deep_merge(x, y):
+    r = dict(x)
+    for k, v in y.items():
+        r[k] = _deep_merge(r[k], v) if isinstance(r.get(k), dict) and isinstance(v, dict) else v
+    return r
+
+
+def truediv(x, y):
+    kx, ky = _kind(x), _kind(y)
+    if kx == ky == NUMBER:
+        if y == 0:
+            raise _type_error(x, y, "cannot be divided because the divisor is zero")
+        return x / y
+    elif kx == ky == STRING:
+        return x.split(y) if x else []
+    raise _type_error(x, y, "cannot be divided")
+
+
+def mod(x, y):
+    kx, ky = _kind(x), _kind(y)
+    if kx == ky == NUMBER:
+        # C's `%` on the operands truncated to integers: the sign of the result follows the dividend
+        a, b = int(x), int(y)
+        if b == 0:
+            raise _type_error(x, y, "cannot be divided because the divisor is zero")
+        r = abs(a) % abs(b)
+        return -r if a < 0 else r
+    raise _type_error(x, y, "cannot be divided")
+
+
+def neg(x):
+    if _kind(x) != NUMBER:
+        raise ValueError("{} cannot be negated".format(_KINDS[_kind(x)][1]))
+    return -float(x) if x == 0 else -x      # jq's numbers are doubles, with a signed zero
+
+
+def eq(x, y):
+    if (type(x), type(y)) in _PLAIN:
+        return x == y
+    return compare(x, y) == 0
+
+
+def ne(x, y):
+    if (type(x), type(y)) in _PLAIN:
+        return x != y
+    return compare(x, y) != 0
+
+
+def lt(x, y):
+    if (type(x), type(y)) in _PLAIN:
+        return x < y
+    return compare(x, y) < 0
+
+
+def le(x, y):
+    if (type(x), type(y)) in _PLAIN:
+        return x <= y
+    return compare(x, y) <= 0
+
+
+def gt(x, y):
+    if (type(x), type(y)) in _PLAIN:
+        return x > y
+    return compare(x, y) > 0
+
+
+def ge(x, y):
+    if (type(x), type(y)) in _PLAIN:
+        return x >= y
+    return compare(x, y) >= 0
+
+
+op_mul = op_generic(mul)
+op_add = op_generic(add)
+op_sub = op_generic(sub)
+op_div = op_generic(truediv)
+op_mod = op_generic(mod)
+
+op_eq = op_generic(eq)
+op_ne = op_generic(ne)
+op_le = op_generic(le)
+op_lt = op_generic(lt)
+op_ge = op_generic(ge)
+op_gt = op_generic(gt)
+
+
+def builtin(ident, fun, *argfs):
+    # A call which scope resolution (see `jqi.optimize.resolve`) has bound directly to a builtin
+    ident_name = "{}/{}".format(ident, len(argfs))
+
+    @node("builtin", ident_name, fun, *argfs)
+    def apply(stream):
+        for env, item in stream:
+            yield from fun(env, item, *argfs)
+
+    return apply
 
-op_eq = op_generic(operator.eq)
-op_ne = op_generic(operator.ne)
-op_le = op_generic(operator.le)
-op_lt = op_generic(operator.lt)
-op_ge = op_generic(operator.ge)
-op_gt = op_generic(operator.gt)
+
+def local_call(ident, depth, slot, *argfs):
+    # A call to a function introduced by an enclosing `def`, or to one of its filter parameters
+    ident_name = "{}/{}".format(ident, len(argfs))
+
+    @node("local_call", ident_name, depth, slot, *argfs)
+    def apply(stream):
+        for env, item in stream:
+            yield from env.lookup(depth, slot)(env, item, *argfs)
+
+    return apply
 
 
 def call(ident, *argfs):
     # Work out the arity of the function call
     ident_name = "{}/{}".format(ident, len(argfs))
 
+    @node("call", ident_name, *argfs)
     def apply(stream):
         # Check the order of evaluation here
-        results = []
         # We do this one at a time. The function itself will have to handle the argfs.
         for env, item in stream:
             fun = env[ident_name]
             # Call the function with the items from its stream
-            values = fun(env, item, *argfs)
-            results.extend(values)
-        return results
+            yield from fun(env, item, *argfs)
 
     return apply
 
 
+# An evaluation that may be abandoned part way (see `jqi.worker`) sets this to a `threading.Event`. Iterating
+# over a large container checks it every so often, and raises `Stopped` once it's set.
+stopping = contextvars.ContextVar("stopping", default=None)
+
+
+class Stopped(Exception):
+    pass
+
+
+_RUN = 4096
+
+
+def checked(items):
+    stop = stopping.get()
+    if stop is None or len(items) <= _RUN:
+        return items
+    return _runs(iter(items), stop)
+
+
+def _runs(it, stop):
+    while run := list(islice(it, _RUN)):
+        if stop.is_set():
+            raise Stopped()
+        yield from run
+
+
+@node("iterate")
 def iterate(stream):
-    result = []
     for env, item in stream:
         if isinstance(item, (Number, str, type(None))):
             raise ValueError("can't iterate over {}".format(type(item).__name__))
         elif isinstance(item, list):
-            result.extend((env, i) for i in item)
+            yield from ((env, i) for i in checked(item))
         elif isinstance(item, dict):
-            result.extend((env, i) for i in item.values())
+            yield from ((env, i) for i in checked(item.values()))
         else:
             raise ValueError("can't iterate over {}".format(type(item).__name__))
-    return result
 
 
 def collect(exp):
+    @node("collect", exp)
     def collect(stream):
-        result = []
         for env, item in stream:
             items = exp([(env, item)])
-            result.append((env, [i for (_, i) in items]))
-        return result
+            yield env, [i for (_, i) in items]
     return collect
 
 
 def make_dict(pairs):
+    @node("make_dict", pairs)
     def make_dict(stream):
-        return _make_dicts(stream, pairs)
+        for env, item in stream:
+            yield from _make_dicts(env, item, pairs)
     return make_dict
 
 
-def _make_dicts(stream, pairs):
+def _make_dicts(env, item, pairs):
     if len(pairs) == 0:
-        return [(make_env(), {})]
-    (k, v), *rest = pairs
-    ks = k(stream)
-    vs = v(stream)
-    remainder = _make_dicts(stream, rest)
-    results = []
-    for e1, k in ks:
-        for e2, v in vs:
-            for e3, others in remainder:
+        yield env, {}
+        return
+    (kf, vf), *rest = pairs
+    for e1, k in kf([(env, item)]):
+        for e2, v in vf([(env, item)]):
+            if not isinstance(k, str):
+                raise ValueError("Object keys must be strings")
+            for e3, others in _make_dicts(env, item, rest):
                 r = {str(k): v}
                 r.update(others)
-                results.append((e1, r))
-    return results
+                yield e1, r
 
 
 def negate(exp):
+    @node("negate", exp)
     def negate(stream):
         vs = exp(stream)
-        return [(e, -v) for (e, v) in vs]
+        return ((e, neg(v)) for (e, v) in vs)
     return negate
 
 
-# Updates have to construct new objects. In order to do this, we need to use the special `.path` attribute on
-# an environment and its parents to work out what we're updating.
+class Function:
+    """
+    A function introduced by `def`. Its body is evaluated in the environment of the definition, plus a
+    frame holding the function itself (so it may recurse); and, if it has parameters, a frame of its
+    filter arguments, each a zero-arity function that evaluates in the environment of the caller.
+    """
+    def __init__(self, params, body, env):
+        self.params = params
+        self.body = body
+        self.env = env.push((self,))
+
+    def __call__(self, env, item, *argfs):
+        for _, value in self.body([(self.enter(env, argfs), item)]):
+            yield env, value
+
+    def enter(self, env, argfs):
+        # The environment for the body of a call from `env`
+        return self.env.push(tuple(Closure(argf, env) for argf in argfs)) if self.params else self.env
+
+
+class Closure:
+    def __init__(self, filter, env):
+        self.filter = filter
+        self.env = env
+
+    def __call__(self, env, item):
+        for _, value in self.filter([(self.env, item)]):
+            yield env, value
+
+
+def definition(name, params, body, rest):
+    # `$name` parameters are desugared by the parser; all params here are filters
+    ident_name = "{}/{}".format(name, len(params))
+
+    @node("definition", ident_name, params, body, rest)
+    def definition(stream):
+        for env, item in stream:
+            fun = Function(params, body, env)
+            yield from rest([(fun.env, item)])
+    return definition
+
+
+# Updates have to construct new objects. In order to do this, we use the `path` carried by the environment
+# that accompanies each value on the LHS to work out what we're updating.
 
 def set_path(lhs, rhs):
+    @node("set_path", lhs, rhs)
     def set_path(stream):
-        results = []
         for env, item in stream:
             rvalues = rhs([(env, item)])
             for env2, rvalue in rvalues:
-                # TODO: construct the updated item and return it
                 result = item
                 lvalues = lhs([(env, item)])
                 for env2, lvalue in lvalues:
                     path = env2.get_path()
                     result = deep_update(result, path, rvalue)
-                results.append((env, result))
-        return results
+                yield env, result
     return set_path
 
 
 def deep_update(lhs, path, rhs):
-    while path != []:
-        step = path[0]
+    # Copy each container along the path (sharing everything else with `lhs`), then fill them in from the bottom up
+    containers = []
+    for step in path:
         if step == '.':
-            path = path[1:]
             continue
         elif isinstance(step, (Field, String)):
             step = str(step)
             lhs = dict(lhs) if lhs is not None else {}
-            orig = lhs.get(step)
-            lhs[step] = deep_update(orig, path[1:], rhs)
-            return lhs
+            containers.append((lhs, step))
+            lhs = lhs.get(step)
         else:
             raise NotImplementedError("unrecognised path update")
+
+    for container, step in reversed(containers):
+        container[step] = rhs
+        rhs = container
     return rhs
 
 
+# Paths are immutable cons cells, `(parent, step)`, each sharing the path it extends; so extending a
+# path is O(1), and the list of steps is only built when an update needs it. A step may be a tuple of
+# several steps (see `fields`).
+ROOT = ()
+
+
+def materialise(path):
+    steps = []
+    while path:
+        path, step = path
+        if type(step) is tuple:
+            steps.extend(reversed(step))
+        else:
+            steps.append(step)
+    steps.reverse()
+    return steps
+
+
+class Frame:
+    """
+    The values bound by one `as`, or one `def` or call of a function, in the order scope resolution
+    gave them their slots; `parent` is the frame around it.
+    """
+    __slots__ = ("values", "parent")
+
+    def __init__(self, values, parent):
+        self.values = values
+        self.parent = parent
+
+
 class Environment:
-    def __init__(self, parent=None, bindings=None):
+    """
+    Bindings by name, as supplied from outside a query (builtins, or a caller's own variables); and the
+    chain of frames made by the query's own `as` and `def`, which are found by (depth, slot).
+    """
+    __slots__ = ("_dict", "_parent", "path", "frame")
+
+    def __init__(self, parent=None, bindings=None, path=ROOT, frame=None):
         if bindings is None:
             bindings = {}
         self._dict = bindings
         self._parent = parent
+        self.path = path
+        self.frame = frame
 
     def child(self, bindings=None):
-        return self.__class__(parent=self, bindings=bindings)
+        # Named bindings are flat: a child starts with a copy of its parent's bindings and shares its parent's
+        # parent (normally the builtins). A query's own bindings are frames instead (see `push`).
+        d = dict(self._dict)
+        if bindings:
+            d.update(bindings)
+        return self.__class__(parent=self._parent, bindings=d, path=self.path, frame=self.frame)
+
+    def push(self, values):
+        # The same bindings, inside a new innermost frame
+        env = self.__class__.__new__(self.__class__)
+        env._dict = self._dict
+        env._parent = self._parent
+        env.path = self.path
+        env.frame = Frame(values, self.frame)
+        return env
+
+    def lookup(self, depth, slot):
+        frame = self.frame
+        while depth:
+            frame = frame.parent
+            depth -= 1
+        return frame.values[slot]
+
+    def at(self, path):
+        # The same bindings, accompanying a value found at a different path
+        env = self.__class__.__new__(self.__class__)
+        env._dict = self._dict
+        env._parent = self._parent
+        env.path = path
+        env.frame = self.frame
+        return env
 
     def __getitem__(self, item):
         try:
@@ -297,20 +691,18 @@ class Environment:
         return self.effective_bindings() == other.effective_bindings()
 
     def get_path(self):
-        step = self._dict.get(".path", ".")
-        if step == ".":
-            return [step]
-        else:
-            return self._parent.get_path() + [step]
+        return materialise(self.path)
+
+
+BUILTINS = Environment(bindings=REGISTER)
 
 
 def make_env():
-    bindings = {".path": "."}
-    bindings.update(REGISTER)
-    return Environment(bindings=bindings)
+    return Environment(parent=BUILTINS)
 
 
 def splice(env, items):
+    # The input side is kept materialised: it may be handed to several filters (see `ExpMatch`)
     return [(env, i) for i in items]
 
 
@@ -47,4 +47,4 @@ def empty(env, item):
 @register
 def select(env, item, test):
     vs = test([(env, item)])
-    return [(env, item) for (_, v) in vs if _truth(v)]
+    return ((env, item) for (_, v) in vs if _truth(v))
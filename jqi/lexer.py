@@ -1,4 +1,8 @@
-from parsy import generate, regex, string_from, match_item, Parser, Result, eof, seq, index
+import bisect
+import functools
+import os
+import re
+from parsy import generate, regex, string_from, index, ParseError
 from json import loads
 
 
@@ -85,6 +89,8 @@ class Int(int):
     def make(cls, start_body_end):
         (start, body, end) = start_body_end
         item = cls(body)
+        if not item and body.startswith("-"):
+            item = Float(body)      # jq's numbers are doubles: `-0` is a negative zero, which only a float can be
         item.pos = (start, end)
         return item
 
@@ -117,7 +123,7 @@ LITERAL = (mark(regex(r'-?[0-9]+')).map(Int.make) |
 FORMAT = mark(regex(r'@[a-zA-Z0-9_]+')).map(Format.make)
 JSON_STRING_REGEX= r'(\\(["\\\/bfnrt]|u[a-fA-F0-9]{4})|[^"\\\0-\x1F\x7F]+)*'
 QQString = mark(regex(rf'"{JSON_STRING_REGEX}"')).map(String.make)
-token = mark(string_from(
+TOKENS = (
     "!=",
     "==",
     "as",
@@ -137,24 +143,16 @@ token = mark(string_from(
     "__loc__",
     "|=", "+=", "-=", "*=", "/=", "%=", "//=", "<=", ">=", "..", "?//",
     ".", "?", "=", ";", ",", ":", "|", "+", "-", "*", "/", "%", "$", "<", ">",
-)).map(Token.make)
+)
+token = mark(string_from(*TOKENS)).map(Token.make)
 
 
-def _bracket(open, close):
-    @generate
-    def _():
-        yield match_item(open)
-        lexes = yield lexer
-        closer = yield match_item(close) | eof
-        if closer is None:
-            return Token(open), *lexes
-        return Token(open), *lexes, Token(close)
-    return _
-
+bracket = mark(string_from("[", "]", "{", "}", "(", ")")).map(Token.make)
+_OPENERS = {"[": "]", "{": "}", "(": ")"}
 
-bracket = _bracket("[", "]")
-brace = _bracket("{", "}")
-paren = _bracket("(", ")")
+# Whitespace and comments lex as WS, which is then dropped
+_token = ws | comment | FIELD | LITERAL | FORMAT | QQString | token | IDENT | bracket
+_partial = mark(regex(rf'"{JSON_STRING_REGEX}')).map(PartialString.make)
 
 
 class Cursor:
@@ -163,51 +161,240 @@ class Cursor:
 
     CURSOR = CursorToken("#CURSOR#")
 
-    def __init__(self, offset=None):
-        self.offset = offset
-        self.cursor_reported = False
 
-    @property
-    def check_cursor(self):
-        @Parser
-        def check_cursor(stream, index):
-            if self.offset is not None and index >= self.offset and not self.cursor_reported:
-                self.cursor_reported = True
-                return Result.success(len(stream), Cursor.CURSOR)
-            return Result.failure(index, "cursor")
-        return check_cursor
+def _scan_parsy(s, index=0, offset=None):
+    """
+    Generate the tokens of `s` from `index` onwards.
+
+    With an `offset`, stop at the first token boundary at or after it with a `Cursor.CURSOR`;
+    a string left open at that point is reported as a `PartialString`.
+    """
+    while True:
+        if offset is not None and index >= offset:
+            yield Cursor.CURSOR
+            return
+        if index >= len(s):
+            return
+        result = _token(s, index)
+        if not result.status:
+            if offset is not None:
+                partial = _partial(s, index)
+                if partial.status and partial.index >= offset:
+                    yield partial.value
+                    yield Cursor.CURSOR
+                    return
+            raise ParseError(result.expected, s, result.furthest)
+        if not isinstance(result.value, WS):
+            yield result.value
+        index = result.index
+
+
+# The same lexical grammar as a single regular expression. Python tries alternatives in order,
+# as parsy does; like `string_from`, the operators are ordered longest first.
+_MASTER = re.compile("|".join("(?P<{}>{})".format(name, pattern) for name, pattern in [
+    ("WS", r'[ \t\n]+|#[^\r\n]*'),
+    ("FIELD", r'\.[a-zA-Z_][a-zA-Z_0-9]*'),
+    ("INT", r'-?[0-9]+'),
+    ("FLOAT", r'-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?'),
+    ("FORMAT", r'@[a-zA-Z0-9_]+'),
+    ("STRING", rf'"{JSON_STRING_REGEX}"'),
+    ("TOKEN", "|".join(re.escape(t) for t in sorted(TOKENS, key=len, reverse=True))),
+    ("IDENT", r'([a-zA-Z_][a-zA-Z_0-9]*::)*[a-zA-Z_][a-zA-Z_0-9]*'),
+    ("BRACKET", r'[\[\]{}()]'),
+]))
+_PARTIAL = re.compile(rf'"{JSON_STRING_REGEX}')
+_MAKERS = {
+    "FIELD": Field.make,
+    "INT": Int.make,
+    "FLOAT": Float.make,
+    "FORMAT": Format.make,
+    "STRING": String.make,
+    "TOKEN": Token.make,
+    "IDENT": Ident.make,
+    "BRACKET": Token.make,
+}
+
+
+def _scan_regex(s, index=0, offset=None):
+    """
+    As `_scan_parsy`, in a single pass of `_MASTER` over the text.
+    """
+    match = _MASTER.match
+    end = len(s)
+    while True:
+        if offset is not None and index >= offset:
+            yield Cursor.CURSOR
+            return
+        if index >= end:
+            return
+        m = match(s, index)
+        if m is None:
+            if offset is not None:
+                partial = _PARTIAL.match(s, index)
+                if partial is not None and partial.end() >= offset:
+                    yield PartialString.make((index, partial.group(), partial.end()))
+                    yield Cursor.CURSOR
+                    return
+            raise ParseError(frozenset(["token"]), s, index)
+        kind = m.lastgroup
+        if kind != "WS":
+            yield _MAKERS[kind]((index, m.group(), m.end()))
+        index = m.end()
+
+
+# JQI_LEXER=parsy selects the combinator lexer
+_scan = {"parsy": _scan_parsy, "regex": _scan_regex}[os.environ.get("JQI_LEXER", "regex")]
+
+
+def _balance(s, tokens):
+    # Brackets may be left open at the end of the input, but not closed out of turn
+    opened = []
+    for t in tokens:
+        if type(t) is Token and str(t) in ")]}":
+            if not opened or _OPENERS[opened.pop()] != str(t):
+                raise ParseError(frozenset([_OPENERS[opened[-1]] if opened else "EOF"]), s, t.pos[0])
+        elif type(t) is Token and str(t) in _OPENERS:
+            opened.append(str(t))
+    return tokens
+
+
+def _start(t):
+    # Field positions leave out the leading '.'
+    return t.pos[0] - 1 if isinstance(t, Field) else t.pos[0]
+
+
+def _shift(t, delta):
+    if delta == 0:
+        return t
+    item = type(t)(t)
+    item.pos = (t.pos[0] + delta, t.pos[1] + delta)
+    return item
+
+
+def edit_range(old, new):
+    """
+    Returns `(start, old_end, new_end)`, such that `new` is `old` with `old[start:old_end]`
+    replaced by `new[start:new_end]`.
+    """
+    limit = min(len(old), len(new))
+    start = 0
+    while start < limit and old[start] == new[start]:
+        start += 1
+    end = 0
+    while end < limit - start and old[-1 - end] == new[-1 - end]:
+        end += 1
+    return start, len(old) - end, len(new) - end
+
+
+def relex(old, tokens, new, edit=None):
+    """
+    Lex `new`, given the `tokens` of `old`. Only the text around the edit is scanned: once the scan
+    reaches a token boundary past the edit which was also a boundary before it, the remaining tokens
+    are reused at their new positions.
+
+    `edit` is as returned by `edit_range`, which works it out if it's not given.
+    """
+    start, old_end, new_end = edit_range(old, new) if edit is None else edit
+    delta = new_end - old_end
+
+    # Rescan from the token touching the edit - or the one before that, since an operator may
+    # run on into the next (`?` `/` then `?//`)
+    ends = [t.pos[1] for t in tokens]
+    first = max(bisect.bisect_left(ends, start) - 1, 0)
+    starts = [_start(t) for t in tokens]
+    index = ends[first - 1] if first > 0 else 0
+
+    result = list(tokens[:first])
+    for t in _scan(new, index):
+        position = _start(t)
+        if position >= new_end:
+            i = bisect.bisect_left(starts, position - delta, first)
+            if i < len(starts) and starts[i] == position - delta:
+                result.extend(_shift(t, delta) for t in tokens[i:])
+                break
+        result.append(t)
+    return _balance(new, result)
+
+
+def typed_edit(old, old_cursor, new, new_cursor):
+    """
+    The edit, as `edit_range` would give it, made by typing or deleting at the cursor: that is, by
+    going from `old` with the cursor at `old_cursor` to `new` with it at `new_cursor`. Returns None if
+    the change wasn't one of those.
+    """
+    delta = len(new) - len(old)
+    if delta > 0 and new_cursor == old_cursor + delta:
+        start, old_end, new_end = old_cursor, old_cursor, new_cursor        # inserted before the cursor
+    elif delta < 0 and new_cursor == old_cursor + delta:
+        start, old_end, new_end = new_cursor, old_cursor, new_cursor        # deleted before the cursor
+    elif delta < 0 and new_cursor == old_cursor:
+        start, old_end, new_end = old_cursor, old_cursor - delta, new_cursor    # deleted after it
+    else:
+        return None
+    # Check, but without comparing a character at a time
+    if old[:start] != new[:start] or old[old_end:] != new[new_end:]:
+        return None
+    return start, old_end, new_end
+
+
+class Relexer:
+    """
+    Lexes successive versions of a text, rescanning only what changed since the last.
+
+    The caller may say what changed, with `edited`; otherwise it's worked out by comparing the texts.
+    """
+    def __init__(self):
+        self.last = ("", ())
+        self._edit = None
+
+    def edited(self, old, new, edit):
+        # `edit` is as returned by `edit_range`, for the change from `old` to `new`
+        self._edit = old, new, edit
+
+    def __call__(self, s):
+        old, tokens = self.last
+        edit = None
+        if self._edit is not None and self._edit[:2] == (old, s):
+            edit = self._edit[2]
+        tokens = tuple(relex(old, tokens, s, edit))
+        self.last = s, tokens
+        return tokens
+
+    def lex(self, s, offset=None):
+        """
+        As `lex`.
+        """
+        return list(_cursor(self, s, offset))
+
 
+def lex(s, offset=None):
+    """
+    Split `s` into tokens, leaving out whitespace and comments. With an `offset`, the tokens end at
+    the cursor (see `_scan`).
+    """
+    # Token lists are cached by (text, cursor offset); hand out a copy
+    return list(_lex(s, offset))
 
-def flatten(xs):
-    if isinstance(xs, list) or isinstance(xs, tuple):
-        result = []
-        for x in xs:
-            result.extend(flatten(x))
-        return result
-    return [xs]
 
+def _lex_all(s):
+    return tuple(_balance(s, list(_scan(s))))
 
-_lexer = ((ws | comment | FIELD | LITERAL | FORMAT | QQString | token | IDENT | bracket | brace | paren)
-          .many()
-          .map(flatten)
-          .map(lambda l: [i for i in l if not isinstance(i, WS)]))
 
-lexer = _lexer
+@functools.lru_cache(maxsize=256)
+def _lex(s, offset):
+    return _cursor(_lex_all, s, offset)
 
 
-def lex(s, offset=None):
-    # For the moment: not re-entrant!
-    global lexer
-    if offset is not None:
-        cursor = Cursor(offset)
-        Q_String = seq(mark(regex(rf'"{JSON_STRING_REGEX}')).map(PartialString.make),
-                       cursor.check_cursor)
-
-        lexer = ((cursor.check_cursor |
-                  ws | comment | FIELD | LITERAL | FORMAT | QQString | Q_String | token | IDENT | bracket | brace | paren)
-                 .many()
-                 .map(flatten)
-                 .map(lambda l: [i for i in l if not isinstance(i, WS)]))
-    else:
-        lexer = _lexer
-    return lexer.parse(s)
+def _cursor(lex_all, s, offset):
+    if offset is None:
+        return lex_all(s)
+    try:
+        tokens = lex_all(s)
+    except ParseError:
+        # The text past the cursor is often unfinished
+        return tuple(_balance(s, list(_scan(s, offset=offset))))
+    return (*(t for t in tokens if _start(t) < offset), Cursor.CURSOR)
+
+
+lex.cache_info = _lex.cache_info
+lex.cache_clear = _lex.cache_clear
@@ -0,0 +1,343 @@
+"""
+Simplification of filter trees.
+
+Each evaluator built by `jqi.eval` records how it was constructed in its `node` attribute; together
+these form the plan for a query. `optimize` rewrites that plan before evaluation:
+
+- arithmetic, comparisons and negation of literals are folded;
+- identity steps (`. | x`, `x | .`) are removed;
+- consecutive field accesses (`.a.b`, `.a | .b`) are fused into a single `fields` step;
+- a variable bound to a literal (`"x" as $v | ...`) is replaced by that literal.
+
+Environments are not part of the plan: a rewritten filter produces the same values, but its output
+environments may lack bindings that have been inlined away.
+
+`resolve` runs at parse time. Each `$var` and function a query binds for itself (with `as`, or `def` and
+its parameters) is given a frame and a slot in it; each reference to one becomes a (depth, slot) pair,
+counting frames outwards from the reference, so nothing is looked up by name as the query runs. Calls
+to builtins that no `def` shadows are bound to the builtin itself. Only names the query doesn't bind
+(such as variables a caller supplies) are left to be looked up in the environment.
+
+`explain` renders a plan as an indented tree.
+"""
+
+from .eval import *
+from .function import REGISTER
+from .pattern import ValueMatch, ArrayMatch, ObjectMatch, KeyMatch, ExpMatch
+
+
+def optimize(f):
+    # Rewriting may take away frames (an inlined binding, say): slots are given out again afterwards
+    return resolve(_optimize(f))
+
+
+def _optimize(f):
+    node = getattr(f, "node", None)
+    if node is None:
+        return f
+    op, *args = node
+
+    if op == "pipe":
+        return _pipeline([s for stage in _stages(f) for s in _stages(_optimize(stage))])
+    elif op == "op":
+        oper, x, y = args
+        x, y = _optimize(x), _optimize(y)
+        if _is_literal(x) and _is_literal(y):
+            try:
+                return literal(oper(_value(x), _value(y)))
+            except Exception:
+                pass
+        return op_generic(oper)(x, y)
+    elif op == "negate":
+        x = _optimize(args[0])
+        if _is_literal(x):
+            try:
+                return literal(neg(_value(x)))
+            except Exception:
+                pass
+        return negate(x)
+    elif op == "binding":
+        term, pattern, exp, names = args
+        term, exp = _optimize(term), _optimize(exp)
+        if _is_literal(term) and isinstance(pattern, ValueMatch):
+            inlined = _substitute(exp, pattern.target, term)
+            if inlined is not None:
+                return _optimize(inlined)
+        return binding(term, pattern, exp, names)
+    return _rebuild(f, _optimize)
+
+
+def resolve(f, scope=None):
+    """
+    `scope` is the chain of frames in force, innermost first: `(names, parent)` cons cells, each holding
+    the names bound in one frame, in slot order. A filter that's already been resolved is resolved
+    afresh, from the names it refers to.
+    """
+    node = getattr(f, "node", None)
+    if node is None:
+        return f
+    op, *args = node
+
+    if op in ("variable", "local"):
+        found = _find(scope, args[0])
+        return variable(args[0][1:]) if found is None else local(args[0][1:], *found)
+    elif op in ("call", "local_call"):
+        ident_name, argfs = args[0], args[1:] if op == "call" else args[3:]
+        argfs = [resolve(a, scope) for a in argfs]
+        found = _find(scope, ident_name)
+        if found is not None:
+            return local_call(_ident(ident_name), *found, *argfs)
+        elif ident_name in REGISTER:
+            return builtin(_ident(ident_name), REGISTER[ident_name], *argfs)
+        return call(_ident(ident_name), *argfs)
+    elif op == "binding":
+        term, pattern, exp, _ = args
+        names = _pattern_names(pattern)
+        return binding(resolve(term, scope), _resolve_pattern(pattern, scope), resolve(exp, (names, scope)), names)
+    elif op == "definition":
+        # The function has a frame of its own, which its body and the rest of the query both see; a call
+        # adds a frame of the arguments, if there are any (see `jqi.eval.Function`)
+        ident_name, params, body, rest = args
+        outer = ((ident_name,), scope)
+        inner = (tuple("{}/0".format(p) for p in params), outer) if params else outer
+        return definition(_ident(ident_name), params, resolve(body, inner), resolve(rest, outer))
+    return _rebuild(f, lambda x: resolve(x, scope))
+
+
+def _find(scope, name):
+    # The (depth, slot) of `name`, or None if it isn't bound in `scope`. A name given twice in the same
+    # frame (`def f(g; g)`) is its last.
+    depth = 0
+    while scope is not None:
+        names, scope = scope
+        if name in names:
+            return depth, len(names) - 1 - names[::-1].index(name)
+        depth += 1
+    return None
+
+
+def _pattern_names(pattern):
+    # The variables a pattern binds, in order of first appearance
+    if isinstance(pattern, ValueMatch):
+        return (pattern.target,)
+    names = []
+    for p in pattern.targets if isinstance(pattern, (ArrayMatch, ObjectMatch)) else [pattern.matcher]:
+        names.extend(n for n in _pattern_names(p) if n not in names)
+    return tuple(names)
+
+
+def _resolve_pattern(pattern, scope):
+    # Key expressions (`{(exp): $v}`) are evaluated in the scope around the pattern
+    if isinstance(pattern, ExpMatch):
+        return ExpMatch(resolve(pattern.exp, scope), _resolve_pattern(pattern.matcher, scope))
+    elif isinstance(pattern, KeyMatch):
+        return KeyMatch(pattern.key, _resolve_pattern(pattern.matcher, scope))
+    elif isinstance(pattern, (ArrayMatch, ObjectMatch)):
+        return type(pattern)(*(_resolve_pattern(p, scope) for p in pattern.targets))
+    return pattern
+
+
+def explain(f, indent=0):
+    node = getattr(f, "node", None)
+    prefix = "  " * indent
+    if node is None:
+        return "{}native {}".format(prefix, getattr(f, "__name__", type(f).__name__))
+
+    op, *args = node
+    if op == "pipe":
+        # Show a pipeline as a flat sequence of stages
+        labels, children = [], _stages(f)
+    elif op in ("field", "fields"):
+        labels, children = [".{}".format(a) for a in args], []
+    elif op == "literal":
+        labels, children = [repr(args[0])], []
+    elif op == "variable":
+        labels, children = [args[0]], []
+    elif op == "local":
+        labels, children = [args[0], "{}:{}".format(*args[1:])], []
+    elif op == "op":
+        labels, children = [args[0].__name__], args[1:]
+    elif op == "call":
+        labels, children = [args[0]], args[1:]
+    elif op == "local_call":
+        labels, children = [args[0], "{}:{}".format(*args[1:3])], args[3:]
+    elif op == "builtin":
+        labels, children = [args[0]], args[2:]
+    elif op == "definition":
+        labels, children = [args[0], "({})".format("; ".join(args[1]))], args[2:]
+    elif op == "binding":
+        labels, children = ["as", _show_pattern(args[1])], [args[0], args[2]]
+    elif op == "complete":
+        labels, children = [args[0].__name__], [a for a in args[1:] if callable(a)]
+    elif op == "make_dict":
+        labels, children = [], [x for pair in args[0] for x in pair]
+    else:
+        labels, children = [], args
+
+    lines = ["{}{}".format(prefix, " ".join([op, *labels]))]
+    lines.extend(explain(child, indent + 1) for child in children)
+    return "\n".join(lines)
+
+
+def _show_pattern(pattern):
+    if isinstance(pattern, ValueMatch):
+        return pattern.target
+    elif isinstance(pattern, ArrayMatch):
+        return "[{}]".format(", ".join(_show_pattern(p) for p in pattern.targets))
+    elif isinstance(pattern, ObjectMatch):
+        return "{{{}}}".format(", ".join(_show_pattern(p) for p in pattern.targets))
+    elif isinstance(pattern, KeyMatch):
+        return "{}: {}".format(pattern.key, _show_pattern(pattern.matcher))
+    return "(...): {}".format(_show_pattern(pattern.matcher))
+
+
+def _stages(f):
+    stages, todo = [], [f]
+    while todo:
+        f = todo.pop()
+        node = getattr(f, "node", None)
+        if node is not None and node[0] == "pipe":
+            todo.extend(reversed(node[1:]))
+        else:
+            stages.append(f)
+    return stages
+
+
+def _pipeline(stages):
+    fused = []
+    for stage in stages:
+        node = getattr(stage, "node", None)
+        if node is not None and node[0] == "dot":
+            continue
+        if node is not None and node[0] in ("field", "fields") and fused:
+            previous = fused[-1].node
+            if previous[0] in ("field", "fields"):
+                fused[-1] = fields(*previous[1:], *node[1:])
+                continue
+        fused.append(stage)
+
+    if not fused:
+        return dot
+    result = fused.pop()
+    while fused:
+        result = pipe(fused.pop(), result)
+    return result
+
+
+def _is_literal(f):
+    node = getattr(f, "node", None)
+    return node is not None and node[0] == "literal"
+
+
+def _value(f):
+    return f.node[1]
+
+
+def _rebuild(f, transform):
+    """
+    Reconstruct `f` from its recorded arguments, applying `transform` to each nested filter.
+    Returns None if `transform` does.
+    """
+    op, *args = f.node
+    if op in ("dot", "iterate", "field", "fields", "literal", "variable", "local"):
+        return f
+
+    def t(x):
+        result = transform(x)
+        if result is None:
+            raise _Abandon()
+        return result
+
+    try:
+        if op == "pipe":
+            return pipe(t(args[0]), t(args[1]))
+        elif op == "comma":
+            return comma(t(args[0]), t(args[1]))
+        elif op == "op":
+            return op_generic(args[0])(t(args[1]), t(args[2]))
+        elif op == "negate":
+            return negate(t(args[0]))
+        elif op == "log_and":
+            return log_and(t(args[0]), t(args[1]))
+        elif op == "log_or":
+            return log_or(t(args[0]), t(args[1]))
+        elif op == "collect":
+            return collect(t(args[0]))
+        elif op == "make_dict":
+            return make_dict([(t(k), t(v)) for (k, v) in args[0]])
+        elif op == "set_path":
+            return set_path(t(args[0]), t(args[1]))
+        elif op == "binding":
+            term, pattern, exp, names = args
+            return binding(t(term), pattern, t(exp), names)
+        elif op == "call":
+            ident_name, *argfs = args
+            return call(_ident(ident_name), *(t(a) for a in argfs))
+        elif op == "local_call":
+            ident_name, depth, slot, *argfs = args
+            return local_call(_ident(ident_name), depth, slot, *(t(a) for a in argfs))
+        elif op == "builtin":
+            ident_name, fun, *argfs = args
+            return builtin(_ident(ident_name), fun, *(t(a) for a in argfs))
+        elif op == "definition":
+            ident_name, params, body, rest = args
+            return definition(_ident(ident_name), params, t(body), t(rest))
+        elif op == "complete":
+            # A completion hook (see `jqi.completer`), remade around the transformed filter
+            make, *hook_args = args
+            return make(*(t(a) if callable(a) else a for a in hook_args))
+    except _Abandon:
+        return None
+    raise NotImplementedError("can't rebuild {}".format(op))
+
+
+class _Abandon(Exception):
+    pass
+
+
+def _ident(ident_name):
+    # "name/arity" -> "name"
+    return ident_name.rsplit("/", 1)[0]
+
+
+def _substitute(f, target, replacement):
+    """
+    Replace references to the variable `target` in `f`. Returns None if that can't be done safely.
+    """
+    node = getattr(f, "node", None)
+    if node is None:
+        return None     # We can't see inside it
+    op, *args = node
+    if op in ("variable", "local"):
+        return replacement if args[0] == target else f
+    if op == "binding":
+        term, pattern, exp, names = args
+        bound = _bound_names(pattern)
+        if bound is None:
+            return None
+        term = _substitute(term, target, replacement)
+        if term is None:
+            return None
+        if target not in bound:
+            exp = _substitute(exp, target, replacement)
+            if exp is None:
+                return None
+        return binding(term, pattern, exp, names)
+    return _rebuild(f, lambda x: _substitute(x, target, replacement))
+
+
+def _bound_names(pattern):
+    if isinstance(pattern, ValueMatch):
+        return {pattern.target}
+    elif isinstance(pattern, (ArrayMatch, ObjectMatch)):
+        names = set()
+        for p in pattern.targets:
+            bound = _bound_names(p)
+            if bound is None:
+                return None
+            names |= bound
+        return names
+    elif isinstance(pattern, KeyMatch):
+        return _bound_names(pattern.matcher)
+    # ExpMatch evaluates an expression we'd also need to rewrite
+    return None
@@ -1,55 +1,22 @@
 """
 A subset of the jq grammar
 """
+import functools
 from numbers import Number
-from parsy import generate, match_item, test_item, seq, peek, ParseError, Parser, Result, index, fail
+from parsy import match_item, test_item, ParseError, Parser, Result
 from .lexer import lex, Token, Ident, Field, String, Cursor, PartialString
 from .eval import *
 from .completer import *
 from .pattern import *
+from .optimize import resolve
 
 """
-Combiners to produce left-associative, right-associative and non-associative precedence-aware parsers.
-"""
-
-
-def chainl(item, op):
-    @generate
-    def _():
-        sum = yield item
-        while True:
-            next = yield (seq(op, item)).optional()
-            if next is None:
-                break
-            (combiner, other) = next
-            sum = combiner(sum, other)
-
-        return sum
-    return _
+The parser reads the token list once, left to right. Each construct is chosen by looking at the next
+token or two, and binary operators are handled by precedence climbing; nothing is parsed twice.
 
-
-def chainr(item, op):
-    @generate
-    def _():
-        sum = yield item
-        rhs = yield (seq(op, _)).optional()
-        if rhs is not None:
-            (combiner, other) = rhs
-            sum = combiner(sum, other)
-        return sum
-    return _
-
-
-def nonassoc(item1, op, item2):
-    @generate
-    def _():
-        sum = yield item1
-        rhs = yield (seq(op, item2)).optional()
-        if rhs is not None:
-            (combiner, other) = rhs
-            sum = combiner(sum, other)
-        return sum
-    return _
+`term`, `exp`, `pattern` and `top_level` are parsy parsers over the token list, so that a parse can be
+started at any of them.
+"""
 
 
 def token(t):
@@ -65,112 +32,355 @@ p_literal = match_type(Number, "Literal")
 p_ident = match_type(Ident, "Identifier")
 
 
-completion_point = peek(match_type(Cursor.CursorToken))
-
+_LEFT, _RIGHT, _NONASSOC = "left", "right", "nonassoc"
+
+# Binary operators: binding power (higher binds tighter), associativity and combiner.
+# A combiner of None marks an operator we don't support yet.
+_BINARY = {
+    "|": (1, _RIGHT, pipe),
+    ",": (2, _LEFT, comma),
+    "//": (3, _RIGHT, None),
+    "=": (4, _NONASSOC, set_path),
+    "|=": (4, _NONASSOC, None),
+    "+=": (4, _NONASSOC, None),
+    "-=": (4, _NONASSOC, None),
+    "*=": (4, _NONASSOC, None),
+    "/=": (4, _NONASSOC, None),
+    "//=": (4, _NONASSOC, None),
+    "or": (5, _LEFT, log_or),
+    "and": (6, _LEFT, log_and),
+    "==": (7, _NONASSOC, op_eq),
+    "!=": (7, _NONASSOC, op_ne),
+    "<": (7, _NONASSOC, op_lt),
+    ">": (7, _NONASSOC, op_gt),
+    "<=": (7, _NONASSOC, op_le),
+    ">=": (7, _NONASSOC, op_ge),
+    "+": (8, _LEFT, op_add),
+    "-": (8, _LEFT, op_sub),
+    "*": (9, _LEFT, op_mul),
+    "/": (9, _LEFT, op_div),
+    "%": (9, _LEFT, op_mod),
+}
+
+
+class _Fail(Exception):
+    def __init__(self, index, expected):
+        super().__init__(expected)
+        self.index = index
+        self.expected = expected
+
+
+class _Parser:
+    def __init__(self, tokens, index=0):
+        self.tokens = tokens
+        self.index = index
+
+    def peek(self, ahead=0):
+        i = self.index + ahead
+        return self.tokens[i] if i < len(self.tokens) else None
+
+    def at(self, t, ahead=0):
+        item = self.peek(ahead)
+        return type(item) is Token and str(item) == t
+
+    def at_cursor(self, ahead=0):
+        return type(self.peek(ahead)) is Cursor.CursorToken
+
+    def next(self):
+        item = self.tokens[self.index]
+        self.index += 1
+        return item
+
+    def fail(self, expected):
+        raise _Fail(self.index, expected)
+
+    def expect(self, t):
+        if not self.at(t):
+            self.fail(t)
+        return self.next()
+
+    def expect_type(self, t, description):
+        if not isinstance(self.peek(), t):
+            self.fail(description)
+        return self.next()
+
+    def exp(self):
+        if self.at("def"):
+            name, params, body = self.funcdef()
+            return definition(name, params, body, self.exp())
+
+        if self.at("-"):
+            return self.binary(0)
+        t = self.term()
+        if self.at("as"):
+            self.next()
+            p = self.pattern()
+            self.expect("|")
+            return binding(t, p, self.exp())
+        return self.binary(0, t)
+
+    def binary(self, min_bp, left=None):
+        if left is None:
+            left = self.unary()
+        while True:
+            t = self.peek()
+            if type(t) is not Token or str(t) not in _BINARY:
+                return left
+            bp, assoc, combine = _BINARY[str(t)]
+            if bp < min_bp:
+                return left
+            self.next()
+            if combine is None:
+                raise NotImplementedError(t)
+
+            if t == "==" and self.at_cursor():
+                left = complete_comparison(left)
+            elif assoc is _RIGHT:
+                # Gather the whole chain before folding it, so long pipelines don't recurse
+                operands = [left, self.binary(bp + 1)]
+                while self.at(t):
+                    self.next()
+                    operands.append(self.binary(bp + 1))
+                left = operands.pop()
+                while operands:
+                    left = combine(operands.pop(), left)
+            else:
+                left = combine(left, self.binary(bp + 1))
+                if assoc is _NONASSOC:
+                    after = self.peek()
+                    if type(after) is Token and _BINARY.get(str(after), (None,))[0] == bp:
+                        self.fail("no {} after {}".format(after, t))
+
+    def unary(self):
+        if self.at("-"):
+            self.next()
+            return negate(self.term())
+        return self.term()
+
+    def term(self):
+        t = self.peek()
+        if isinstance(t, String):                                       # String
+            self.next()
+            e = literal(t)
+        elif self.at("."):
+            self.next()
+            if isinstance(self.peek(), String):                         # . String
+                e = field(self.next())
+            elif isinstance(self.peek(), PartialString) and self.at_cursor(1):
+                e = field(self.next())
+            else:                                                       # .
+                e = dot
+        elif isinstance(t, Field):                                      # FIELD
+            e = field(self.next())
+        elif isinstance(t, Number):                                     # LITERAL
+            e = literal(self.next())
+        elif self.at("("):                                              # ( Exp )
+            self.next()
+            e = self.exp()
+            if not self.at_cursor():
+                self.expect(")")
+        elif isinstance(t, Ident):
+            self.next()
+            if self.at("("):                                            # IDENT ( Args )
+                self.next()
+                args = [self.exp()]
+                while self.at(";"):
+                    self.next()
+                    args.append(self.exp())
+                self.expect(")")
+                e = call(t, *args)
+            else:                                                       # IDENT
+                e = call(t)
+        elif self.at("["):
+            self.next()
+            if self.at("]"):                                            # [ ]
+                self.next()
+                e = literal([])
+            else:                                                       # [ Exp ]
+                e = collect(self.exp())
+                self.expect("]")
+        elif self.at("$"):                                              # $ IDENT
+            self.next()
+            e = variable(self.expect_type(Ident, "Identifier"))
+        elif self.at("{"):                                              # { MkDict }
+            self.next()
+            e = self.mk_dict()
+            self.expect("}")
+        else:
+            self.fail("term")
 
-def at(seek):
+        while True:
+            prev = self.tokens[self.index - 1]
+
+            # Completion support. We have to inject this explicitly into the grammar
+            if self.at_cursor():
+                return complete_term(prev, e)
+
+            if isinstance(self.peek(), Field):                          # Term FIELD
+                f = self.next()
+                # Complete '.a.b'
+                if self.at_cursor():
+                    return complete_field(f, e)
+                e = extend_fields(e, f)
+            elif self.at("."):                                          # Term . String
+                d = self.next()
+                # Complete '.a.'
+                if self.at_cursor():
+                    return complete_field(Field.make((d.start, ".", d.end)), e)     # Synthesise a position
+                # Complete ' ."a '
+                if isinstance(self.peek(), PartialString) and self.at_cursor(1):
+                    return complete_field(self.next(), e)
+                e = extend_fields(e, self.expect_type(String, "String"))
+            elif self.at("[") and self.at("]", 1):                      # Term [ ]
+                self.index += 2
+                e = pipe(e, iterate)
+            else:
+                return e
+
+    def expd(self):
+        e = self.expd_item()
+        while self.at("|"):
+            self.next()
+            e = pipe(e, self.expd_item())
+        return e
+
+    def expd_item(self):
+        if self.at("-"):
+            self.next()
+            return negate(self.expd())
+        return self.term()
+
+    def mk_dict(self):
+        pairs = []
+        pair = self.mk_dict_pair()
+        while pair is not None:
+            pairs.append(pair)
+            if not self.at(","):
+                break
+            self.next()
+            pair = self.mk_dict_pair()
+            if pair is None:
+                self.fail("object key")
+        return make_dict(pairs)
+
+    def mk_dict_pair(self):
+        t = self.peek()
+        if isinstance(t, (Ident, String)) or (type(t) is Token and t.isalpha()):
+            self.next()
+            key = literal(str(t))
+            if self.at(":"):                                            # IDENT | Keyword | String : ExpD
+                self.next()
+                return key, self.expd()
+            if type(t) is Token:
+                self.fail(":")
+            return key, field(String(str(t)))                          # IDENT | String: shorthand for `IDENT: .IDENT`
+        elif self.at("$"):                                              # $ IDENT
+            self.next()
+            i = self.expect_type(Ident, "Identifier")
+            return literal(str(i)), variable(i)
+        elif self.at("("):                                              # ( Exp ) : ExpD
+            self.next()
+            k = self.exp()
+            self.expect(")")
+            self.expect(":")
+            return k, self.expd()
+        return None
+
+    def funcdef(self):
+        self.expect("def")
+        name = self.expect_type(Ident, "Identifier")
+        params = []
+        if self.at("("):
+            self.next()
+            params.append(self.param())
+            while self.at(";"):
+                self.next()
+                params.append(self.param())
+            self.expect(")")
+        self.expect(":")
+        body = self.exp()
+        self.expect(";")
+
+        # def f($a): body        is shorthand for        def f(a): a as $a | body
+        for p in reversed(params):
+            if p.startswith("$"):
+                body = binding(call(p[1:]), ValueMatch(p[1:]), body)
+        return name, [p.lstrip("$") for p in params], body
+
+    def param(self):
+        if self.at("$"):
+            self.next()
+            return "$" + self.expect_type(Ident, "Identifier")
+        return str(self.expect_type(Ident, "Identifier"))
+
+    def pattern(self):
+        if self.at("$"):
+            self.next()
+            return ValueMatch(self.expect_type(Ident, "Identifier"))
+
+        if self.at("["):
+            self.next()
+            patterns = [self.pattern()]
+            while self.at(","):
+                self.next()
+                patterns.append(self.pattern())
+            self.expect("]")
+            return ArrayMatch(*patterns)
+
+        if self.at("{"):
+            self.next()
+            patterns = [self.object_pattern()]
+            while self.at(","):
+                self.next()
+                patterns.append(self.object_pattern())
+            self.expect("}")
+            return ObjectMatch(*patterns)
+
+        self.fail("pattern")
+
+    def object_pattern(self):
+        if self.at("$"):
+            # Just as {foo} is a handy way of writing {foo: .foo}, so {$foo} is a handy way of writing {foo:$foo}
+            self.next()
+            i = self.expect_type(Ident, "Identifier")
+            return KeyMatch(i, ValueMatch(i))
+        elif isinstance(self.peek(), (Ident, String)):
+            key = self.next()
+            self.expect(":")
+            return KeyMatch(key, self.pattern())
+        elif self.at("("):
+            self.next()
+            e = self.exp()
+            self.expect(")")
+            self.expect(":")
+            return ExpMatch(e, self.pattern())
+        self.fail("object pattern")
+
+    def top_level(self):
+        e = self.exp()
+        if self.at_cursor():
+            self.next()
+        return e
+
+
+def extend_fields(t, f):
+    # Fuse `Term FIELD` into a single path access where possible
+    node = getattr(t, "node", None)
+    if node is not None and node[0] in ("field", "fields"):
+        return fields(*node[1:], f)
+    return pipe(t, field(f))
+
+
+def _entry(method):
     @Parser
-    def at(stream, index):
-        return Result.success(index, stream[seek])
-    return at
-
-
-@generate("expd")
-def expd():
-    e = yield (token("-") >> expd).map(negate) | term
-    while True:
-        e2 = yield (token("|") >> ((token("-") >> expd).map(negate) | term)).optional()
-        if e2 is None:
-            return e
-        e = pipe(e, e2)
-
-
-@generate("keyword")
-def keyword():
-    t = yield match_type(Token)
-    if not t.isalpha():
-        yield fail("keyword")
-    return t
-
-
-@generate("mk_dict")
-def mk_dict():
-    pairs = yield (
-        seq(match_type(Ident).map(str).map(literal) << token(":"), expd) |       # IDENT : ExpD
-        seq(keyword.map(str).map(literal) << token(":"), expd) |                 # Keyword : Expd
-        seq(match_type(String).map(str).map(literal) << token(":"), expd) |      # String : Expd
-        match_type(String).map(str).map(literal).map(lambda s: (s, s)) |         # String
-        match_type(Ident).map(str).map(literal).map(lambda i: (i, i)) |          # Ident
-        token("$") >> match_type(Ident).map(lambda i: (literal(str(i)), variable(i))) |   # $ Ident
-        seq(token("(") >> exp << token(")") << token(":"), expd)        # ( Exp ) : Expd
-    ).sep_by(token(","))
-    return make_dict(pairs)
-
-
-@generate("term")
-def term():
-    t = yield (
-            match_type(String).map(literal) |  # String
-            (token(".") >> match_type(String)).map(field) |     # . String
-            (token(".") >> match_type(PartialString) << completion_point).map(field) |
-            token(".").result(dot) |  # .
-            p_field.map(field) |  # FIELD
-            p_literal.map(literal) |               # LITERAL
-            token("(") >> exp << (token(")") | completion_point) |    # ( Exp )
-            seq(match_type(Ident) << token("("),
-                exp.sep_by(token(";"), min=1) << token(")")
-                ).map(lambda fa: call(fa[0], *fa[1])) |         # IDENT ( Args )
-            p_ident.map(call) |              # IDENT
-            (token("[") >> exp << token("]")).map(collect) |    # [ Exp ]
-            seq(token("["), token("]")).result(literal([])) |   # [ ]
-            (token("$") >> match_type(Ident)).map(variable) |    # $ IDENT
-            (token("{") >> mk_dict << token("}"))           # { MkDict }
-    )
-    while True:
-        # Work out the previous token:
-        idx = yield index
-        prev = yield at(idx - 1)
-
-        # Completion support. We have to inject this explicitly into the grammar
-        cursor = yield completion_point.optional()
-        if cursor is not None:
-            # cursor detected, injecting completion capability
-            return complete_term(prev, t)
-
-        f = yield p_field.optional()          # Term FIELD
-        if f is not None:
-            # Complete '.a.b'
-            cursor = yield completion_point.optional()
-            if cursor is not None:
-                # cursor detected, injecting completion capability
-                return complete_field(f, t)
-            t = pipe(t, field(f))
-            continue
-
-        d = yield token(".").optional()         # Term . String
-        if d is not None:
-            # Complete '.a.'
-            c = yield completion_point.optional()
-            if c is not None:
-                return complete_field(Field.make((d.start, ".", d.end)), t)     # Synthesise a position
-
-            s = yield (match_type(PartialString) << completion_point).optional()
-            # Complete ' ."a '
-            if s is not None:
-                return complete_field(s, t)
-
-            s = yield match_type(String)
-            t = pipe(t, field(s))
-            continue
-
-        b = yield seq(token("["), token("]")).optional()    # Term [ ]
-        if b is not None:
-            t = pipe(t, iterate)
-            continue
-
-        break
-
-    return t
+    def parser(stream, index):
+        p = _Parser(stream, index)
+        try:
+            value = method(p)
+        except _Fail as e:
+            return Result.failure(e.index, e.expected)
+        return Result.success(p.index, value)
+    return parser
 
 
 """
@@ -194,81 +404,21 @@ Remaining items in Term:
         Term '[' Exp ':' Exp ']' '?'  |
 """
 
+term = _entry(_Parser.term)
+exp = _entry(_Parser.exp)
+pattern = _entry(_Parser.pattern)
+top_level = _entry(_Parser.top_level)
 
-def operator(t, op):
-    @generate
-    def _():
-        yield token(t)
-        return op
-    return _
-
-
-def TODO(t):
-    @generate
-    def _():
-        yield token(t)
-        raise NotImplementedError(t)
-    return _
-
-
-# Binds tightest
-exp1 = (chainl(term, operator("*", op_mul) | operator("/", op_div) | operator("%", op_mod)) |
-        (token("-") >> term).map(negate))
-exp2 = chainl(exp1, operator("+", op_add) | operator("-", op_sub))
-exp3 = ((exp2 << token("==") << completion_point).map(complete_comparison) |
-        nonassoc(exp2, operator("!=", op_ne) | operator("==", op_eq) |
-                 operator("<", op_lt) | operator(">", op_gt) |
-                 operator("<=", op_le) | operator(">=", op_ge), exp2)
-        )
-exp4 = chainl(exp3, operator("and", log_and))
-exp5 = chainl(exp4, operator("or", log_or))
-exp6 = nonassoc(exp5, operator("=", set_path) | TODO("|=") | TODO("+=") | TODO("-=") | TODO("*=") | TODO("/=") | TODO("//="), exp5)
-exp7 = chainr(exp6, TODO("//"))
-exp8 = chainl(exp7, operator(",", comma))
-exp9 = chainr(exp8, operator("|", pipe))
-# Binds loosest
-
-@generate
-def exp():
-    bind = yield seq(term, token("as"), pattern, token("|"), exp).optional()
-    if bind is not None:
-        return binding(bind[0], bind[2], bind[4])
-
-    e = yield exp9 << completion_point.optional()
-    return e
-
-
-@generate
-def pattern():
-    bare_var = yield (token("$") >> match_type(Ident)).optional()
-    if bare_var is not None:
-        return ValueMatch(bare_var)
-
-    aps = yield (token("[") >> pattern.sep_by(token(","), min=1) << token("]")).optional()
-    if aps is not None:
-        return ArrayMatch(*aps)
-
-    ops = yield (token("{") >> (
-            # Just as {foo} is a handy way of writing {foo: .foo}, so {$foo} is a handy way of writing {foo:$foo}
-            (token("$") >> match_type(Ident)).map(lambda i: KeyMatch(i, ValueMatch(i))) |
-
-            seq(match_type(Ident) << token(":"), pattern).map(lambda ip: KeyMatch(ip[0], ip[1])) |
-            seq(match_type(String) << token(":"), pattern).map(lambda ip: KeyMatch(ip[0], ip[1])) |
-
-            seq(token("(") >> exp << token(")") << token(":"), pattern).map(lambda ep: ExpMatch(ep[0], ep[1]))
-    ).sep_by(token(","), min=1) << token("}")).optional()
-    if ops is not None:
-        return ObjectMatch(*ops)
-
-    yield fail("pattern")
-
-
-top_level = exp << match_type(Cursor.CursorToken).optional()
 
+# Evaluators hold no state, so they can be shared between callers
 
+@functools.lru_cache(maxsize=256)
 def parse(s, start=top_level):
-    return start.parse(lex(s))
+    return resolve(start.parse(lex(s)))
 
 
-def complete(s, offset, start=top_level):
-    return start.parse(lex(s, offset))
+@functools.lru_cache(maxsize=256)
+def complete(s, offset, start=top_level, relexer=None):
+    # A `Relexer` following the edits to `s` saves lexing it afresh
+    tokens = lex(s, offset) if relexer is None else relexer.lex(s, offset)
+    return resolve(start.parse(tokens))
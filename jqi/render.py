@@ -0,0 +1,126 @@
+"""
+Render values as jq prints them: indented or compact (`-c`), with top-level strings raw (`-r`), and
+optionally coloured with jq's default colours (those of jq 1.6, escape for escape).
+"""
+import math
+
+from . import codec
+
+COLOUR_RESET = "\033[0m"
+FIELD_COLOUR = "\033[34;1m"
+NULL_COLOUR = "\033[1;30m"
+FALSE_COLOUR = TRUE_COLOUR = NUMBER_COLOUR = "\033[0;39m"
+STRING_COLOUR = "\033[0;32m"
+ARRAY_COLOUR = OBJECT_COLOUR = "\033[1;39m"
+
+
+def render(values, compact=False, raw=False, colour=False):
+    """
+    Render a sequence of output values, one after another.
+    """
+    parts = []
+    for value in values:
+        if raw and isinstance(value, str):
+            parts.append(value)
+        else:
+            _dump(value, parts, None if compact else 0, colour)
+        parts.append("\n")
+    return "".join(parts)
+
+
+def dumps(value, compact=False, colour=False):
+    parts = []
+    _dump(value, parts, None if compact else 0, colour)
+    return "".join(parts)
+
+
+def _number(n):
+    n = float(n)
+    if n != n:
+        return "null"
+    if n in (float("inf"), float("-inf")):
+        n = 1.7976931348623157e+308 if n > 0 else -1.7976931348623157e+308
+    sign = "-" if math.copysign(1, n) < 0 else ""
+    if n.is_integer() and abs(n) < 1e16 and n:
+        return str(int(n))
+
+    # As jq's dtoa: the shortest digits that read back as the same double, written out in full unless
+    # the decimal point would be more than 15 places past them, or 4 or more before them
+    mantissa, _, exponent = repr(abs(n)).partition("e")
+    whole, _, fraction = mantissa.partition(".")
+    digits = (whole + fraction).lstrip("0")
+    point = len(whole) + int(exponent or 0) - (len(whole + fraction) - len(digits))
+    digits = digits.rstrip("0")
+    if not digits:
+        return sign + "0"
+    if point <= -4 or point > len(digits) + 15:
+        exponent = point - 1
+        return "{}{}{}e{}{:02d}".format(sign, digits[0], "." + digits[1:] if len(digits) > 1 else "",
+                                        "-" if exponent < 0 else "+", abs(exponent))
+    elif point <= 0:
+        return "{}0.{}{}".format(sign, "0" * -point, digits)
+    elif point >= len(digits):
+        return sign + digits + "0" * (point - len(digits))
+    return "{}{}.{}".format(sign, digits[:point], digits[point:])
+
+
+def _string(s):
+    return codec.dumps(str(s)).replace("\x7f", "\\u007f")
+
+
+def _dump(value, parts, indent, colour):
+    # `indent` is None for compact output. The placement of escapes follows jq's jv_dump_term.
+    if value is None:
+        start, text = NULL_COLOUR, "null"
+    elif value is True:
+        start, text = TRUE_COLOUR, "true"
+    elif value is False:
+        start, text = FALSE_COLOUR, "false"
+    elif isinstance(value, (int, float)):
+        start, text = NUMBER_COLOUR, _number(value)
+    elif isinstance(value, str):
+        start, text = STRING_COLOUR, _string(value)
+    elif isinstance(value, list):
+        start, text = ARRAY_COLOUR, None if value else "[]"
+    elif isinstance(value, dict):
+        start, text = OBJECT_COLOUR, None if value else "{}"
+    else:
+        raise TypeError("can't render {}".format(type(value).__name__))
+
+    if colour:
+        parts.append(start)
+    if text is not None:
+        parts.append(text)
+    else:
+        inner = None if indent is None else indent + 1
+        parts.append("[" if isinstance(value, list) else "{")
+        if inner is not None:
+            parts.append("\n" + "  " * inner)
+        if isinstance(value, list):
+            for i, item in enumerate(value):
+                if i:
+                    parts.append(",\n" + "  " * inner if inner is not None else ",")
+                _dump(item, parts, inner, colour)
+                if colour:
+                    parts.append(start)
+        else:
+            for i, (key, item) in enumerate(value.items()):
+                if i:
+                    parts.append(",\n" + "  " * inner if inner is not None else ",")
+                if colour:
+                    parts.append(COLOUR_RESET + FIELD_COLOUR + _string(key) + COLOUR_RESET + start)
+                else:
+                    parts.append(_string(key))
+                parts.append(": " if inner is not None else ":")
+                if colour:
+                    parts.append(COLOUR_RESET)
+                _dump(item, parts, inner, colour)
+                if colour:
+                    parts.append(start)
+        if indent is not None:
+            parts.append("\n" + "  " * indent)
+        if colour:
+            parts.append(start)
+        parts.append("]" if isinstance(value, list) else "}")
+    if colour:
+        parts.append(COLOUR_RESET)
@@ -0,0 +1,344 @@
+"""
+The input to be queried.
+
+The input is kept in a file, so that jq can read it directly: either the file it was given in, or a
+temporary copy of a stream. It's copied as bytes, a chunk at a time, rather than read into memory.
+
+jqi's own view of the input is a sequence of its top-level values. For a file, that's `MappedValues`:
+the file is mapped into memory, and each value is decoded only when it's used.
+"""
+from array import array
+from collections import OrderedDict, deque
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
+import json
+import mmap
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+from . import codec
+
+
+class Input:
+    """
+    Input held in the file at `path`, or given as `text` and written to a temporary file when a path is
+    first asked for. A temporary file is removed on `close`.
+    """
+    def __init__(self, path=None, text=None, temporary=False):
+        self._path = path
+        self._text = text
+        self.temporary = temporary
+
+    @classmethod
+    def from_path(cls, path):
+        return cls(path=path)
+
+    @classmethod
+    def from_stream(cls, stream, chunk=1024 * 1024):
+        """
+        Spool a binary stream to a temporary file.
+        """
+        fd, path = tempfile.mkstemp(prefix="jqi-", suffix=".json")
+        with os.fdopen(fd, "wb") as f:
+            shutil.copyfileobj(stream, f, chunk)
+        return cls(path=path, temporary=True)
+
+    @classmethod
+    def from_text(cls, text):
+        return cls(text=text)
+
+    @property
+    def path(self):
+        if self._path is None:
+            fd, self._path = tempfile.mkstemp(prefix="jqi-", suffix=".json")
+            self.temporary = True
+            with os.fdopen(fd, "w") as f:
+                f.write(self._text)
+        return self._path
+
+    def values(self):
+        """
+        The input's top-level values: `MappedValues` over the file or, for text not yet written out,
+        a list.
+        """
+        if self._text is not None:
+            return parse_values(self._text)
+        return MappedValues(self._path)
+
+    def close(self):
+        if self.temporary and self._path is not None:
+            os.unlink(self._path)
+            self._path = None
+            self.temporary = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_NOT_WHITESPACE = re.compile(r"[^\s]")
+
+
+def parse_values(text):
+    """
+    Decode a stream of JSON values from a string. This always uses `json`, which can decode a value
+    from the middle of a string.
+    """
+    values = []
+    decoder = json.JSONDecoder()
+    offset = 0
+    while match := _NOT_WHITESPACE.search(text, offset):
+        value, offset = decoder.raw_decode(text, match.start())
+        values.append(value)
+    return values
+
+
+_SPACE = re.compile(rb"[ \t\r\n]*")
+_STRING = re.compile(rb'"(?:[^"\\]|\\.)*"', re.DOTALL)
+_STRUCTURE = re.compile(rb'"(?:[^"\\]|\\.)*"|[\[\]{}]', re.DOTALL)
+_LINE_SPACE = re.compile(rb"[ \t\r]*")
+_SCALAR = re.compile(rb'[^ \t\r\n\[\]{}",]+')
+
+NDJSON = "ndjson"                   # one value per line
+CONCATENATED = "concatenated"       # values one after another, laid out any way at all
+DOCUMENT = "document"               # a single value
+
+
+def _value_end(buf, pos, limit=None):
+    """
+    The end of the value starting at `pos`, found without decoding it. Given a `limit`, returns None if
+    the value doesn't end before it.
+    """
+    n = len(buf) if limit is None else limit
+    first = buf[pos:pos + 1]
+    if first == b'"':
+        m = _STRING.match(buf, pos, n)
+        if m:
+            return m.end()
+        return None if limit is not None else len(buf)
+    if first not in (b"[", b"{"):
+        m = _SCALAR.match(buf, pos, n)
+        return m.end() if m else pos + 1
+
+    depth = 0
+    for m in _STRUCTURE.finditer(buf, pos, n):
+        c = buf[m.start()]
+        if c in b"[{":
+            depth += 1
+        elif c in b"]}":
+            depth -= 1
+            if depth == 0:
+                return m.end()
+    # Unterminated: leave it to the decoder to complain
+    return None if limit is not None else len(buf)
+
+
+def detect(buf, sample=1024 * 1024):
+    """
+    Tell what kind of stream of values `buf` holds, from the first `sample` bytes.
+
+    A first value that doesn't end within the sample is taken to be the whole of a `DOCUMENT`.
+    """
+    start = _SPACE.match(buf).end()
+    limit = min(len(buf), start + sample)
+    if start >= limit:
+        return DOCUMENT
+    end = _value_end(buf, start, limit)
+    if end is None or _SPACE.match(buf, end).end() >= len(buf):
+        return DOCUMENT
+
+    # There's more than one value. Is there exactly one on each line?
+    pos = start
+    while pos < limit:
+        nl = buf.find(b"\n", pos, limit)
+        if nl < 0:
+            if limit < len(buf):
+                break           # The sample ends part way through this line
+            nl = limit
+        end = _value_end(buf, pos, nl)
+        if end is None or _LINE_SPACE.match(buf, end).end() != nl:
+            return CONCATENATED
+        pos = _SPACE.match(buf, nl).end()
+    return NDJSON
+
+
+def _decode_batch(path, start, end, offsets):
+    # Run in a worker process: decode the values at `offsets`, relative to `start`
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return [codec.loads(data[a:b]) for a, b in offsets]
+
+
+class MappedValues(Sequence):
+    """
+    The top-level JSON values in a file, decoded on demand.
+
+    The file is memory-mapped. Values are found by scanning for the brackets and strings that delimit
+    them, only as far into the file as has been asked for; each value is decoded when it's first
+    used. With `lines`, each non-blank line is taken to hold exactly one value (NDJSON), and finding
+    values is just a matter of finding newlines. If `lines` isn't given, it's decided by looking at
+    the start of the file.
+
+    Recently used values are kept decoded; the rest are decoded again if they're used again.
+
+    `traverse`, for going through every value of a large file, decodes batches of values in a pool of
+    `processes` processes, ahead of the values being used. Each batch is read and decoded in a worker;
+    the values come back in order; a single document, or less than a batch, is decoded in-process instead.
+    The pool is kept until the file is closed.
+    """
+    KEEP = 4096
+
+    # Files smaller than this are decoded in-process
+    PARALLEL = 16 * 2 ** 20
+    BATCH = 1024
+
+    def __init__(self, path, lines=None, processes=None):
+        self.path = path
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        kind = detect(self._map) if lines is None else None
+        self.lines = kind == NDJSON if lines is None else lines
+        # A single document is decoded whole, without scanning for where it ends
+        self._whole = kind == DOCUMENT
+        self.processes = (os.cpu_count() or 1) if processes is None else processes
+        self._starts = array("q")
+        self._ends = array("q")
+        self._pos = 0
+        self._done = False
+        self._decoded = OrderedDict()
+        self._pool = None
+        # Values may be wanted by an evaluation thread and for completion at the same time
+        self._lock = threading.RLock()
+
+    def _scan(self, upto=None):
+        # Find the extents of values, until there are more than `upto` of them
+        with self._lock:
+            buf, n = self._map, len(self._map)
+            pos = self._pos
+            while not self._done and (upto is None or len(self._starts) <= upto):
+                pos = _SPACE.match(buf, pos).end()
+                if pos >= n:
+                    self._done = True
+                    break
+                if self.lines:
+                    end = buf.find(b"\n", pos)
+                    end = n if end < 0 else end
+                elif self._whole:
+                    end = n
+                    while end > pos and buf[end - 1] in b" \t\r\n":
+                        end -= 1
+                else:
+                    end = _value_end(buf, pos)
+                self._starts.append(pos)
+                self._ends.append(end)
+                pos = end
+            self._pos = pos
+
+    def __len__(self):
+        self._scan()
+        return len(self._starts)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        with self._lock:
+            self._scan(i)
+            if not 0 <= i < len(self._starts):
+                raise IndexError(i)
+            if i in self._decoded:
+                self._decoded.move_to_end(i)
+                return self._decoded[i]
+            start, end, whole = self._starts[i], self._ends[i], self._whole
+        try:
+            value = codec.loads(self._map[start:end])
+        except ValueError:
+            if not whole:
+                raise
+            # The first value was too big for `detect` to see past, and there's more after it: scan after all
+            with self._lock:
+                if self._whole:
+                    self._whole = False
+                    del self._starts[:], self._ends[:]
+                    self._pos, self._done = 0, False
+            return self[i]
+        with self._lock:
+            self._decoded[i] = value
+            if len(self._decoded) > self.KEEP:
+                self._decoded.popitem(last=False)
+        return value
+
+    def __iter__(self):
+        i = 0
+        while True:
+            self._scan(i)
+            if i >= len(self._starts):
+                return
+            yield self[i]
+            i += 1
+
+    def traverse(self):
+        """
+        Every value, in order, for a caller that's going to use them all: a large file is decoded
+        in the process pool. Reading part of the file, or a sample of it, is better done by iterating.
+        """
+        if self.processes <= 1 or len(self._map) < self.PARALLEL:
+            yield from self
+            return
+        i = 0
+        if self._whole:
+            # A single document is decoded here: in the pool, it would only have to be pickled back. Decoding
+            # it also tells whether it really is alone (see `__getitem__`); if it isn't, the rest is batched.
+            self._scan(0)
+            if self._starts:
+                yield self[0]
+                i = 1
+            if self._whole:
+                return
+        self._scan(i + self.BATCH)
+        if len(self._starts) - i <= self.BATCH:
+            # Not even a batch's worth left: not worth the pool
+            yield from (self[j] for j in range(i, len(self._starts)))
+            return
+        if self._pool is None:
+            # This runs in an evaluation thread of a threaded process, which mustn't fork: workers are
+            # started from a clean server process (or, where there's no such thing, from scratch)
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            self._pool = ProcessPoolExecutor(self.processes, mp_context=context)
+        pending = deque()
+        try:
+            while True:
+                # Keep every process busy, with a batch to spare
+                while len(pending) < 2 * self.processes:
+                    self._scan(i + self.BATCH - 1)
+                    n = min(self.BATCH, len(self._starts) - i)
+                    if n <= 0:
+                        break
+                    first, last = self._starts[i], self._ends[i + n - 1]
+                    offsets = [(self._starts[j] - first, self._ends[j] - first) for j in range(i, i + n)]
+                    pending.append(self._pool.submit(_decode_batch, self.path, first, last, offsets))
+                    i += n
+                if not pending:
+                    return
+                yield from pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._decoded.clear()
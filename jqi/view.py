@@ -0,0 +1,87 @@
+"""
+Index a block of output text by line, so that a window onto it can be cut out without splitting the
+whole text into lines.
+"""
+from array import array
+import bisect
+
+
+class LineIndex:
+    """
+    The lines of `text`.
+
+    Rather than recording where every line starts, the index counts the newlines in each fixed-size
+    block of the text (which `str.count` does at C speed). Finding a line means skipping to its block,
+    then searching forward over no more than a block's worth of text.
+    """
+    BLOCK = 4096
+
+    def __init__(self, text):
+        self.text = text
+        self._marks = None
+
+    def _index(self):
+        # _marks[k] is the number of newlines before offset k * BLOCK
+        if self._marks is None:
+            text, block = self.text, self.BLOCK
+            marks = array("q", [0])
+            total = 0
+            for start in range(0, len(text), block):
+                total += text.count("\n", start, start + block)
+                marks.append(total)
+            self._marks = marks
+        return self._marks
+
+    def __len__(self):
+        marks = self._index()
+        text = self.text
+        return marks[-1] + (1 if text and not text.endswith("\n") else 0)
+
+    def start(self, i):
+        """
+        The offset at which line `i` starts.
+        """
+        if i == 0:
+            return 0
+        marks = self._index()
+        # Line i follows the i'th newline, which lies in block k
+        k = bisect.bisect_left(marks, i) - 1
+        pos = k * self.BLOCK
+        find = self.text.find
+        for _ in range(i - marks[k]):
+            pos = find("\n", pos) + 1
+        return pos
+
+    def spans(self, top, height):
+        """
+        The `(start, end)` offsets of lines `top` to `top + height`, not counting their newlines.
+        """
+        text = self.text
+        bottom = min(top + height, len(self))
+        pos = self.start(top) if top < bottom else 0
+        spans = []
+        for _ in range(top, bottom):
+            end = text.find("\n", pos)
+            if end < 0:
+                end = len(text)
+            spans.append((pos, end))
+            pos = end + 1
+        return spans
+
+    def line(self, i):
+        (start, end), = self.spans(i, 1)
+        return self.text[start:end]
+
+    def window(self, top, height, left=0, width=None):
+        """
+        Lines `top` to `top + height`, each cut down to the `width` characters starting at `left`.
+        """
+        text = self.text
+        return [text[start + left:end if width is None else min(end, start + left + width)]
+                for start, end in self.spans(top, height)]
+
+    def width(self, top, height):
+        """
+        The length of the longest of the lines `top` to `top + height`.
+        """
+        return max((end - start for start, end in self.spans(top, height)), default=0)
@@ -0,0 +1,354 @@
+"""
+An explicit-stack evaluator.
+
+`compile_filter` flattens a filter tree (as built by `jqi.eval`, which records each evaluator's
+construction in its `node` attribute) into a list of instructions. These are executed by a single
+loop which keeps its own stack of choice points for backtracking, its own data stack for
+subexpressions and its own stack of return frames, instead of nesting Python calls.
+
+Calls to `def`-introduced functions (and their filter arguments) jump straight into compiled code.
+A call in tail position reuses the caller's return frame, so recursive definitions run in constant
+Python stack depth.
+
+Any evaluator the compiler doesn't recognise (completion hooks, builtins) is run as an opaque Python
+iterator from within the loop; so is any function which was not compiled as part of this program.
+"""
+
+from numbers import Number
+
+from .eval import _access, bind, checked, neg, Function, Closure, ROOT
+from .function import _truth
+
+# Opcodes
+FIELD = "FIELD"
+FIELDS = "FIELDS"
+LITERAL = "LITERAL"
+VARIABLE = "VARIABLE"
+LOCAL = "LOCAL"
+EACH = "EACH"
+FORK = "FORK"
+JUMP = "JUMP"
+SUBEXP_BEGIN = "SUBEXP_BEGIN"
+SUBEXP_END = "SUBEXP_END"
+BINOP = "BINOP"
+NEGATE = "NEGATE"
+TEST_AND = "TEST_AND"
+TEST_OR = "TEST_OR"
+TRUTH = "TRUTH"
+COLLECT_BEGIN = "COLLECT_BEGIN"
+APPEND = "APPEND"
+BIND = "BIND"
+DEF = "DEF"
+CALL = "CALL"
+TAIL_CALL = "TAIL_CALL"
+BUILTIN = "BUILTIN"
+NATIVE = "NATIVE"
+RET = "RET"
+OUTPUT = "OUTPUT"
+
+# Kinds of choice point
+_FORK = 0       # resume at a saved state
+_PAIRS = 1      # resume with the next (env, value) from an iterator
+_VALUES = 2     # resume with the next value from an iterator
+_ENVS = 3       # resume with the next environment from an iterator
+
+
+class Program:
+    def __init__(self, code, entries):
+        self.code = code
+        self.entries = entries
+
+    def __call__(self, stream):
+        for env, item in stream:
+            yield from self.run(env, item)
+
+    def dump(self):
+        return "\n".join("{:4d}  {}".format(pc, " ".join([instr[0], *(_show(i) for i in instr[1:])]))
+                         for pc, instr in enumerate(self.code))
+
+    def run(self, env, value, pc=0):
+        code = self.code
+        entries = self.entries
+        stack = None        # cons cells: (top, rest)
+        frames = None       # cons cells: ((return pc, caller env), rest)
+        choices = []        # (kind, pc, env, value, stack, frames, iterator)
+
+        while True:
+            instr = code[pc]
+            op = instr[0]
+            backtrack = False
+
+            if op is FIELD:
+                f = instr[1]
+                env = env.at((env.path, f))
+                value = _access(value, f)
+                pc += 1
+            elif op is FIELDS:
+                for f in instr[1]:
+                    value = _access(value, f)
+                env = env.at((env.path, instr[1]))
+                pc += 1
+            elif op is LITERAL:
+                env = env.at(ROOT)
+                value = instr[1]
+                pc += 1
+            elif op is VARIABLE:
+                env = env.at(ROOT)
+                value = env[instr[1]]
+                pc += 1
+            elif op is LOCAL:
+                env = env.at(ROOT)
+                value = env.lookup(instr[1], instr[2])
+                pc += 1
+            elif op is SUBEXP_BEGIN:
+                stack = ((env, value), stack)
+                pc += 1
+            elif op is SUBEXP_END:
+                (env, saved), rest = stack
+                stack = (value, rest)
+                value = saved
+                pc += 1
+            elif op is BINOP:
+                x, (y, stack) = stack
+                value = instr[1](x, y)
+                pc += 1
+            elif op is FORK:
+                choices.append((_FORK, instr[1], env, value, stack, frames, None))
+                pc += 1
+            elif op is JUMP:
+                pc = instr[1]
+            elif op is EACH:
+                if isinstance(value, list):
+                    it = iter(checked(value))
+                elif isinstance(value, dict):
+                    it = iter(checked(value.values()))
+                else:
+                    raise ValueError("can't iterate over {}".format(type(value).__name__))
+                choices.append((_VALUES, pc + 1, env, value, stack, frames, it))
+                backtrack = True
+            elif op is CALL or op is TAIL_CALL:
+                ident_name, argfs, where = instr[1], instr[2], instr[3]
+                fun = env[ident_name] if where is None else env.lookup(*where)
+                if isinstance(fun, Function) and id(fun.body) in entries:
+                    callee_env = fun.enter(env, argfs)
+                    target = entries[id(fun.body)]
+                elif isinstance(fun, Closure) and id(fun.filter) in entries:
+                    callee_env = fun.env
+                    target = entries[id(fun.filter)]
+                else:
+                    choices.append((_PAIRS, pc + 1, env, value, stack, frames, iter(fun(env, value, *argfs))))
+                    backtrack = True
+                    target = None
+                if target is not None:
+                    if op is CALL:
+                        frames = ((pc + 1, env), frames)
+                    env = callee_env
+                    pc = target
+            elif op is RET:
+                (pc, env), frames = frames
+            elif op is OUTPUT:
+                yield env, value
+                backtrack = True
+            elif op is TRUTH:
+                value = _truth(value)
+                pc += 1
+            elif op is TEST_AND:
+                x, stack = stack
+                if _truth(x):
+                    pc += 1
+                else:
+                    value = False
+                    pc = instr[1]
+            elif op is TEST_OR:
+                x, stack = stack
+                if _truth(x):
+                    value = True
+                    pc = instr[1]
+                else:
+                    pc += 1
+            elif op is COLLECT_BEGIN:
+                acc = []
+                choices.append((_FORK, instr[1], env, acc, stack, frames, None))
+                stack = (acc, stack)
+                pc += 1
+            elif op is APPEND:
+                stack[0].append(value)
+                backtrack = True
+            elif op is NEGATE:
+                value = neg(value)
+                pc += 1
+            elif op is BIND:
+                v, stack = stack
+                envs = [bind(env, b, instr[2]) for b in instr[1].bindings([(env, value)], v)]
+                choices.append((_ENVS, pc + 1, env, value, stack, frames, iter(envs)))
+                backtrack = True
+            elif op is DEF:
+                env = Function(instr[2], instr[3], env).env
+                pc += 1
+            elif op is BUILTIN:
+                choices.append((_PAIRS, pc + 1, env, value, stack, frames, iter(instr[1](env, value, *instr[2]))))
+                backtrack = True
+            elif op is NATIVE:
+                choices.append((_PAIRS, pc + 1, env, value, stack, frames, iter(instr[1]([(env, value)]))))
+                backtrack = True
+            else:
+                raise NotImplementedError("unknown instruction {}".format(op))
+
+            if backtrack:
+                while True:
+                    if not choices:
+                        return
+                    kind, pc, env, value, stack, frames, it = choice = choices.pop()
+                    if kind == _FORK:
+                        break
+                    try:
+                        if kind == _VALUES:
+                            value = next(it)
+                        elif kind == _PAIRS:
+                            env, value = next(it)
+                        else:
+                            env = next(it)
+                    except StopIteration:
+                        continue
+                    choices.append(choice)
+                    break
+
+
+def compile_filter(f):
+    """
+    Compile an evaluator (as returned by `jqi.parser.parse`) into a `Program`.
+    """
+    compiler = _Compiler()
+    compiler.emit(f)
+    compiler.code.append((OUTPUT,))
+    compiler.finish()
+    return Program(compiler.code, compiler.entries)
+
+
+class _Compiler:
+    def __init__(self):
+        self.code = []
+        self.entries = {}
+        self.pending = []       # separately-compiled blocks: function bodies and filter arguments
+
+    def finish(self):
+        while self.pending:
+            f = self.pending.pop()
+            if id(f) in self.entries:
+                continue
+            self.entries[id(f)] = len(self.code)
+            self.emit(f)
+            self.code.append((RET,))
+
+        # Mark calls in tail position
+        for pc, instr in enumerate(self.code):
+            if instr[0] is CALL:
+                following = self.code[pc + 1]
+                while following[0] is JUMP:
+                    following = self.code[following[1]]
+                if following[0] is RET:
+                    self.code[pc] = (TAIL_CALL, *instr[1:])
+
+    def emit(self, f):
+        # Pipelines are flattened iteratively, so long chains don't recurse
+        todo = [f]
+        while todo:
+            f = todo.pop()
+            node = getattr(f, "node", None)
+            if node is None:
+                self.code.append((NATIVE, f))
+                continue
+            op, *args = node
+            if op == "pipe":
+                todo.extend(reversed(args))
+            else:
+                self.emit_node(f, op, *args)
+
+    def emit_node(self, f, op, *args):
+        code = self.code
+        if op == "dot":
+            pass
+        elif op == "field":
+            code.append((FIELD, args[0]))
+        elif op == "fields":
+            code.append((FIELDS, args))
+        elif op == "literal":
+            code.append((LITERAL, args[0]))
+        elif op == "variable":
+            code.append((VARIABLE, args[0]))
+        elif op == "local":
+            code.append((LOCAL, args[1], args[2]))
+        elif op == "iterate":
+            code.append((EACH,))
+        elif op == "comma":
+            x, y = args
+            fork = len(code)
+            code.append(None)
+            self.emit(x)
+            jump = len(code)
+            code.append(None)
+            code[fork] = (FORK, len(code))
+            self.emit(y)
+            code[jump] = (JUMP, len(code))
+        elif op == "op":
+            oper, x, y = args
+            # Right-hand side varies slowest
+            self.subexp(y)
+            self.subexp(x)
+            code.append((BINOP, oper))
+        elif op == "negate":
+            self.emit(args[0])
+            code.append((NEGATE,))
+        elif op in ("log_and", "log_or"):
+            x, y = args
+            self.subexp(x)
+            test = len(code)
+            code.append(None)
+            self.emit(y)
+            code.append((TRUTH,))
+            code[test] = (TEST_AND if op == "log_and" else TEST_OR, len(code))
+        elif op == "collect":
+            begin = len(code)
+            code.append(None)
+            self.emit(args[0])
+            code.append((APPEND,))
+            code[begin] = (COLLECT_BEGIN, len(code))
+        elif op == "binding":
+            term, pattern, exp, names = args
+            self.subexp(term)
+            code.append((BIND, pattern, names))
+            self.emit(exp)
+        elif op == "definition":
+            ident_name, params, body, rest = args
+            self.pending.append(body)
+            code.append((DEF, ident_name, params, body))
+            self.emit(rest)
+        elif op == "call":
+            ident_name, *argfs = args
+            self.pending.extend(argfs)
+            code.append((CALL, ident_name, argfs, None))
+        elif op == "local_call":
+            ident_name, depth, slot, *argfs = args
+            self.pending.extend(argfs)
+            code.append((CALL, ident_name, argfs, (depth, slot)))
+        elif op == "builtin":
+            ident_name, fun, *argfs = args
+            code.append((BUILTIN, fun, argfs))
+        else:
+            code.append((NATIVE, f))
+
+    def subexp(self, f):
+        self.code.append((SUBEXP_BEGIN,))
+        self.emit(f)
+        self.code.append((SUBEXP_END,))
+
+
+def _show(arg):
+    if callable(arg) and not isinstance(arg, type):
+        node = getattr(arg, "node", None)
+        return "<{}>".format(node[0] if node is not None else getattr(arg, "__name__", "native"))
+    if isinstance(arg, (list, tuple)):
+        return "[{}]".format(", ".join(_show(a) for a in arg))
+    if isinstance(arg, (str, Number)) or arg is None:
+        return repr(arg)
+    return type(arg).__name__
@@ -0,0 +1,357 @@
+"""
+Workers run filters over a fixed input.
+
+A worker takes its input once, when it's created; after that, each call to `run` supplies only the
+filter and its flags. `run_async` does the same from a coroutine, which can be cancelled at any point
+if its result is no longer wanted.
+
+`stream` is an asynchronous generator of the output, a chunk at a time, for showing output while the
+filter is still running. A chunk of None means that the worker has started again from the beginning, and
+the output so far should be discarded. If the filter fails, `stream` raises `Failed`.
+
+`objects` gives the filter's output values themselves, as decoded JSON, for callers that want to lay
+them out some other way.
+"""
+import asyncio
+import codecs
+import io
+import threading
+import time
+
+import sh
+
+from . import codec
+from .codegen import compile_query
+from .optimize import optimize
+from .eval import make_env, splice, stopping, strict
+from .parser import parse
+from .render import render
+from .source import Input, MappedValues
+
+
+class Unsupported(Exception):
+    """
+    The worker can't run this filter the way jq would.
+    """
+
+
+class Failed(Exception):
+    """
+    The filter failed; the exception's argument is jq's error message.
+    """
+
+
+async def collect(stream):
+    """
+    Gather a whole stream into `(output, None)`, or `(None, error)` if it fails.
+    """
+    chunks = []
+    try:
+        async for chunk in stream:
+            if chunk is None:
+                chunks = []
+            else:
+                chunks.append(chunk)
+    except Failed as e:
+        return None, e.args[0]
+    return "".join(chunks), None
+
+
+class JqWorker:
+    """
+    Runs the `jq` executable.
+
+    jq takes its filter on the command line, so a resident process can't be handed a new one: each
+    run is still a fresh process. The input, though, is in a file, and jq reads that directly rather
+    than having the whole document piped through from Python on every refresh.
+
+    `source` is an `Input`, or the input's text; text is spooled to a temporary file the first time
+    it's needed, and that file is removed on `close`.
+    """
+    def __init__(self, source):
+        self.owned = isinstance(source, str)
+        self.source = Input.from_text(source) if self.owned else source
+        self.path = None
+
+    def run(self, pattern, args=(), tty=False, out=None, err=None):
+        """
+        Returns `(output, None)`, or `(None, error)` if jq fails. If `out` and `err` are given, jq
+        writes to them directly and both results are None.
+        """
+        self.spool()
+        stdio = out is not None
+        if stdio:
+            tty = out.isatty()
+        else:
+            out = io.StringIO()
+            err = io.StringIO()
+
+        try:
+            proc = sh.jq(*args, pattern, self.path, _out=out, _err=err, _return_cmd=True, _tty_out=tty)
+            proc.wait()
+            if stdio:
+                return None, None
+            return out.getvalue(), None
+        except sh.ErrorReturnCode:
+            if stdio:
+                return None, None
+            return None, err.getvalue()
+
+    # How much output `stream` reads at a time
+    CHUNK = 64 * 1024
+
+    async def run_async(self, pattern, args=(), tty=False):
+        """
+        As `run`. If cancelled, the jq process is killed.
+        """
+        return await collect(self.stream(pattern, args, tty=tty))
+
+    async def stream(self, pattern, args=(), tty=False):
+        """
+        Generate jq's output as it's written. If the generator is cancelled or closed early, the jq
+        process is killed.
+        """
+        self.spool()
+        if tty:
+            args = [*args, "-C"]
+        proc = await asyncio.create_subprocess_exec("jq", *args, pattern, self.path,
+                                                    stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.PIPE)
+        # Drain stderr alongside stdout, so that jq can't block writing to either
+        err = asyncio.ensure_future(proc.stderr.read())
+        try:
+            decoder = codecs.getincrementaldecoder("utf-8")()
+            while chunk := await proc.stdout.read(self.CHUNK):
+                if text := decoder.decode(chunk):
+                    yield text
+            if text := decoder.decode(b"", final=True):
+                yield text
+            await proc.wait()
+            error = await err
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            if not err.done():
+                err.cancel()
+        if proc.returncode != 0:
+            raise Failed(error.decode())
+
+    async def objects(self, pattern):
+        # Compact output has one value per line, with no colour to strip
+        out, err = await self.run_async(pattern, ["-c"])
+        if out is None:
+            raise Failed(err)
+        # One value per line; only "\n" ends a line, since jq leaves U+2028 and the like unescaped in strings
+        return [codec.loads(line) for line in out.split("\n") if line]
+
+    def spool(self):
+        if self.path is None:
+            self.path = self.source.path
+
+    def close(self):
+        if self.owned:
+            self.source.close()
+        self.path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class InProcessWorker:
+    """
+    Runs filters with jqi's own evaluator, over input that's already been decoded: no process, no
+    serialisation and no reparsing of the input.
+
+    Raises `Unsupported` if the filter doesn't parse, uses anything jqi doesn't implement, or fails;
+    jq can then report the problem in its own words.
+    """
+    FLAGS = {"-c", "-r"}
+
+    # How long the evaluation thread runs for before handing over the values it has
+    SLICE = 0.02
+
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.last = None        # the most recently streamed filter, and its values
+
+    def run(self, pattern, args=(), tty=False, out=None, err=None):
+        # A slice at a time, so the filter is evaluated under the same rules as when it's streamed
+        outputs, values = self.values(pattern, args), []
+        while (batch := self.slice(outputs, threading.Event())) is not None:
+            values.extend(batch)
+        return self.output(values, args, tty, out)
+
+    async def run_async(self, pattern, args=(), tty=False):
+        """
+        As `run`. Evaluation is interleaved with other tasks, and stops at the next opportunity if
+        cancelled.
+        """
+        return await collect(self.stream(pattern, args, tty=tty))
+
+    async def stream(self, pattern, args=(), tty=False):
+        """
+        Generate the output, a time slice's worth at a time.
+        """
+        compact, raw = "-c" in args, "-r" in args
+        values = []
+        async for batch in self.batches(pattern, args):
+            values.extend(batch)
+            yield render(batch, compact=compact, raw=raw, colour=tty)
+        self.last = pattern, values
+
+    async def objects(self, pattern):
+        if self.last is not None and self.last[0] == pattern:
+            return self.last[1]
+        values = []
+        async for batch in self.batches(pattern, ()):
+            values.extend(batch)
+        return values
+
+    async def batches(self, pattern, args):
+        """
+        Generate lists of output values, a time slice's worth at a time. Evaluation runs in a thread, so
+        that a filter which goes a long way between outputs doesn't hold up other tasks; once the
+        generator is closed, the thread gives up at its next opportunity.
+        """
+        stop = threading.Event()
+        values = self.values(pattern, args)
+        try:
+            while (batch := await asyncio.to_thread(self.slice, values, stop)) is not None:
+                if batch:
+                    yield batch
+        finally:
+            stop.set()
+
+    def slice(self, values, stop):
+        """
+        Take the values produced in one time slice; or None, once there are no more.
+        """
+        token, strictly = stopping.set(stop), strict.set(True)
+        try:
+            batch = []
+            deadline = time.monotonic() + self.SLICE
+            for value in values:
+                if value is not _PAUSE:
+                    batch.append(value)
+                if time.monotonic() > deadline:
+                    return batch
+            return batch or None
+        finally:
+            strict.reset(strictly)
+            stopping.reset(token)
+
+    def values(self, pattern, args):
+        """
+        Generate the filter's outputs, with `_PAUSE` between inputs.
+        """
+        if not self.FLAGS.issuperset(args):
+            raise Unsupported(" ".join(args))
+        try:
+            _check(optimize(parse(pattern)))
+            evaluator = compile_query(pattern)
+            env = make_env()
+            # One input at a time, so that a caller can pause between them
+            for item in _traverse(self.inputs):
+                yield _PAUSE
+                for _, value in evaluator(splice(env, [item])):
+                    yield value
+        except Unsupported:
+            raise
+        except Exception as e:
+            raise Unsupported(e) from e
+
+    def output(self, values, args, tty, out):
+        text = render(values, compact="-c" in args, raw="-r" in args, colour=tty if out is None else out.isatty())
+        if out is not None:
+            out.write(text)
+            return None, None
+        return text, None
+
+    def close(self):
+        self.inputs = None
+        self.last = None
+
+
+_PAUSE = object()
+
+
+def _traverse(inputs):
+    # Every input will be used, so a large file's can be decoded ahead, in parallel
+    return inputs.traverse() if isinstance(inputs, MappedValues) else inputs
+
+# The kinds of step whose results have been checked against jq's. A filter with any other step (an update,
+# say, whose paths jqi resolves differently) is left to jq.
+CHECKED = {"dot", "field", "fields", "literal", "variable", "local", "pipe", "comma", "iterate", "op", "negate",
+           "collect", "make_dict", "log_and", "log_or", "builtin", "call", "local_call", "definition", "binding"}
+
+
+def _check(f):
+    todo = [f]
+    while todo:
+        node = getattr(todo.pop(), "node", None)
+        if node is None or node[0] not in CHECKED:
+            raise Unsupported(node[0] if node is not None else "native step")
+        for arg in node[1:]:
+            if isinstance(arg, (list, tuple)):
+                todo.extend(a for pair in arg for a in (pair if isinstance(pair, tuple) else [pair]) if callable(a))
+            elif callable(arg) and hasattr(arg, "node"):
+                todo.append(arg)
+
+
+class FallbackWorker:
+    """
+    Offers each filter to its workers in turn, until one doesn't raise `Unsupported`.
+    """
+    def __init__(self, *workers):
+        self.workers = workers
+
+    def run(self, pattern, args=(), tty=False, out=None, err=None):
+        for worker in self.workers[:-1]:
+            try:
+                return worker.run(pattern, args, tty=tty, out=out, err=err)
+            except Unsupported:
+                pass
+        return self.workers[-1].run(pattern, args, tty=tty, out=out, err=err)
+
+    async def run_async(self, pattern, args=(), tty=False):
+        return await collect(self.stream(pattern, args, tty=tty))
+
+    async def stream(self, pattern, args=(), tty=False):
+        for worker in self.workers:
+            stream = worker.stream(pattern, args, tty=tty)
+            started = False
+            try:
+                async for chunk in stream:
+                    started = True
+                    yield chunk
+                return
+            except Unsupported:
+                if worker is self.workers[-1]:
+                    raise
+                if started:
+                    yield None
+            finally:
+                # Close the worker's stream now, if this one's abandoned
+                await stream.aclose()
+
+    async def objects(self, pattern):
+        for worker in self.workers[:-1]:
+            try:
+                return await worker.objects(pattern)
+            except Unsupported:
+                pass
+        return await self.workers[-1].objects(pattern)
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
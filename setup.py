@@ -13,4 +13,7 @@ setup(
     setup_requires=["setupmeta"],
     url="https://github.com/jan-g/jqi",
     packages=find_packages(exclude=["test.*, *.test", "test*"]),
+    extras_require={
+        "fast": ["orjson"],     # a faster JSON codec; see jqi/codec.py
+    },
 )
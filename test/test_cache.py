@@ -0,0 +1,46 @@
+import pytest
+
+from jqi.cache import normalise, ResultCache
+
+
+def simplify(x):
+    if isinstance(x, str):
+        return x.replace(".", "_").replace(" ", "_")
+    else:
+        return type(x).__name__
+
+
+@pytest.mark.parametrize("pattern, expected", [
+    (".", "."),
+    ("  .a  ", ".a"),
+    (".a|.b", ".a|.b"),
+    (".a  |\n\t.b", ".a | .b"),
+    (".a | .b # comment", ".a | .b"),
+    ('"a  b"  ,  1', '"a  b" , 1'),
+    ("1.5", "1.5"),
+    ("1 . 5", "1 . 5"),
+], ids=simplify)
+def test_normalise(pattern, expected):
+    assert normalise(pattern) == expected
+
+
+def test_lru():
+    c = ResultCache(budget=10)
+    c.put("a", "aaaa", 4)
+    c.put("b", "bbbb", 4)
+    assert c.get("a") == "aaaa"
+    c.put("c", "cccc", 4)           # evicts b, the least recently used
+    assert "a" in c and "b" not in c and "c" in c
+    assert c.size == 8
+    assert c.get("b") is None
+
+
+def test_budget():
+    c = ResultCache(budget=10)
+    c.put("a", "a", 1)
+    c.put("big", "x" * 11, 11)
+    assert "big" not in c and "a" in c
+    c.put("a", "aaaaaaaaaa", 10)
+    assert len(c) == 1 and c.size == 10
+    c.clear()
+    assert len(c) == 0 and c.size == 0
@@ -0,0 +1,40 @@
+import json
+import pytest
+
+from jqi import codec
+
+
+@pytest.fixture(params=sorted(codec.CODECS))
+def loads_dumps(request):
+    return codec.CODECS[request.param]
+
+
+@pytest.mark.parametrize("text, value", [
+    ('{"a": [1, 2.5, "x"]}', {"a": [1, 2.5, "x"]}),
+    (b'[null, true, false]', [None, True, False]),
+    ('"\\u00e9\\n"', "é\n"),
+    ('NaN', float("nan")),
+])
+def test_loads(loads_dumps, text, value):
+    loads, _ = loads_dumps
+    result = loads(text)
+    assert result == value or result != result and value != value
+
+
+def test_loads_error(loads_dumps):
+    loads, _ = loads_dumps
+    with pytest.raises(json.JSONDecodeError):
+        loads('{"a": ')
+
+
+@pytest.mark.parametrize("value", [
+    "plain",
+    "é\x00\x1f\x7f\"\\/\n\t",
+    "\ud800",
+    {"a": [1, None, "b"]},
+])
+def test_dumps(loads_dumps, value):
+    _, dumps = loads_dumps
+    assert json.loads(dumps(value)) == value
+    if isinstance(value, str):
+        assert dumps(value) == json.dumps(value, ensure_ascii=False)
@@ -0,0 +1,92 @@
+import pytest
+from jqi.parser import parse, exp
+from jqi.eval import make_env, splice, unsplice
+from jqi.codegen import compile_python, compile_query
+
+
+def simplify(x):
+    if isinstance(x, str):
+        return x.replace(".", "_").replace(" ", "_")
+    elif isinstance(x, (list, tuple)):
+        return "".join(type(i).__name__[0] for i in x)
+    elif isinstance(x, type):
+        return x.__name__
+    else:
+        return type(x).__name__
+
+
+@pytest.mark.parametrize("input,stream,result", [
+    (".", [1, 2, 3], [1, 2, 3]),
+    (".a.b", [{"a": {"b": "c"}}, {}, None], ["c", None, None]),
+    ("1, 2", [0, 0], [1, 2, 1, 2]),
+    ("3 - 1 - 1", [None], [1]),
+    ('(1, 3) * (4, 7)', [None], [4, 12, 7, 21]),
+    ('-(1, 2)', [None], [-1, -2]),
+    ('(false, true) and (true, false)', [None], [False, True, False]),
+    ('(false, true) or (true, false)', [None], [True, False, True]),
+    ("not", [False, True, 1, None], [True, False, False, True]),
+    ("null, true, false, empty", [None], [None, True, False]),
+    (".[]", [[1, 2, 3], {"a": 4, "b": 5}], [1, 2, 3, 4, 5]),
+    ("[.[] | [.[] | . * 10]]", [[[1, 2], [3]]], [[[10, 20], [30]]]),
+    ('{("a", "b"):("c", "d")}', [None], [{"a": "c"}, {"a": "d"}, {"b": "c"}, {"b": "d"}]),
+    ('[[1, 2], [3, 4]] as [$x, [$y, $z]] | [$x, $y, $z]', [None], [[[1, 2], 3, 4]]),
+    ('.a | . | .c = 2', [{}], [{"a": {"c": 2}}]),
+    ('.[] | select(.a == 1) | .b', [[{"a": 1, "b": 2}, {"a": 2, "b": 3}]], [2]),
+    ('1, 2, 3 | select(. < 3, . % 2 != 0)', [None], [1, 1, 2, 3]),
+    ('def f(g): g | g; 2 | f(. * 3)', [None], [18]),
+    ('def select(f): 5; select(false)', [None], [5]),
+    ('1 as $x | def f: $x; 2 as $x | f, $x', [None], [1, 2]),
+    ('def f(g): def h: g; 2 | h; 1 | f(. + 10)', [None], [12]),
+    ('def f: def g: 3; g * 2; def g: 5; f, g', [None], [6, 5]),
+    ('. as [$a, $b] | def f($x): [$a, $x, $b]; f(5), ($b as $a | f($a))', [[1, 2]], [[1, 5, 2], [1, 2, 2]]),
+    ('.a as $k | . as {($k): $v} | $v', [{"a": "x", "x": 1}], [1]),
+], ids=simplify)
+def test_compile(input, stream, result):
+    env = make_env()
+    evaluator = compile_python(parse(input, start=exp))
+    assert unsplice(evaluator(splice(env, stream))) == result
+
+
+def test_inlined():
+    source = compile_python(parse(".[] | select(.a == 1) | .b")).source
+    assert "select" not in source
+    assert ".get('a')" in source
+
+
+def test_deeply_nested():
+    # More nested loops than Python permits in a single function
+    evaluator = compile_python(parse("[" + " | ".join([".[]"] * 30) + "]"))
+    item = 1
+    for _ in range(30):
+        item = [item]
+    assert unsplice(evaluator(splice(make_env(), [item]))) == [[1]]
+
+
+def test_cached():
+    assert compile_query(".a | .b") is compile_query(".a | .b")
+
+
+def test_recursive_definition():
+    # Deeper than the Python stack allows
+    evaluator = compile_query("def f: select(. >= 5000), (select(. < 5000) | . + 1 | f); f")
+    assert unsplice(evaluator(splice(make_env(), [0]))) == [5000]
+
+
+@pytest.mark.parametrize("input,stream,result", [
+    (". < 2", [1, 2.5, "a", None, True], [True, False, False, True, True]),
+    ('. == "a"', ["a", 1], [True, False]),
+    (". + 1", [1, 1.5, None], [2, 2.5, 1]),
+    (". == .", [[1], {"a": True}], [True, True]),
+    (". * .", [2, {"a": {"b": 1}}], [4, {"a": {"b": 1}}]),
+], ids=simplify)
+def test_operators(input, stream, result):
+    # Plain numbers and strings take Python's operators; anything else, jq's rules
+    evaluator = compile_query(input)
+    assert unsplice(evaluator(splice(make_env(), stream))) == result
+
+
+@pytest.mark.parametrize("input", ["empty", ".[] | empty"], ids=simplify)
+def test_empty(input):
+    # A query with no way to produce a value still compiles to a generator
+    evaluator = compile_query(input)
+    assert unsplice(evaluator(splice(make_env(), [[1, 2]]))) == []
@@ -2,6 +2,7 @@ import pytest
 from jqi.parser import Token, Field, PartialString
 from jqi.lexer import Cursor, lex
 from jqi.completion import completer
+from jqi.completer import Sampling
 
 
 def simplify(x):
@@ -60,6 +61,9 @@ def test_lexer(input, result):
     ('."##', [{"a": "b", "aa": "d"}], (1, 2), [Field("a"), Field("aa")]),
     ('."a"."##', [{"a": {"aaa": "b", "aa": "d"}}], (5, 6), [Field("aa"), Field("aaa")]),
     ('(1, "a", [], {}) == ##', [None], (20, 20), [1, "a"]),
+    ('.a as $x | $x.##', [{"a": {"b": "c", "bb": "d"}}], (14, 14), [Field("b"), Field("bb")]),
+    ('def f(g): .a | g; f(.b).##', [{"a": {"b": {"c": 1}}}], (24, 24), [Field("c")]),
+    ('.a as $x | (.b, $x) == ##', [{"a": 1, "b": "c"}], (23, 23), [1, "c"]),
 ], ids=simplify)
 def test_completion(input, stream, pos, result):
     # Work out where the cursor is in the input
@@ -71,3 +75,46 @@ def test_completion(input, stream, pos, result):
             completer(input, cursor)
         return
     assert completer(input, cursor)(stream) == (result, pos)
+
+
+def test_completion_cache():
+    from jqi.parser import complete
+    input = '.a | .b'
+    completer(input, len(input))
+    lexed, parsed = lex.cache_info(), complete.cache_info()
+    tokens = lex(input, offset=len(input))
+    tokens.append(None)     # Callers get their own copy of the cached tokens
+    assert completer(input, len(input))([{"a": {"b": 1}}]) == ([Field("b")], (6, 7))
+    assert lex(input, offset=len(input)) == tokens[:-1]
+    assert complete.cache_info().hits == parsed.hits + 1
+    assert complete.cache_info().misses == parsed.misses
+    assert lex.cache_info().misses == lexed.misses
+
+
+@pytest.mark.parametrize("sampling,result", [
+    (Sampling("first", limit=2, budget=None), [Field("k0"), Field("k1")]),
+    (Sampling("exhaustive"), [Field("k{}".format(i)) for i in range(10)]),
+    (Sampling("reservoir", limit=10, budget=None), [Field("k{}".format(i)) for i in range(10)]),
+], ids=lambda x: x.method if isinstance(x, Sampling) else "")
+def test_sampling(sampling, result):
+    stream = [{"k{}".format(i): i} for i in range(10)]
+    assert completer(".[] | .k", 8)([stream], sampling=sampling)[0] == result
+
+
+def test_sampling_lazy():
+    # Items beyond the sample are never computed
+    seen = []
+
+    def stream():
+        for i in range(1000):
+            seen.append(i)
+            yield {"a": i}
+    assert completer(".", 1)(stream(), sampling=Sampling("first", limit=5))[0] == [Token(""), Field("a")]
+    assert len(seen) == 5
+
+
+def test_reservoir():
+    sample = Sampling("reservoir", limit=10, budget=None)(range(1000))
+    assert len(sample) == 10 and len(set(sample)) == 10
+    assert max(sample) >= 10
+    assert sample == Sampling("reservoir", limit=10, budget=None)(range(1000))
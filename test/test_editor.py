@@ -0,0 +1,107 @@
+import asyncio
+import types
+from unittest import mock
+
+import pytest
+from prompt_toolkit.input import create_pipe_input
+from prompt_toolkit.output import DummyOutput
+
+from jqi.editor import Editor
+from jqi.render import render
+from jqi.worker import InProcessWorker
+
+
+class Counting:
+    """
+    A worker that counts how often it's asked to evaluate a filter, or for a filter's values.
+    """
+    def __init__(self, worker):
+        self.worker = worker
+        self.evaluations = 0
+        self.fetches = 0
+
+    def stream(self, pattern, args=(), tty=False):
+        self.evaluations += 1
+        return self.worker.stream(pattern, args, tty=tty)
+
+    async def objects(self, pattern):
+        self.fetches += 1
+        return await self.worker.objects(pattern)
+
+    def close(self):
+        self.worker.close()
+
+
+@pytest.fixture
+def editor(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    with create_pipe_input() as pipe, mock.patch("jqi.editor.create_input", lambda **kwargs: pipe):
+        e = Editor()
+        e.app.output = DummyOutput()
+        e.make_worker = lambda: Counting(InProcessWorker(e.input.values()))
+        e.set_input('{"a": [1, 2], "b": 3}')
+        e.buf.text = ".a"
+        yield e
+        e.close()
+
+
+def run(editor, *steps):
+    """
+    Take each step in turn, waiting for any evaluation it starts to finish.
+    """
+    async def main():
+        for step in steps:
+            step()
+            if editor.job is not None:
+                await editor.job
+    asyncio.run(main())
+
+
+def toggle(editor):
+    return lambda: editor.toggle_compact(types.SimpleNamespace(app=editor.app))
+
+
+def test_toggle_current(editor):
+    run(editor, editor.reformat, toggle(editor))
+    worker = editor.worker
+    assert worker.evaluations == 1
+    # The values are at hand now: toggling back is done there and then, without the worker
+    fetches, job = worker.fetches, editor.job
+    run(editor, toggle(editor))
+    assert (worker.evaluations, worker.fetches) == (1, fetches)
+    assert editor.job is job
+    assert editor.cache[Editor.CACHE_BYTES] == render([[1, 2]], colour=True)
+
+
+def test_toggle_stale(editor):
+    run(editor, editor.reformat)
+    # The output on display is for another filter: toggling evaluates the new one
+    editor.buf.text = ".b"
+    run(editor, toggle(editor))
+    assert editor.worker.evaluations == 2
+    assert editor.cache[Editor.CACHE_BYTES] == render([3], compact=True, colour=True)
+
+    # ... or for other input
+    editor.set_input('{"b": 4}')
+    run(editor, toggle(editor))
+    assert editor.worker.evaluations == 1
+    assert editor.cache[Editor.CACHE_BYTES] == render([4], colour=True)
+
+
+def test_toggle_cached(editor):
+    run(editor, editor.reformat, toggle(editor))
+    editor.buf.text = ".b"
+    run(editor, editor.reformat)
+    evaluations = editor.worker.evaluations
+    # The compact output of `.a` was kept when it was rendered
+    editor.buf.text = ".a"
+    run(editor, editor.reformat)
+    assert editor.worker.evaluations == evaluations
+    assert editor.cache[Editor.CACHE_BYTES] == render([[1, 2]], compact=True, colour=True)
+
+
+def test_complete(editor):
+    editor.buf.text = "."
+    editor.buf.cursor_position = 1
+    completions = editor.buf.completer.get_completions(editor.buf.document, None)
+    assert [str(c.text) for c in completions] == ["", "a", "b"]
@@ -1,6 +1,8 @@
+import threading
+
 import pytest
 from jqi.parser import parse, Token, Field, Ident, term, exp, ParseError
-from jqi.eval import make_env, pipe, binding, literal, variable, splice
+from jqi.eval import make_env, pipe, binding, literal, variable, splice, stopping, Stopped
 from jqi.pattern import *
 
 
@@ -19,7 +21,7 @@ def test_variable():
     evaluator = parse("$x", start=exp)
     env = make_env()
     env.update({"$x": 1})
-    assert evaluator(splice(env, [None])) == splice(env, [1])
+    assert list(evaluator(splice(env, [None]))) == splice(env, [1])
 
 
 def test_binding():
@@ -27,4 +29,78 @@ def test_binding():
     evaluator = binding(literal(1), ValueMatch("x"), variable("x"))
     result = evaluator(splice(env, [None]))
     expected_env = env.child({"$x": 1})
-    assert result == splice(expected_env, [1])
+    assert list(result) == splice(expected_env, [1])
+
+
+def test_lazy():
+    env = make_env()
+
+    def stream():
+        yield env, {"a": [1, 2]}
+        raise AssertionError("stream was read too far")
+
+    evaluator = parse(".a | .[] | select(. > 0)", start=exp)
+    results = evaluator(stream())
+    assert next(results) == (env, 1)
+    assert next(results) == (env, 2)
+
+
+def test_flat_environment():
+    env = make_env().child({"$x": 1}).child({"$y": 2}).child({"$x": 3})
+    assert env["$x"] == 3
+    assert env["$y"] == 2
+    assert env["not/0"] is not None
+    assert env == make_env().child({"$x": 3, "$y": 2})
+
+
+def test_frames():
+    # A query's own bindings are frames, found by position, rather than copies of every binding by name
+    evaluator = parse(". as [$x, $y] | . as [$z] | [$x, $y, $z]", start=exp)
+    [(env, value)] = evaluator(splice(make_env(), [[1, 2]]))
+    assert value == [1, 2, 1]
+    assert env.frame.values == (1,)
+    assert env.frame.parent.values == (1, 2)
+    assert "$x" not in env.effective_bindings()
+
+
+@pytest.mark.parametrize("input,stream,result", [
+    ("-5 % 3", [None], [-2]),                   # C's remainder, not Python's
+    ("5 % -3", [None], [2]),
+    ('"ab" * 0', [None], [None]),
+    ('"ab" * 2', [None], ["abab"]),
+    ("null + 1", [None], [1]),
+    ("{a: 1} + {b: 2}", [None], [{"a": 1, "b": 2}]),
+    ("{a: {b: 1}} * {a: {c: 2}}", [None], [{"a": {"b": 1, "c": 2}}]),
+    ("[1, 2, 3, 1] - [1]", [None], [[2, 3]]),
+    ('"a,b" / ","', [None], [["a", "b"]]),
+    ("1 == true", [None], [False]),
+    ("[1] == [true]", [None], [False]),
+    ('null < false, false < 0, 0 < "a", "a" < [], [] < {}', [None], [True] * 5),
+    ("{a: 2} < {a: 1, b: 0}", [None], [True]),  # Keys are compared first
+    ("true + 1", [None], ValueError),
+    ("[1] * 2", [None], ValueError),
+    ("1 / 0", [None], ValueError),
+    ("-true", [None], ValueError),
+    ("{(1): 2}", [None], ValueError),
+], ids=simplify)
+def test_jq_semantics(input, stream, result):
+    env = make_env()
+    evaluator = parse(input, start=exp)
+    if isinstance(result, type) and issubclass(result, Exception):
+        with pytest.raises(result):
+            list(evaluator(splice(env, stream)))
+        return
+    assert [v for (_, v) in evaluator(splice(env, stream))] == result
+
+
+def test_stopping():
+    evaluator = parse(".[] | select(. < 0)", start=exp)
+    stop = threading.Event()
+    token = stopping.set(stop)
+    try:
+        stop.set()
+        with pytest.raises(Stopped):
+            list(evaluator(splice(make_env(), [list(range(100000))])))
+        assert list(evaluator(splice(make_env(), [[1, -1]]))) != []     # small containers aren't checked
+    finally:
+        stopping.reset(token)
@@ -34,3 +34,17 @@ def test_func(input, stream, result):
         return
     env = make_env()
     assert unsplice(parse(input, start=exp)(splice(env, stream))) == result
+
+
+@pytest.mark.parametrize("input,stream,result", [
+    ('def f: . + 1; 1 | f', [None], [2]),
+    ('def f(g): g | g; 2 | f(. * 3)', [None], [18]),
+    ('def f($a): $a + .; 1 | f(2, 3)', [None], [3, 4]),
+    ('def f($a; $b): [$a, $b]; f(1, 2; 3, 4)', [None], [[1, 3], [1, 4], [2, 3], [2, 4]]),
+    ('def f: def g: 3; g; f', [None], [3]),
+    ('def f: select(. >= 5), (select(. < 5) | . + 1 | f); 0 | f', [None], [5]),
+    ('1 as $x | def f: $x; 2 as $x | f, $x', [None], [1, 2]),
+], ids=simplify)
+def test_def(input, stream, result):
+    env = make_env()
+    assert unsplice(parse(input, start=exp)(splice(env, stream))) == result
@@ -1,7 +1,17 @@
 import pytest
+import jqi.lexer
 from jqi.lexer import *
 
 
+@pytest.fixture(params=["parsy", "regex"], autouse=True)
+def scanner(request, monkeypatch):
+    # Run every test against both implementations
+    monkeypatch.setattr(jqi.lexer, "_scan", getattr(jqi.lexer, "_scan_" + request.param))
+    lex.cache_clear()
+    yield
+    lex.cache_clear()
+
+
 def test_equality():
     assert Token("..") == Token("..")
     assert Token("..") == ".."
@@ -20,6 +30,7 @@ def test_equality():
     ("and", [Token("and")]),
     (". ", [Token(".")]),
     ("$x", [Token("$"), Ident("x")]),
+    ('@base64 "a\\n" ?// a::b', [Format("@base64"), String("a\n"), Token("?//"), Ident("a::b")]),
 ], ids=lambda x:
     x.replace(".", "_").replace(" ", "_") if isinstance(x, str) else "".join(type(i).__name__[0] for i in x))
 def test_lexer(input, tokens):
@@ -40,3 +51,64 @@ def test_lexer(input, tokens):
     x.replace(".", "_").replace(" ", "_") if isinstance(x, str) else "".join(type(i).__name__[0] for i in x))
 def test_lexer_positions(input, tokens):
     assert lex(input) == tokens
+
+
+@pytest.mark.parametrize("old,new", [
+    ("", ".data"),
+    (".a | .b", ".a | .bc"),
+    (".a | .b", ".aa | .b"),
+    ("?/", "?//"),
+    ("- 1", "-1"),
+    ('.a | "x" | .b', '.a | "x | .b'),
+    (".a # comment\n| .b", ".a # comment | .b"),
+    ("[.a, .b]", "[.a, .b, .c]"),
+    ("1 + 2", "1 + 2)"),
+])
+def test_relex(old, new):
+    try:
+        expected = lex(new)
+    except ParseError:
+        with pytest.raises(ParseError):
+            relex(old, lex(old), new)
+        return
+    tokens = relex(old, lex(old), new)
+    assert tokens == expected
+    assert [t.pos for t in tokens] == [t.pos for t in expected]
+
+
+def test_edit_range():
+    assert edit_range(".a | .b", ".a | .bc") == (7, 7, 8)
+    assert edit_range(".aa", ".a") == (2, 3, 2)
+    assert edit_range("abc", "xyz") == (0, 3, 3)
+
+
+def test_reentrant():
+    # Lexing with a cursor leaves nothing behind to affect later lexing
+    lex("[.a", offset=2)
+    assert lex("[.a, .b]") == [Token("["), Field("a"), Token(","), Field("b"), Token("]")]
+    with pytest.raises(ParseError):
+        lex("[.a)")
+
+
+@pytest.mark.parametrize("old,old_cursor,new,new_cursor,edit", [
+    (".a | .b", 7, ".a | .bc", 8, (7, 7, 8)),          # typed
+    (".a | .b", 2, ".ab | .b", 3, (2, 2, 3)),
+    (".aa", 3, ".a", 2, (2, 3, 2)),                     # backspace
+    (".aa", 1, ".a", 1, (1, 2, 1)),                     # delete
+    (".a", 2, ".a | .b", 7, (2, 2, 7)),                 # pasted
+    (".a", 0, ".b", 0, None),                           # replaced
+    (".a | .b", 7, ".b", 2, None),                      # the cursor is no guide
+], ids=lambda x: x.replace(".", "_").replace(" ", "_") if isinstance(x, str) else None)
+def test_typed_edit(old, old_cursor, new, new_cursor, edit):
+    assert typed_edit(old, old_cursor, new, new_cursor) == edit
+
+
+def test_relexer():
+    relexer = Relexer()
+    assert relexer(".a | .b") == tuple(lex(".a | .b"))
+    relexer.edited(".a | .b", ".a | .bc", (7, 7, 8))
+    assert relexer(".a | .bc") == tuple(lex(".a | .bc"))
+    # An edit given for some other change is ignored
+    relexer.edited(".a | .b", ".a | .bcd", (7, 7, 9))
+    assert relexer(".a | .bcd") == tuple(lex(".a | .bcd"))
+    assert relexer.lex(".a | .bcd", offset=2) == lex(".a | .bcd", offset=2)
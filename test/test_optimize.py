@@ -0,0 +1,56 @@
+import pytest
+from jqi.parser import parse, exp
+from jqi.eval import make_env, splice, unsplice
+from jqi.optimize import optimize, explain
+
+
+def simplify(x):
+    if isinstance(x, str):
+        return x.replace(".", "_").replace(" ", "_")
+    elif isinstance(x, (list, tuple)):
+        return "".join(type(i).__name__[0] for i in x)
+    elif isinstance(x, type):
+        return x.__name__
+    else:
+        return type(x).__name__
+
+
+@pytest.mark.parametrize("input,plan", [
+    ('1 + 2', "literal 3"),
+    ('1 + 2 * 3 == 7', "literal True"),
+    ('-(1)', "literal -1"),
+    ('. | .a', "field .a"),
+    ('.a | .', "field .a"),
+    ('.|.|.', "dot"),
+    ('.a.b | .c', "fields .a .b .c"),
+    ('"x" as $v | $v', "literal 'x'"),
+    ('"x" as $v | ("y" as $v | $v), $v', "comma\n  literal 'y'\n  literal 'x'"),
+    ('1 as $x | 2 as $y | $x + $y', "literal 3"),
+    ('. as $x | $x', "binding as $x\n  dot\n  local $x 0:0"),
+    ('. as $x | 1 as $y | $x + $y', "binding as $x\n  dot\n  op add\n    local $x 0:0\n    literal 1"),
+    ('. as [$x, $y] | def f(g): g | $y; f(.)', "binding as [$x, $y]\n  dot\n  definition f/1 (g)\n    pipe\n"
+                                                "      local_call g/0 0:0\n      local $y 2:1\n    local_call f/1 0:0\n"
+                                                "      dot"),
+    ('$x', "variable $x"),
+    ('1 / 0', "op truediv\n  literal 1\n  literal 0"),
+    ('def select(f): 1; select(.), not', "definition select/1 (f)\n  literal 1\n  comma\n    local_call select/1 0:0\n"
+                                         "      dot\n    builtin not/0"),
+    ('def g(not): not; g(1)', "definition g/1 (not)\n  local_call not/0 0:0\n  local_call g/1 0:0\n    literal 1"),
+    ('.a | select(.b == 1)', "pipe\n  field .a\n  builtin select/1\n    op eq\n      field .b\n      literal 1"),
+], ids=simplify)
+def test_plan(input, plan):
+    assert explain(optimize(parse(input, start=exp))) == plan
+
+
+@pytest.mark.parametrize("input,stream", [
+    ('.a.b | .c', [{"a": {"b": {"c": 1}}}, {}, None]),
+    ('"x" as $v | [$v, ("y" as $v | $v), $v]', [None]),
+    ('1 as $x | def f: $x; f', [None]),
+    ('2 as $x | [.[] | . * $x]', [[1, 2, 3]]),
+    ('1 as $x | . as [$x] | $x', [[5]]),
+    ('.a = 1 + 1', [{}]),
+], ids=simplify)
+def test_optimized_results(input, stream):
+    evaluator = parse(input, start=exp)
+    expected = unsplice(evaluator(splice(make_env(), stream)))
+    assert unsplice(optimize(evaluator)(splice(make_env(), stream))) == expected
@@ -1,5 +1,6 @@
 import pytest
-from jqi.parser import parse, Token, Field, Ident, term, exp, ParseError
+from jqi.lexer import lex
+from jqi.parser import parse, Token, Field, Ident, term, exp, top_level, ParseError
 from jqi.error import Error
 from jqi.eval import make_env, splice, unsplice
 from jqi import parser
@@ -28,10 +29,12 @@ def simplify(x):
     ('"a"', [None], ["a"]),
     ('[]', [None], [[]]),
     ('{}', [None], [{}]),
-    ('{a}', [None], [{"a":"a"}]),
+    ('{a}', [None], [{"a": None}]),
+    ('{a}', [{"a": 1, "b": 2}], [{"a": 1}]),
+    ('{"a"}', [{"a": 1}], [{"a": 1}]),
     ('{a: 1}', [None], [{"a": 1}]),
     ('{as: 1}', [None], [{"as": 1}]),
-    ('{"a"}', [None], [{"a": "a"}]),
+    ('{"a"}', [None], [{"a": None}]),
     ('{"a": 1}', [None], [{"a": 1}]),
 ], ids=simplify)
 def test_term(input, stream, result):
@@ -40,7 +43,7 @@ def test_term(input, stream, result):
             parse(input, start=term)
         return
     env = make_env()
-    assert parse(input, start=term)(splice(env, stream)) == splice(env, result)
+    assert list(parse(input, start=term)(splice(env, stream))) == splice(env, result)
 
 
 def test_field():
@@ -85,6 +88,10 @@ def test_field():
          {"b": "d", "e": "g"}, {"b": "d", "e": "h"}, {"b": "d", "f": "g"}, {"b": "d", "f": "h"}]),
     ('"A" as $a | $a', [None], ["A"]),
     ('"A" as $a | {$a}', [None], [{"a": "A"}]),
+    ("1 - 2 - 3", [None], [-4]),               # Left-associative
+    ("1, 2 | . * 10", [None], [10, 20]),        # Comma binds tighter than pipe
+    ("1 + 2 == 3 and 2 < 1 or 1 == 1", [None], [True]),
+    ("- .a * 2", [{"a": 3}], [-6]),
 ], ids=simplify)
 def test_exp(input, stream, result):
     if isinstance(result, type) and issubclass(result, Exception):
@@ -93,3 +100,32 @@ def test_exp(input, stream, result):
         return
     env = make_env()
     assert unsplice(parse(input, start=exp)(splice(env, stream))) == result
+
+
+def test_fused_fields():
+    assert parse('.a.b."c"', start=term).node == ("fields", "a", "b", "c")
+    assert parse('.a | .b', start=exp).node[0] == "pipe"
+
+
+@pytest.mark.parametrize("input,exception", [
+    ("1 == 2 == 3", ParseError),                # Comparisons don't associate
+    (".a = .b = .c", ParseError),
+    (".a | ", ParseError),
+    ("(1", ParseError),
+    ("f(1;)", ParseError),
+    ("{a: 1,}", ParseError),
+    (".a // .b", NotImplementedError),
+    (".a |= 1", NotImplementedError),
+], ids=simplify)
+def test_rejected(input, exception):
+    with pytest.raises(exception):
+        parse(input)
+
+
+def test_long_chains():
+    # Chains don't recurse in the parser, however long they get
+    tokens = lex(" | ".join([".a"] * 5000))
+    assert top_level.parse(tokens).node[0] == "pipe"
+    tokens = lex(", ".join(["1"] * 5000))
+    assert top_level.parse(tokens).node[0] == "comma"
+    assert unsplice(parse("[" * 100 + "1" + "]" * 100)(splice(make_env(), [None])))[0] is not None
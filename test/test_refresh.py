@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from jqi.editor import Refresh
+
+
+@pytest.mark.parametrize("adaptive, last, expected", [
+    (False, None, 0.5),
+    (False, 0.01, 0.5),
+    (True, None, 0.5),
+    (True, 0.001, Refresh.MIN_DELAY),
+    (True, 0.1, 0.2),
+    (True, 2, 0.5),
+])
+def test_refresh_delay(adaptive, last, expected):
+    r = Refresh(delay=0.5, adaptive=adaptive)
+    if last is not None:
+        r.record_duration(last)
+    assert r.refresh_delay() == pytest.approx(expected)
+
+
+def test_debounce():
+    pattern = [""]
+    calls = []
+    r = Refresh(delay=0.05, adaptive=False)
+
+    async def main():
+        r.start_refresh(refresh=lambda: calls.append(pattern[0]), get_pattern=lambda: pattern[0])
+        for p in ".", ".a", ".ab":
+            pattern[0] = p
+            r.schedule_refresh()
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+        # Unchanged: nothing to do
+        r.schedule_refresh()
+        await asyncio.sleep(0.1)
+        r.stop_refresh()
+
+    asyncio.run(main())
+    assert calls == [".ab"]
+
+
+def test_undone_edit():
+    pattern = ["."]
+    calls = []
+    r = Refresh(delay=0.05, adaptive=False)
+
+    async def main():
+        r.start_refresh(refresh=lambda: calls.append(pattern[0]), get_pattern=lambda: pattern[0])
+        # An edit undone before the refresh fires leaves the pattern as it was
+        for p in ".a", ".":
+            pattern[0] = p
+            r.schedule_refresh()
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+        pattern[0] = ".b"
+        r.schedule_refresh()
+        await asyncio.sleep(0.1)
+        r.stop_refresh()
+
+    asyncio.run(main())
+    assert calls == [".b"]
@@ -0,0 +1,46 @@
+import json
+import shutil
+import subprocess
+import pytest
+from jqi.render import render, dumps
+
+DOCS = [
+    '{"a": [1, null, true, "s", {}], "b": {}, "c": [], "d": 1.5}',
+    '[1.0, 1e17, 1e16, -0.0, 1460323737035677698, 0.00001, "a\\u007fb\\u0001\\n", "\\u00e9", false, [[[]]], {"x": {"y": [1, {"z": null}]}}]',
+    '"top"',
+]
+
+
+@pytest.mark.parametrize("value,compact,text", [
+    ({"a": [1, "x"]}, True, '{"a":[1,"x"]}'),
+    ({"a": [1, "x"]}, False, '{\n  "a": [\n    1,\n    "x"\n  ]\n}'),
+    ([], False, "[]"),
+    (2.0, True, "2"),
+    (1e17, True, "1e+17"),
+    (float("nan"), True, "null"),
+    (1460323737035677698, True, "1460323737035677700"),
+    (1e16, True, "1e+16"),
+    (2.5e15, True, "2500000000000000"),
+    (-0.0, True, "-0"),
+    (0.0001, True, "0.0001"),
+    (0.00001, True, "1e-05"),
+    (123456e-9, True, "0.000123456"),
+    (-1.5e-10, True, "-1.5e-10"),
+    (float("inf"), True, "1.7976931348623157e+308"),
+])
+def test_dumps(value, compact, text):
+    assert dumps(value, compact=compact) == text
+
+
+def test_raw():
+    assert render(["a\nb", {"c": "d"}], compact=True, raw=True) == 'a\nb\n{"c":"d"}\n'
+
+
+@pytest.mark.skipif(shutil.which("jq") is None, reason="needs jq")
+@pytest.mark.parametrize("doc", DOCS)
+@pytest.mark.parametrize("flags", [[], ["-c"], ["-r"]])
+@pytest.mark.parametrize("colour", [False, True])
+def test_matches_jq(doc, flags, colour):
+    expected = subprocess.run(["jq", *flags, "-C" if colour else "-M", "."],
+                              input=doc, capture_output=True, text=True).stdout
+    assert render([json.loads(doc)], compact="-c" in flags, raw="-r" in flags, colour=colour) == expected
@@ -0,0 +1,146 @@
+import io
+import json
+import os
+import pytest
+
+from jqi.source import Input, MappedValues, parse_values, detect, NDJSON, CONCATENATED, DOCUMENT
+
+
+def simplify(x):
+    if isinstance(x, str):
+        return x.replace(".", "_").replace(" ", "_")
+    else:
+        return type(x).__name__
+
+
+def test_from_stream():
+    data = '{"a": "é"}\n'.encode() * 1000
+    with Input.from_stream(io.BytesIO(data), chunk=100) as source:
+        path = source.path
+        with open(path, "rb") as f:
+            assert f.read() == data
+    assert not os.path.exists(path)
+
+
+def test_from_path(tmp_path):
+    path = tmp_path / "input.json"
+    path.write_text("[1, 2]")
+    with Input.from_path(str(path)) as source:
+        assert source.path == str(path)
+    assert path.exists()
+
+
+def test_from_text():
+    with Input.from_text("null") as source:
+        assert source.values() == [None]
+        path = source.path
+        with open(path) as f:
+            assert f.read() == "null"
+    assert not os.path.exists(path)
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "  \n",
+    "1",
+    '1 "two" [3] {"four": 4} null true',
+    '{"a": "]}[{\\"", "b": [{}, []]}\n[1,\n 2]\n"x"',
+    '{"a": 1}\n{"a": 2}\n\n{"a": 3}\n',
+], ids=simplify)
+def test_document(tmp_path, text):
+    path = tmp_path / "input.json"
+    path.write_text(text)
+    doc = MappedValues(str(path))
+    assert list(doc) == parse_values(text)
+    assert len(doc) == len(parse_values(text))
+    doc.close()
+
+
+def test_document_lazy(tmp_path):
+    path = tmp_path / "input.json"
+    path.write_text('{"a": 1}\n{"a": 2}\n{"a": oops}\n')
+    for lines in (False, True):
+        doc = MappedValues(str(path), lines=lines)
+        assert doc[1] == {"a": 2}
+        assert len(doc._starts) == 2           # nothing beyond the value used has been looked at
+        with pytest.raises(json.JSONDecodeError):
+            doc[2]
+        assert len(doc) == 3
+        doc.close()
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("", DOCUMENT),
+    ("  [1, 2]\n", DOCUMENT),
+    ('{\n  "a": 1\n}\n', DOCUMENT),
+    ('{"a": 1}\n{"a": 2}\n', NDJSON),
+    ('{"a": "\\n"}\r\n\n1\n"two" \n[3]', NDJSON),
+    ('{"a": 1} {"a": 2}\n', CONCATENATED),
+    ('{\n  "a": 1\n}\n{\n  "a": 2\n}\n', CONCATENATED),
+    ('1 2', CONCATENATED),
+], ids=simplify)
+def test_detect(text, expected):
+    assert detect(text.encode()) == expected
+
+
+def test_detect_sample():
+    text = b'{"a": 1}\n' * 1000 + b'{"a": 1} {"a": 2}\n'
+    assert detect(text, sample=100) == NDJSON
+    assert detect(text) == CONCATENATED
+    assert detect(b"[" + b"1, " * 1000 + b"1] 2", sample=100) == DOCUMENT
+
+
+@pytest.mark.parametrize("lines", [False, True])
+def test_parallel(tmp_path, lines):
+    values = [{"a": i, "b": "x" * (i % 10)} for i in range(1000)]
+    path = tmp_path / "input.json"
+    path.write_text("".join(json.dumps(v) + "\n" for v in values))
+    doc = MappedValues(str(path), processes=2)
+    assert doc.lines
+    doc = MappedValues(str(path), lines=lines, processes=2)
+    doc.PARALLEL = doc.BATCH = 64
+    assert list(doc) == values
+    assert doc._pool is None                # iterating, as sampling does, stays in-process
+    assert list(doc.traverse()) == values
+    pool = doc._pool
+    assert list(doc.traverse()) == values
+    assert doc._pool is pool                # one pool, however many times the values are gone through
+    doc.close()
+    assert doc._pool is None
+
+
+def test_large_values(tmp_path):
+    # The first value is too big for `detect` to see the end of, so the file looks like a single document
+    values = [{"a": "x" * 2 ** 20}, {"a": 2}]
+    path = tmp_path / "input.json"
+    path.write_text(json.dumps(values[0]))
+    doc = MappedValues(str(path))
+    assert list(doc) == values[:1]
+    doc.close()
+    path.write_text(" ".join(json.dumps(v) for v in values) + "\n")
+    doc = MappedValues(str(path))
+    assert list(doc) == values
+    assert doc._ends[1] == path.stat().st_size - 1
+    doc.close()
+
+
+def test_large_values_traverse(tmp_path):
+    values = [{"a": "x" * 2 ** 20}, {"a": 2}, {"a": 3}]
+    path = tmp_path / "input.json"
+    path.write_text(json.dumps(values[0]))
+    doc = MappedValues(str(path), processes=2)
+    doc.PARALLEL = 0
+    assert list(doc.traverse()) == values[:1]
+    assert doc._pool is None                # a single document is decoded in-process
+    doc.close()
+    path.write_text(" ".join(json.dumps(v) for v in values) + "\n")
+    doc = MappedValues(str(path), processes=2)
+    doc.PARALLEL = 0
+    assert list(doc.traverse()) == values
+    assert doc._pool is None                # what follows it is less than a batch
+    doc.close()
+    doc = MappedValues(str(path), processes=2)
+    doc.PARALLEL, doc.BATCH = 0, 1
+    assert list(doc.traverse()) == values
+    assert doc._pool is not None
+    doc.close()
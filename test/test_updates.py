@@ -1,6 +1,6 @@
 import pytest
 from jqi.parser import parse, Token, Field, Ident, term, exp, ParseError
-from jqi.eval import make_env, pipe, binding, literal, variable, splice, unsplice
+from jqi.eval import make_env, pipe, binding, literal, variable, splice, unsplice, materialise, deep_update, ROOT
 from jqi.pattern import *
 
 
@@ -25,6 +25,8 @@ def simplify(x):
     ('.a."b".c = 2', [{}], [{"a": {"b": {"c": 2}}}]),
     ('.a | . | .c = 2', [{}], [{"a": {"c": 2}}]),
     ('. | (.a, .b) = (1, 2)', [None], [{"a": 1, "b": 1}, {"a": 2, "b": 2}]),
+    ('.a | (. as $x | .b = 1)', [{}], [{"a": {"b": 1}}]),
+    ('.a.b = 1', [{"a": {"c": 2}, "d": 3}], [{"a": {"b": 1, "c": 2}, "d": 3}]),
 ], ids=simplify)
 def test_updates(input, stream, result):
     if isinstance(result, type) and issubclass(result, Exception):
@@ -33,3 +35,17 @@ def test_updates(input, stream, result):
         return
     env = make_env()
     assert unsplice(parse(input, start=exp)(splice(env, stream))) == result
+
+
+def test_materialise():
+    assert materialise(ROOT) == []
+    assert materialise(((ROOT, "a"), ("b", "c"))) == ["a", "b", "c"]
+
+
+def test_deep_update():
+    # Deeper than the Python stack would allow for a recursive implementation
+    path = ["a"] * 5000
+    result = deep_update({}, [Field(step) for step in path], 1)
+    for _ in path:
+        result = result["a"]
+    assert result == 1
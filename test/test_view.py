@@ -0,0 +1,43 @@
+import pytest
+
+from jqi.view import LineIndex
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "\n",
+    "a",
+    "a\n",
+    "a\nbb\nccc",
+    "a\nbb\nccc\n",
+    "\n\nabc\n\n",
+    "one\ntwo three\n\nfour\n",
+])
+def test_lines(text):
+    index = LineIndex(text)
+    lines = text.splitlines()
+    assert len(index) == len(lines)
+    assert [index.line(i) for i in range(len(index))] == lines
+    assert index.width(0, len(index)) == max((len(line) for line in lines), default=0)
+
+
+@pytest.mark.parametrize("top, height, left, width", [
+    (0, 2, 0, None),
+    (1, 10, 0, None),
+    (2, 2, 1, 2),
+    (0, 5, 3, 1),
+    (5, 2, 0, None),
+])
+def test_window(top, height, left, width):
+    text = "one\ntwo three\n\nfour\n"
+    lines = text.splitlines()
+    expected = [line[left:None if width is None else left + width] for line in lines[top:top + height]]
+    assert LineIndex(text).window(top, height, left, width) == expected
+
+
+def test_blocks():
+    lines = ["line {}".format(i) * (i % 7) for i in range(5000)]
+    index = LineIndex("\n".join(lines))
+    assert len(index) == len(lines)
+    for top in (0, 1, 586, 2500, 4990):
+        assert index.window(top, 20) == lines[top:top + 20]
@@ -0,0 +1,61 @@
+import pytest
+from jqi.parser import parse, exp
+from jqi.eval import make_env, splice, unsplice
+from jqi.vm import compile_filter
+
+
+def simplify(x):
+    if isinstance(x, str):
+        return x.replace(".", "_").replace(" ", "_")
+    elif isinstance(x, (list, tuple)):
+        return "".join(type(i).__name__[0] for i in x)
+    elif isinstance(x, type):
+        return x.__name__
+    else:
+        return type(x).__name__
+
+
+@pytest.mark.parametrize("input,stream,result", [
+    (".", [1, 2, 3], [1, 2, 3]),
+    (".a.b", [{"a": {"b": "c"}}, {}], ["c", None]),
+    (".|.|.|.", [1, 2, 3], [1, 2, 3]),
+    ("1, 2", [0, 0], [1, 2, 1, 2]),
+    ("3 - 1 - 1", [None], [1]),
+    ('(1, 3) * (4, 7)', [None], [4, 12, 7, 21]),
+    ('-(1, 2)', [None], [-1, -2]),
+    ('(false, true) and (true, false)', [None], [False, True, False]),
+    ('(false, true) or (true, false)', [None], [True, False, True]),
+    (".[]", [[1, 2, 3], {"a": 4, "b": 5}], [1, 2, 3, 4, 5]),
+    ("[.[] | [.[] | . * 10]]", [[[1, 2], [3]]], [[[10, 20], [30]]]),
+    ("[empty], [1, 2]", [None], [[], [1, 2]]),
+    ('{("a", "b"):("c", "d")}', [None], [{"a": "c"}, {"a": "d"}, {"b": "c"}, {"b": "d"}]),
+    ('[[1, 2], [3, 4]] as [$x, [$y, $z]] | [$x, $y, $z]', [None], [[[1, 2], 3, 4]]),
+    ('. as {("a", "b"):$A} | $A', [{"a": 1, "b": 2}], [1, 2]),
+    ('.a.b = 2', [{}], [{"a": {"b": 2}}]),
+    ('1, 2, 3 | select(. < 3, . % 2 != 0)', [None], [1, 1, 2, 3]),
+    ('def f: . + 1; 1 | f', [None], [2]),
+    ('def f(g): g | g; 2 | f(. * 3)', [None], [18]),
+    ('def f(g): [g, g]; f(.[])', [[1, 2]], [[1, 2, 1, 2]]),
+    ('def f($a; $b): [$a, $b]; f(1, 2; 3, 4)', [None], [[1, 3], [1, 4], [2, 3], [2, 4]]),
+    ('def f: def g: 3; g; f', [None], [3]),
+    ('1 as $x | def f: $x; 2 as $x | f, $x', [None], [1, 2]),
+    ('def f(g): def h: g; 2 | h; 1 | f(. + 10)', [None], [12]),
+    ('def f: def g: 3; g * 2; def g: 5; f, g', [None], [6, 5]),
+    ('. as [$a, $b] | def f($x): [$a, $x, $b]; f(5), ($b as $a | f($a))', [[1, 2]], [[1, 5, 2], [1, 2, 2]]),
+    ('.a as $k | . as {($k): $v} | $v', [{"a": "x", "x": 1}], [1]),
+], ids=simplify)
+def test_vm(input, stream, result):
+    env = make_env()
+    evaluator = parse(input, start=exp)
+    assert unsplice(compile_filter(evaluator)(splice(env, stream))) == result
+
+
+def test_tail_recursion():
+    # This recurses far deeper than the Python stack would allow
+    evaluator = parse('def f: select(. >= 20000), (select(. < 20000) | . + 1 | f); 0 | f', start=exp)
+    assert unsplice(compile_filter(evaluator)(splice(make_env(), [None]))) == [20000]
+
+
+def test_tail_call_marked():
+    program = compile_filter(parse('def f: select(. < 3) | . + 1 | f; f', start=exp))
+    assert "TAIL_CALL 'f/0'" in program.dump()
@@ -0,0 +1,206 @@
+import asyncio
+import io
+import json
+import os
+import shutil
+import time
+import pytest
+from jqi.worker import JqWorker, InProcessWorker, FallbackWorker, Unsupported, Failed
+
+needs_jq = pytest.mark.skipif(shutil.which("jq") is None, reason="needs jq")
+
+
+@needs_jq
+def test_jq_worker():
+    with JqWorker('{"a": [1, 2]} {"a": [3]}') as worker:
+        assert worker.run(".a[]") == ("1\n2\n3\n", None)
+        path = worker.path
+        assert worker.run(".a", ["-c"]) == ("[1,2]\n[3]\n", None)
+        out, err = worker.run(".a[")
+        assert out is None and err
+    assert not os.path.exists(path)
+
+
+@pytest.mark.parametrize("pattern,args,result", [
+    (".a[]", [], "1\n2\n3\n"),
+    (".a", ["-c"], "[1,2]\n[3]\n"),
+    ('"x"', ["-r"], "x\nx\n"),
+    ("{b: .a}", ["-c"], '{"b":[1,2]}\n{"b":[3]}\n'),
+])
+def test_in_process_worker(pattern, args, result):
+    worker = InProcessWorker([{"a": [1, 2]}, {"a": [3]}])
+    assert worker.run(pattern, args) == (result, None)
+
+
+@pytest.mark.parametrize("pattern,args", [
+    (".a[", []),                # Doesn't parse
+    (".a | length", []),        # Not implemented
+    (".a.b", []),               # Error result
+    (".", ["-S"]),              # Unsupported flag
+    ("true + 1", []),           # jq's type error
+    (".a | .b = 1", []),        # Updates aren't checked against jq
+])
+def test_in_process_unsupported(pattern, args):
+    worker = InProcessWorker([{"a": [1, 2]}])
+    with pytest.raises(Unsupported):
+        worker.run(pattern, args)
+
+
+@needs_jq
+@pytest.mark.parametrize("doc,pattern", [
+    ('[{"a": 1}, null, {"b": 2}]', "[.[] | select(.a == 1)]"),
+    ('[{"a": 1}, 5]', "[.[] | select(.a == 1)]"),       # jq fails part way through the filter...
+    ("1", "select(.a)"),
+    ("[1]", ".a and .e"),
+    ("[1]", ".g * 2"),
+    ("[1]", "{(.g): 1}"),
+    ("[1]", ".a < .g"),
+    ('{"a": "x"}', "[.a.b.c]"),
+    ('{"a": null}', "[.a.b.c]"),                        # ... but not on null
+    ('{"a": 1}', "def f: .a; [f, (.a | f)]"),
+    ("0", "-0"),                                        # jq's numbers are doubles, with a signed zero
+    ("0", "[-0, 0 * -1, -0 * 1, -0 / 1, -0 - 0, -0 + 0, -1 * 0, 2 * 3]"),
+    ("-1", "[. * 0, 0 * ., . * -0, -(. * 0)]"),
+    ("[0, -2]", "[.[] | . * -2]"),
+    ("0", "def f: . * -1; [f, (1 | f)]"),
+])
+def test_in_process_matches_jq(doc, pattern):
+    worker = InProcessWorker([json.loads(doc)])
+    with JqWorker(doc) as jq:
+        expected, error = jq.run(pattern, ["-c"])
+    if error:
+        with pytest.raises(Unsupported):
+            worker.run(pattern, ["-c"])
+    else:
+        assert worker.run(pattern, ["-c"]) == (expected, None)
+
+
+@needs_jq
+def test_fallback_worker():
+    text = '{"a": [1, 2]}'
+    with FallbackWorker(InProcessWorker([{"a": [1, 2]}]), JqWorker(text)) as worker:
+        assert worker.run(".a[]") == ("1\n2\n", None)
+        assert worker.workers[1].path is None       # jq wasn't needed
+        assert worker.run(".a | length") == ("2\n", None)
+        out = io.StringIO()
+        out.isatty = lambda: False
+        assert worker.run(".a | length", out=out, err=io.StringIO()) == (None, None)
+        assert out.getvalue() == "2\n"
+
+
+@needs_jq
+def test_jq_worker_async():
+    async def main():
+        with JqWorker('{"a": [1, 2]}') as worker:
+            assert await worker.run_async(".a[]") == ("1\n2\n", None)
+            assert await worker.run_async(".a[0]", tty=True) == ("\033[0;39m1\033[0m\n", None)
+            out, err = await worker.run_async(".a[")
+            assert out is None and err
+    asyncio.run(main())
+
+
+@needs_jq
+def test_jq_worker_cancel():
+    async def main():
+        with JqWorker("null") as worker:
+            job = asyncio.ensure_future(worker.run_async("[range(1e9)] | length"))
+            await asyncio.sleep(0.2)
+            job.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await job
+    start = time.monotonic()
+    asyncio.run(main())
+    assert time.monotonic() - start < 5
+
+
+def test_in_process_worker_async():
+    worker = InProcessWorker([{"a": i} for i in range(100)])
+    assert asyncio.run(worker.run_async(".a", ["-c"])) == ("".join("{}\n".format(i) for i in range(100)), None)
+    with pytest.raises(Unsupported):
+        asyncio.run(worker.run_async(".a.b"))
+
+
+def test_in_process_worker_cancel():
+    async def main():
+        worker = InProcessWorker([{"a": list(range(1000))}] * 10000)
+        job = asyncio.ensure_future(worker.run_async(".a[] | select(. < 0)"))
+        await asyncio.sleep(0.1)
+        assert not job.done()
+        job.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await job
+    start = time.monotonic()
+    asyncio.run(main())
+    assert time.monotonic() - start < 2
+
+
+def test_in_process_worker_responsive():
+    # One input, and a long way to go before any output: other tasks still get to run
+    async def main():
+        worker = InProcessWorker([[{"a": i} for i in range(300000)]])
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.001)
+
+        ticker = asyncio.ensure_future(tick())
+        assert await worker.run_async("[.[] | select(.a < 0)]") == ("[]\n", None)
+        ticker.cancel()
+        assert max(b - a for a, b in zip(ticks, ticks[1:])) < 0.1
+    asyncio.run(main())
+
+
+@needs_jq
+def test_jq_worker_stream():
+    async def main():
+        with JqWorker("null") as worker:
+            worker.CHUNK = 16
+            stream = worker.stream("range(100)")
+            chunks = [await stream.__anext__() for _ in range(3)]
+            await stream.aclose()
+            assert "".join(chunks) == "".join("{}\n".format(i) for i in range(100))[:48]
+            with pytest.raises(Failed):
+                async for _ in worker.stream("error(\"x\")"):
+                    pass
+    asyncio.run(main())
+
+
+@needs_jq
+def test_fallback_worker_restart():
+    # The in-process worker fails after it's produced some output: the output starts again, from jq
+    objects = [{"a": i} for i in range(3)] + [{"a": "x"}]
+    text = " ".join(json.dumps(o) for o in objects)
+
+    async def main():
+        with FallbackWorker(InProcessWorker(objects), JqWorker(text)) as worker:
+            worker.workers[0].SLICE = 0
+            chunks = []
+            with pytest.raises(Failed):
+                async for chunk in worker.stream(".a - 1"):
+                    chunks.append(chunk)
+            return chunks
+    chunks = asyncio.run(main())
+    restart = chunks.index(None)
+    assert restart > 0
+    assert "".join(chunks[restart + 1:]) == "-1\n0\n1\n"
+
+
+@needs_jq
+def test_objects():
+    objects = [{"a": [1, "x\ny"]}, {"a": [{"b": None}, "x\u2028\x85y"]}]
+    text = " ".join(json.dumps(o) for o in objects)
+
+    async def main():
+        with JqWorker(text) as jq:
+            assert await jq.objects(".a[]") == [1, "x\ny", {"b": None}, "x\u2028\x85y"]
+            with pytest.raises(Failed):
+                await jq.objects(".a[")
+        in_process = InProcessWorker(objects)
+        assert await in_process.objects(".a[]") == [1, "x\ny", {"b": None}, "x\u2028\x85y"]
+        await in_process.run_async(".a", ["-r"])
+        assert in_process.last == (".a", [[1, "x\ny"], [{"b": None}, "x\u2028\x85y"]])
+        with FallbackWorker(in_process, JqWorker(text)) as worker:
+            assert await worker.objects(".a | length") == [2, 2]
+    asyncio.run(main())